@@ -1,15 +1,23 @@
 #!/usr/bin/env python
-import pymongo
+"""
+Print the mouse document fields that hold expression data (one per gene). The gene IDs are read from the catalog
+that the importer maintains (see src/catalog.py) rather than by scanning every mouse.
+"""
 
-if __name__ == '__main__':
-    con = pymongo.MongoClient('mr4.jax.org', 27017)
-    mouse = con.attie_keller_pheno.mouse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
 
-    expr_ids = set()
-    for mouse in mouse.find({'expression_data': {'$exists': True, '$ne': None}}):
-        for gene_id in mouse['expression_data'].iterkeys():
-            expr_ids.add(gene_id)
+import config
+import mongodb_utils
+
+if __name__ == '__main__':
+    mongodb_utils.connect(config.MONGO_SERVER, config.MONGO_PORT)
+    mongodb_utils.set_default_database(config.MONGO_DATABASE)
+    if mongodb_utils.get_catalog() is None:
+        sys.exit('the dataset has no catalog. Run "python src/catalog.py --rebuild" to build it')
 
-    print 'mouse_id'
-    for expr_id in expr_ids:
-        print 'expression_data.{}'.format(expr_id)
+    print('mouse_id')
+    for expr_id, _ in mongodb_utils.get_catalog_genes():
+        print('expression_data.{}'.format(expr_id))
@@ -0,0 +1,159 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Admission control for routes. Routes are put into groups (eg. expensive analyses and cheap searches) and each
+group allows a limited number of requests to run at once and a limited number to wait for a slot. Requests that
+can't wait (or wait for too long) are rejected straight away so that an overloaded group can't tie up every server
+thread and slow down the other groups.
+"""
+
+import collections
+import threading
+import time
+
+
+class RouteLimiter(object):
+    """
+    Limits the number of requests for a group of routes that run at once.
+    """
+
+    def __init__(self, name, max_concurrent, max_queued=0, queue_timeout=0.0, retry_after=1):
+        """
+        :param name: the group name that stats are reported under
+        :param max_concurrent: the maximum number of requests that run at once
+        :param max_queued: the maximum number of requests that wait for a slot
+        :param queue_timeout: the maximum number of seconds that a request waits for a slot
+        :param retry_after: the number of seconds that rejected clients are told to wait before retrying
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._in_flight = collections.Counter()
+        self._queued = collections.Counter()
+        self._counts = collections.Counter()
+
+    def acquire(self, route):
+        """
+        Wait for a slot to run a request.
+
+        :param route: the route (endpoint) name that the request is for
+        :return: True if the request can run (in which case release must be called once it is done) or False if
+                 it was rejected
+        """
+        with self._condition:
+            if sum(self._in_flight.values()) < self.max_concurrent:
+                self._in_flight[route] += 1
+                self._counts['admitted'] += 1
+                return True
+
+            if sum(self._queued.values()) >= self.max_queued:
+                self._counts['rejected'] += 1
+                return False
+
+            self._queued[route] += 1
+            deadline = time.time() + self.queue_timeout
+            try:
+                while sum(self._in_flight.values()) >= self.max_concurrent:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._counts['timed_out'] += 1
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self._queued[route] -= 1
+
+            self._in_flight[route] += 1
+            self._counts['admitted'] += 1
+            self._counts['queued'] += 1
+            return True
+
+    def release(self, route):
+        """
+        Free the slot taken by a request that acquire admitted.
+
+        :param route: the route (endpoint) name that the request was for
+        """
+        with self._condition:
+            self._in_flight[route] -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        :return: a dict of the group's limits, its current in-flight and queued requests (in total and by route)
+                 and counts of admitted, queued, rejected and timed out requests
+        """
+        with self._condition:
+            routes = set(route for route, count in self._in_flight.items() if count) | \
+                set(route for route, count in self._queued.items() if count)
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queued': self.max_queued,
+                'queue_timeout': self.queue_timeout,
+                'in_flight': sum(self._in_flight.values()),
+                'queued': sum(self._queued.values()),
+                'routes': {
+                    route: {'in_flight': self._in_flight[route], 'queued': self._queued[route]}
+                    for route in routes
+                },
+                'admitted': self._counts['admitted'],
+                'queued_total': self._counts['queued'],
+                'rejected': self._counts['rejected'],
+                'timed_out': self._counts['timed_out'],
+            }
+
+
+class AdmissionController(object):
+    """
+    Maps routes to the RouteLimiter of their group.
+    """
+
+    def __init__(self, limits):
+        """
+        :param limits: a dict of group name to a dict of that group's 'routes' (a list of endpoint names),
+                       'max_concurrent', 'max_queued', 'queue_timeout' and 'retry_after' (see RouteLimiter)
+        """
+        self.limiters = collections.OrderedDict()
+        self._route_limiters = {}
+        for name in sorted(limits):
+            group = limits[name]
+            limiter = RouteLimiter(
+                name,
+                group['max_concurrent'],
+                group.get('max_queued', 0),
+                group.get('queue_timeout', 0.0),
+                group.get('retry_after', 1))
+            self.limiters[name] = limiter
+            for route in group['routes']:
+                self._route_limiters[route] = limiter
+
+    def limiter(self, route):
+        """
+        :param route: the route (endpoint) name
+        :return: the route's RouteLimiter or None if the route isn't limited
+        """
+        return self._route_limiters.get(route)
+
+    def stats(self):
+        """
+        :return: a dict of the stats of every group keyed by group name
+        """
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
@@ -17,14 +17,37 @@
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask import Flask
+from flask import abort
+from flask import g
+from flask import Response
+from flask import json as flask_json
 from flask import render_template
 from flask import jsonify
 from flask import request
+from flask import stream_with_context
 
-from scipy.stats import pearsonr, spearmanr
+import numpy as np
 
+import admission
+import cache_snapshot
+import coexpression
 import config
+import correlation
+import correlation_significance
+import correlation_sketch
+import correlation_workers
+import dataset
+import gene_sets
+import heatmap
+import jobs
+import memory_usage
 import mongodb_utils
+import phenotype_cache
+import result_cache
+import sample_index
+import sample_pca
+import scatter_density
+import tsv_export
 
 app = Flask(__name__)
 
@@ -37,6 +60,97 @@ app.config.from_object('config')
 
 mongodb_utils.connect(app.config['MONGO_SERVER'], app.config['MONGO_PORT'])
 mongodb_utils.set_default_database(app.config['MONGO_DATABASE'])
+cache_snapshot.set_snapshot_dir(app.config.get('CACHE_SNAPSHOT_DIR'), app.config['MONGO_DATABASE'])
+dataset.set_version_check_interval(app.config.get('DATASET_VERSION_CHECK_INTERVAL', 5.0))
+phenotype_cache.set_max_cached_columns(app.config.get('PHENOTYPE_CACHE_SIZE', 1000))
+
+CORRELATION_CACHE = result_cache.ResultCache(
+    'correlation',
+    app.config.get('CORRELATION_CACHE_BYTES', 64 * 1024 * 1024))
+CORRELATION_CACHE_TOP_K = app.config.get('CORRELATION_CACHE_TOP_K', 1000)
+NEARBY_WINDOW = app.config.get('NEARBY_WINDOW', 1000000)
+PCA_CACHE = result_cache.ResultCache('pca', app.config.get('PCA_CACHE_BYTES', 16 * 1024 * 1024))
+PCA_COMPONENTS = app.config.get('PCA_COMPONENTS', 10)
+HEATMAP_ORDER_CACHE = result_cache.ResultCache(
+    'heatmap_orders',
+    app.config.get('HEATMAP_ORDER_CACHE_BYTES', 16 * 1024 * 1024))
+HEATMAP_MAX_GENES = app.config.get('HEATMAP_MAX_GENES', 5000)
+GENE_SET_MAX_SETS = app.config.get('GENE_SET_MAX_SETS', 1000)
+SCATTER_DENSITY_BINS = app.config.get('SCATTER_DENSITY_BINS', 40)
+SCATTER_DENSITY_MAX_BINS = app.config.get('SCATTER_DENSITY_MAX_BINS', 200)
+APPROX_CANDIDATES = app.config.get('APPROX_CANDIDATES', 2000)
+CORRELATION_PERMUTATIONS = app.config.get('CORRELATION_PERMUTATIONS', 1000)
+CORRELATION_MAX_PERMUTATIONS = app.config.get('CORRELATION_MAX_PERMUTATIONS', 10000)
+CORRELATION_PERMUTATION_SEED = app.config.get('CORRELATION_PERMUTATION_SEED', 0)
+
+# expression correlation searches are scattered to these shard workers when any are configured
+CORRELATION_SHARDS = None
+if app.config.get('CORRELATION_WORKERS'):
+    CORRELATION_SHARDS = correlation_workers.ShardedCorrelation(
+        app.config['CORRELATION_WORKERS'],
+        app.config['CORRELATION_WORKER_AUTHKEY'],
+        app.config.get('CORRELATION_WORKER_TIMEOUT', 30.0))
+
+JOBS = jobs.JobManager(
+    app.config.get('JOB_MAX_WORKERS', 2),
+    app.config.get('JOB_MAX_QUEUED', 100),
+    app.config.get('JOB_RESULT_TTL', 600))
+
+ADMISSION = admission.AdmissionController(app.config.get('ADMISSION_LIMITS', {}))
+
+MEMORY_TRACER = memory_usage.AllocationTracer(app.config.get('MEMORY_TRACING_FRAMES', 1))
+if app.config.get('MEMORY_TRACING') and not MEMORY_TRACER.start():
+    app.logger.warning('MEMORY_TRACING needs tracemalloc (python 3.4 or later) so allocations are not traced')
+
+
+@app.before_request
+def _admit_request():
+    """
+    Run or reject the request according to the limits of its route's admission group (see admission.py)
+    """
+    limiter = ADMISSION.limiter(request.endpoint)
+    if limiter is None:
+        return None
+
+    if not limiter.acquire(request.endpoint):
+        response = jsonify(error='the server is busy, please try again later')
+        response.status_code = 503
+        response.headers['Retry-After'] = str(limiter.retry_after)
+        return response
+
+    g.admission_limiter = limiter
+    return None
+
+
+@app.before_request
+def _trace_request():
+    # registered after _admit_request so that rejected requests aren't traced
+    g.memory_trace = MEMORY_TRACER.begin()
+
+
+@app.teardown_request
+def _release_request(exception=None):
+    # for streamed responses this runs once the stream is finished. g.pop needs Flask 0.11 so the attribute is
+    # deleted by hand to make sure the limiter is only released once
+    limiter = getattr(g, 'admission_limiter', None)
+    if limiter is not None:
+        del g.admission_limiter
+        limiter.release(request.endpoint)
+
+
+@app.teardown_request
+def _end_request_trace(exception=None):
+    token = getattr(g, 'memory_trace', None)
+    if token is not None:
+        del g.memory_trace
+    MEMORY_TRACER.end(request.endpoint, token)
+
+
+@app.errorhandler(sample_index.SubsetError)
+def _subset_error(e):
+    # every route that takes a "subset" argument evaluates it with SampleIndex.select
+    return jsonify(error=str(e)), 400
+
 
 def _decode_uri_slashes(uriCompStr):
     """
@@ -46,6 +160,77 @@ def _decode_uri_slashes(uriCompStr):
     """
     return uriCompStr.replace('\\f', '/').replace('\\b', '\\')
 
+
+def _sample_columns(sample_index, sample_mask):
+    """
+    Build the per-mouse columns that are shared by the expression and phenotype responses
+    :param sample_index:    the SampleIndex
+    :param sample_mask:     a boolean mask of the samples to include
+    :return:                a dict of 'mouse_ids', 'sexes', 'strains', 'diets' and one list per factor
+    """
+    mouse_ids = [mouse_id for mouse_id, selected in zip(sample_index.mouse_ids, sample_mask) if selected]
+    columns = {
+        'mouse_ids': mouse_ids,
+        'sexes': ['M'] * len(mouse_ids),
+        'strains': [strain for strain, selected in zip(sample_index.strains, sample_mask) if selected],
+        'diets': [diet for diet, selected in zip(sample_index.diets, sample_mask) if selected],
+    }
+    for factor_id in sample_index.factor_ids:
+        columns[factor_id] = sample_index.factor_values(factor_id, sample_mask)
+
+    return columns
+
+
+def _compact_json_response(data):
+    """
+    Serialize data as JSON without any of the whitespace that jsonify adds when pretty printing
+    :param data:    the data to serialize
+    :return:        the response
+    """
+    return Response(flask_json.dumps(data, separators=(',', ':')), mimetype='application/json')
+
+
+def _stream_json_list(key, items):
+    """
+    Stream a JSON object with a single key whose value is a list, one item at a time. This produces the same
+    document as jsonify({key: items}) (or {key: None} if there are no items) without holding the whole
+    response in memory.
+    :param key:     the key for the list
+    :param items:   an iterable of items that can be serialized as JSON
+    :return:        a generator of response chunks
+    """
+    items = iter(items)
+    try:
+        first_item = next(items)
+    except StopIteration:
+        yield flask_json.dumps({key: None})
+        return
+
+    yield '{{{0}: [\n{1}'.format(flask_json.dumps(key), flask_json.dumps(first_item))
+    for item in items:
+        yield ',\n' + flask_json.dumps(item)
+    yield '\n]}\n'
+
+
+def _stream_ndjson(items):
+    """
+    Stream items as newline delimited JSON
+    :param items:   an iterable of items that can be serialized as JSON
+    :return:        a generator of response chunks
+    """
+    for item in items:
+        yield flask_json.dumps(item) + '\n'
+
+
+def _stream_sse(items):
+    """
+    Stream items as server-sent events (one JSON message event per item)
+    :param items:   an iterable of items that can be serialized as JSON
+    :return:        a generator of response chunks
+    """
+    for item in items:
+        yield 'data: {}\n\n'.format(flask_json.dumps(item, separators=(',', ':')))
+
 @app.route("/phenotypes/")
 def phenotypes():
     """
@@ -58,9 +243,49 @@ def phenotypes():
 @app.route("/expression/")
 def expressions():
     """
-    Return all the expression kinds.
+    Return all the expression kinds from the catalog that the importer maintains (see catalog.py).
+    :return: a jsonified dict with the following attributes:
+
+    * version: the dataset version that the catalog is for
+    * sample_count: the number of samples
+    * gene_count: the number of genes
+    * factor_ids: the design factors
+    * phenotype_ids: the phenotypes
+    * ids: the expression IDs ordered by ID
+    * value_counts: the number of samples with a (non-missing) value for each expression ID
     """
-    pass
+    summary = mongodb_utils.get_catalog()
+    if summary is None:
+        return jsonify(error='the dataset has no catalog. Run "python src/catalog.py --rebuild" to build it'), 404
+
+    genes = mongodb_utils.get_catalog_genes()
+    summary['ids'] = [gene_id for gene_id, _ in genes]
+    summary['value_counts'] = [value_count for _, value_count in genes]
+
+    return _compact_json_response(summary)
+
+
+@app.route("/samples/")
+def samples():
+    """
+    Return the dictionary-encoded sample table. This only changes when the dataset changes so clients should
+    fetch it once and then request expression values with /expression/<expr_id>?slim=1. The response carries
+    the sample order version as its ETag.
+
+    :return: a JSON dict with the following keys:
+
+    * sample_order_version: identifies the sample order and contents of this table
+    * mouse_ids: array of mouse IDs in sample order
+    * strains: the mouse strains encoded as a dict of 'levels' and 'codes' (one index into levels per mouse)
+    * diets: the mouse diets encoded like strains
+    * factors: a dict keyed by factor ID of factor columns encoded like strains (a code of -1 means missing)
+    """
+    sample_index = dataset.get_sample_index()
+
+    response = Response(sample_index.sample_table_json(), mimetype='application/json')
+    response.set_etag(sample_index.sample_order_version)
+
+    return response.make_conditional(request)
 
 
 @app.route("/mouse/<mouse_id>")
@@ -82,14 +307,30 @@ def mouse(mouse_id):
 
 @app.route("/mice/", methods=['POST'])
 def mice():
-    json = request.get_json()
-
-    mice = mongodb_utils.find_mice(json)
-
-    if not mice:
-        return jsonify({"mice": None})
-
-    return jsonify({'mice': mice})
+    """
+    Find mice using the JSON filter given in the request body. The response is streamed from the database cursor
+    so memory use does not depend on the number of mice matched. The following query string arguments are
+    supported:
+
+    * fields: a comma-separated list of fields to return (eg. "mouse_id,factors,expression_data.ENSMUSG00000019966").
+              Only the mouse metadata and factors are returned by default
+    * limit: the maximum number of mice to return
+    * format: "json" (the default) for a {"mice": [...]} document or "ndjson" for one mouse per line
+    """
+    mouse_filter = request.get_json()
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+    limit = request.args.get('limit', 0, type=int)
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'ndjson'):
+        return jsonify(error='"{}" format is not supported'.format(output_format)), 400
+
+    mice = mongodb_utils.find_mice(mouse_filter, fields, limit)
+
+    if output_format == 'json':
+        return Response(stream_with_context(_stream_json_list('mice', mice)), mimetype='application/json')
+    else:
+        return Response(stream_with_context(_stream_ndjson(mice)), mimetype='application/x-ndjson')
 
 
 @app.route("/phenotype/<pheno_id>")
@@ -107,62 +348,30 @@ def phenotype(pheno_id):
     * type: a string describing the phenotype values as one of: "number", "factor" or "identifier"
     * values: array indexed by individual mouse containing phenotype values. The type of data is determined by
               the "type" attribute
+    * one array per factor indexed by individual mouse containing the factor level of the mouse
+
+    The optional "subset" query string argument restricts the mice to a subset (see sample_index.py)
     """
     pheno_id = _decode_uri_slashes(pheno_id)
 
-    mouse_ids = []
-    sexes = []
-    strains = []
-    diets = []
-    values = []
-
-    # retrieve all mice, also return the phenotype value specified
-
-    data = mongodb_utils.get_phenotype_data(pheno_id)
-    phenotype = mongodb_utils.get_phenotype(pheno_id)
+    sample_index = dataset.get_sample_index()
+    sample_mask = sample_index.select(request.args.get('subset'))
+    column = phenotype_cache.get_column(pheno_id)
 
     # TODO: Need a better way of determining the type, maybe store in mongo
-    types = phenotype['type']
-
-    if types in ['FLOAT', 'INT']:
+    if column.is_numeric:
         types = 'number'
     else:
         types = 'identifier'
 
-    elems = pheno_id.split('.')
-    sub_key = elems[0]
-    if elems > 1:
-        key_id = elems[1]
+    pheno_dict = _sample_columns(sample_index, sample_mask)
+    selected_mice = set(pheno_dict['mouse_ids'])
+    pheno_dict['type'] = types
+    pheno_dict['values'] = [
+        value for mouse_id, value in zip(column.mouse_ids, column.json_values()) if mouse_id in selected_mice
+    ]
 
-    if data:
-        for d in data:
-            mouse_id = d.get('mouse_id', '')
-            sex = 'M'
-            strain = d.get('group', '')
-            diet = d.get('diet_desc', '')
-            try:
-                value = ''
-                if key_id:
-                    value = d[sub_key][key_id]
-                else:
-                    value = d[sub_key]
-            except KeyError:
-                pass
-
-            mouse_ids.append(mouse_id)
-            sexes.append(sex)
-            strains.append(strain)
-            diets.append(diet)
-            values.append(value)
-
-    return jsonify({
-        'mouse_ids': mouse_ids,
-        'sexes': sexes,
-        'strains': strains,
-        'diets': diets,
-        'type': types,
-        'values': values,
-    })
+    return jsonify(pheno_dict)
 
 
 @app.route("/search/phenotype/<pheno_search_text>/<int:start_index>/<int:max_count>")
@@ -226,51 +435,41 @@ def expression(expr_id):
     * diet: array indexed by individual mouse. Contains the IDs for the mouse diet
     * type: a string describing the phenotype values as one of: "number", "factor" or "identifier"
     * values: array indexed by individual mouse containing expression values. Expression data is a numeric type
-    """
-    expr_id = _decode_uri_slashes(expr_id)
+    * one array per factor indexed by individual mouse containing the factor level of the mouse
 
-    expr_dict = {
-        'mouse_ids': [],
-        'sexes': [],
-        'strains': [],
-        'diets': [],
-        'values': [],
-    }
+    The optional "subset" query string argument restricts the mice to a subset (see sample_index.py), for
+    example ?subset=tissue=hypothalamus;time=6hrs|9hrs
 
-    # retrieve all mice, also return the phenotype value specified
+    If the "slim" query string argument is set only the following keys are returned. The per-mouse columns
+    come from the /samples/ table instead.
 
-    data = mongodb_utils.get_expression_data(expr_id)
+    * sample_order_version: the version of the /samples/ table that the values are aligned with
+    * values: array of expression values in sample table order (null for missing values)
+    * sample_indexes: only present if a subset was requested. The sample table index of each value
+    """
+    expr_id = _decode_uri_slashes(expr_id)
 
-    if data:
-        all_factor_keys = set()
-        for d in data:
-            all_factor_keys |= set(d['factors'].keys())
-
-        for fact_key in all_factor_keys:
-            expr_dict[fact_key] = []
-
-        for d in data:
-            mouse_id = d.get('mouse_id', '')
-            sex = 'M'
-            strain = d.get('group', '')
-            diet = d.get('diet_desc', '')
-            value = ''
-            try:
-                value = d['expression_data'][expr_id]
-            except KeyError:
-                pass
-
-            expr_dict['mouse_ids'].append(mouse_id)
-            expr_dict['sexes'].append(sex)
-            expr_dict['strains'].append(strain)
-            expr_dict['diets'].append(diet)
-            expr_dict['values'].append(value)
-
-            for fact_key in all_factor_keys:
-                try:
-                    expr_dict[fact_key].append(d['factors'][fact_key])
-                except KeyError:
-                    expr_dict[fact_key].append('')
+    sample_index = dataset.get_sample_index()
+    subset = request.args.get('subset')
+    sample_mask = sample_index.select(subset)
+    values = dataset.get_expression_matrix().row(expr_id)
+
+    if request.args.get('slim'):
+        slim_dict = {'sample_order_version': sample_index.sample_order_version}
+        if values is None:
+            slim_dict['values'] = [None] * int(sample_mask.sum())
+        else:
+            slim_dict['values'] = [None if np.isnan(value) else value for value in values[sample_mask].tolist()]
+        if subset:
+            slim_dict['sample_indexes'] = np.flatnonzero(sample_mask).tolist()
+
+        return _compact_json_response(slim_dict)
+
+    expr_dict = _sample_columns(sample_index, sample_mask)
+    if values is None:
+        expr_dict['values'] = [''] * len(expr_dict['mouse_ids'])
+    else:
+        expr_dict['values'] = ['' if np.isnan(value) else value for value in values[sample_mask].tolist()]
 
     return jsonify(expr_dict)
 
@@ -325,7 +524,7 @@ def expression_search(expr_search_text, start_index, max_count):
 def correlation_search(corr_kind, search_id_kind, search_id, result_id_kind, result_count):
     """
     Searches for most highly correlated values for the given ID
-    :param corr_kind: the kind of correlation that should be calculated. One of: "pearson", "spearman", or "biweight"
+    :param corr_kind: the kind of correlation that should be calculated. One of: "pearson" or "spearman"
     :param search_id_kind: "expression" or "phenotype"
     :param search_id: the expression or phenotype ID to find correlation for
     :param result_id_kind: "expression" or "phenotype"
@@ -336,23 +535,909 @@ def correlation_search(corr_kind, search_id_kind, search_id, result_id_kind, res
     * names: a list of human-readable names for expression genes matching the search. This list length is >= max_count
     * correlations: an array for correlation values
     * total_count: the total number of expression or phenotype results
+
+    The optional "subset" query string argument restricts the correlation to a subset of the mice (see
+    sample_index.py)
+
+    The optional "mode" query string argument can be "approx" to find the approximate top results for
+    expression IDs over all samples by only calculating exact correlations for a shortlist of candidates picked
+    using random projection sketches (see correlation_sketch.py). The optional "candidates" argument sets the
+    shortlist size (APPROX_CANDIDATES by default). Larger shortlists are slower but have better recall. Only
+    Pearson searches can be approximate: other kinds of correlation, searches for phenotype IDs and searches over
+    a subset of samples are always exact. Every response (and streamed update) has a "mode" attribute of "approx"
+    or "exact" giving the mode that was actually used
+
+    The optional "format" query string argument can be "ndjson" or "sse" (server-sent events) to stream the
+    running top result_count as the genes are scored a block at a time. Every streamed update has the attributes
+    above plus "final". Provisional updates (final=false) also have "rows_scored" and "total_rows". The last
+    update is always the exact result with final=true
+
+    The optional "significance" query string argument (1 to enable) adds empirical p-values from shuffling the
+    samples of the search vector and Benjamini-Hochberg q-values over all candidates (see
+    correlation_significance.py) as the "p_values" and "q_values" arrays along with the number of "permutations".
+    The "permutations" and "seed" arguments set the number of permutations (CORRELATION_PERMUTATIONS by default,
+    at most CORRELATION_MAX_PERMUTATIONS) and the random seed (CORRELATION_PERMUTATION_SEED by default).
+    Significance needs every candidate to be scored so it turns approximate searches into exact ones, and it is
+    only available with the json format
     """
     search_id = _decode_uri_slashes(search_id)
-    corr_func = None
-    if corr_kind == "pearson":
-        corr_func = lambda x, y: pearsonr(x, y)[0]
-    elif corr_kind == "spearman":
-        corr_func = lambda x, y: spearmanr(x, y)[0]
+    if corr_kind not in correlation.CORRELATION_KINDS:
+        return jsonify(error='"{}" corr_kind is not supported'.format(corr_kind)), 400
+    for id_kind in (search_id_kind, result_id_kind):
+        if id_kind not in correlation.ID_KINDS:
+            return jsonify(error='"{}" ID kind is not supported'.format(id_kind)), 400
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'ndjson', 'sse'):
+        return jsonify(error='"{}" format is not supported'.format(output_format)), 400
+
+    subset = request.args.get('subset') or ''
+    # the subset is checked up front so that a bad one is reported before any results are streamed
+    sample_mask = dataset.get_sample_index().select(subset)
+    significance = request.args.get('significance', '').lower() in ('1', 'true')
+    approximate = request.args.get('mode', 'exact') == 'approx' and result_id_kind == 'expression' and not subset
+    # the sketches approximate Pearson correlations so they can't shortlist the top results of the other kinds
+    approximate = approximate and corr_kind in correlation_sketch.APPROX_CORR_KINDS and not significance
+    candidate_count = request.args.get('candidates', APPROX_CANDIDATES, type=int) if approximate else None
+
+    # we always cache at least the top CORRELATION_CACHE_TOP_K results so that requests for fewer results can
+    # be answered by slicing. Approximate searches shortlist candidates for just the results requested
+    top_k = result_count if approximate else max(result_count, CORRELATION_CACHE_TOP_K)
+    version = dataset.get_dataset_version()
+    cache_key = (corr_kind, search_id_kind, search_id, result_id_kind, subset, version, top_k, candidate_count)
+
+    def sliced_result(corr_search_result):
+        result = correlation.slice_result(corr_search_result, result_count)
+        result['mode'] = 'approx' if approximate else 'exact'
+        return result
+
+    def compute():
+        search = correlation.prepare_search(
+            corr_kind,
+            search_id_kind,
+            search_id,
+            result_id_kind,
+            dataset.get_expression_matrix(),
+            sample_mask)
+
+        if approximate:
+            return correlation_sketch.approximate_top(
+                search, dataset.get_expression_matrix(), dataset.get_correlation_sketch(), top_k, candidate_count)
+
+        if CORRELATION_SHARDS is not None and result_id_kind == 'expression':
+            # the workers may not have loaded the new dataset version yet or may be unavailable, in which case we
+            # scan locally
+            try:
+                result = CORRELATION_SHARDS.top(search, top_k, version)
+            except correlation_workers.WorkerError as e:
+                app.logger.warning('scanning locally: %s', e)
+                result = None
+            if result is not None:
+                return result
+
+        return search.top(top_k)
+
+    if significance:
+        if output_format != 'json':
+            return jsonify(error='significance is only available with the json format'), 400
+
+        permutations = request.args.get('permutations', CORRELATION_PERMUTATIONS, type=int)
+        seed = request.args.get('seed', CORRELATION_PERMUTATION_SEED, type=int)
+        if not 0 < permutations <= CORRELATION_MAX_PERMUTATIONS:
+            return jsonify(error='permutations must be between 1 and {}'.format(CORRELATION_MAX_PERMUTATIONS)), 400
+
+        def compute_significance():
+            search = correlation.prepare_search(
+                corr_kind,
+                search_id_kind,
+                search_id,
+                result_id_kind,
+                dataset.get_expression_matrix(),
+                sample_mask)
+            return correlation_significance.add_significance(
+                search, CORRELATION_CACHE.get_or_compute(cache_key, compute), permutations, seed)
+
+        corr_search_result = CORRELATION_CACHE.get_or_compute(cache_key + (permutations, seed), compute_significance)
+        return jsonify(sliced_result(corr_search_result))
+
+    if output_format == 'json':
+        corr_search_result = CORRELATION_CACHE.get_or_compute(cache_key, compute)
+        return jsonify(sliced_result(corr_search_result))
+
+    def iter_updates():
+        if approximate:
+            # approximate searches only score a shortlist so they are sent as a single final update
+            corr_search_result = CORRELATION_CACHE.get_or_compute(cache_key, compute)
+        else:
+            corr_search_result = CORRELATION_CACHE.get(cache_key)
+        if corr_search_result is None:
+            search = correlation.prepare_search(
+                corr_kind,
+                search_id_kind,
+                search_id,
+                result_id_kind,
+                dataset.get_expression_matrix(),
+                sample_mask)
+            for rows_scored, corr_search_result in search.iter_results(top_k):
+                if rows_scored < search.row_count:
+                    update = sliced_result(corr_search_result)
+                    update.update(final=False, rows_scored=rows_scored, total_rows=search.row_count)
+                    yield update
+            CORRELATION_CACHE.put(cache_key, corr_search_result)
+
+        update = sliced_result(corr_search_result)
+        update['final'] = True
+        yield update
+
+    if output_format == 'ndjson':
+        return Response(stream_with_context(_stream_ndjson(iter_updates())), mimetype='application/x-ndjson')
     else:
-        raise Exception('"{}" corr_kind is not supported'.format(corr_kind))
-    corr_search_result = mongodb_utils.correlation_search(
-        corr_func,
-        search_id_kind,
-        search_id,
-        result_id_kind,
-        result_count)
+        response = Response(stream_with_context(_stream_sse(iter_updates())), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+def _correlation_job_params(params):
+    """
+    Check and fill in the defaults of the parameters of a correlation job. These are the same as the arguments of
+    the /correlation/ route.
+    """
+    params = {
+        'corr_kind': params.get('corr_kind', 'pearson'),
+        'search_id_kind': params.get('search_id_kind'),
+        'search_id': params.get('search_id'),
+        'result_id_kind': params.get('result_id_kind'),
+        'result_count': int(params.get('result_count', 100)),
+        'subset': params.get('subset') or '',
+    }
+    if params['corr_kind'] not in correlation.CORRELATION_KINDS:
+        raise ValueError('"{}" corr_kind is not supported'.format(params['corr_kind']))
+    for id_kind in (params['search_id_kind'], params['result_id_kind']):
+        if id_kind not in correlation.ID_KINDS:
+            raise ValueError('"{}" ID kind is not supported'.format(id_kind))
+    if not params['search_id']:
+        raise ValueError('a search_id is required')
+    # raises a SubsetError (a ValueError) if the subset can't be evaluated
+    dataset.get_sample_index().select(params['subset'])
+
+    return params
+
+
+def _prepare_correlation_job(params):
+    search = correlation.prepare_search(
+        params['corr_kind'],
+        params['search_id_kind'],
+        params['search_id'],
+        params['result_id_kind'],
+        dataset.get_expression_matrix(),
+        dataset.get_sample_index().select(params['subset']))
+
+    return search, params['result_count']
+
+
+def _run_correlation_job(prepared, progress):
+    search, result_count = prepared
+    return search.top(result_count, progress)
+
+
+COEXPRESSION_PARAMS = {
+    'min_correlation': app.config.get('COEXPRESSION_MIN_CORRELATION', 0.7),
+    'neighbours': app.config.get('COEXPRESSION_NEIGHBOURS', 10),
+    'min_module_size': app.config.get('COEXPRESSION_MIN_MODULE_SIZE', 20),
+}
+
+
+def _prepare_coexpression_job(params):
+    return dataset.get_expression_matrix(), params
+
+
+def _run_coexpression_job(prepared, progress):
+    expr_matrix, params = prepared
+    return coexpression.find_modules(
+        expr_matrix,
+        threads=app.config.get('COEXPRESSION_THREADS', 4),
+        scratch_dir=app.config.get('COEXPRESSION_SCRATCH_DIR'),
+        progress=progress,
+        **params)
+
+
+JOB_PARAMS = {
+    'correlation': _correlation_job_params,
+}
+JOBS.register('correlation', _prepare_correlation_job, _run_correlation_job)
+JOBS.register('coexpression', _prepare_coexpression_job, _run_coexpression_job)
+
+
+def _get_coexpression_modules():
+    """
+    Get the co-expression modules for the current dataset version, submitting a job to find them if needed.
+
+    :return: a (modules, job) tuple. modules is None until the job is done
+    """
+    version = dataset.get_dataset_version()
+    modules = coexpression.get_modules(version, COEXPRESSION_PARAMS)
+    if modules is not None:
+        return modules, None
+
+    job = JOBS.submit('coexpression', COEXPRESSION_PARAMS, version)
+    if job.status == jobs.DONE:
+        coexpression.put_modules(version, job.result)
+        return job.result, None
+    elif job.status == jobs.FAILED:
+        raise Exception('finding co-expression modules failed: {}'.format(job.error))
+
+    return None, job
+
+
+def _pending_job_response(job):
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.route('/modules/')
+def coexpression_modules():
+    """
+    List the gene co-expression modules (see coexpression.py). The modules are found by a background job the
+    first time they are requested for a dataset version. Until the job is done this returns a 202 response with
+    the job's state (see job_status).
+
+    :return: a jsonified dict with the following attributes:
+
+    * modules: an array of dicts with the "id", "size" and "variance_explained" (by its eigengene) of every module
+      ordered by decreasing size
+    * unassigned_count: the number of genes that aren't in any module (module 0)
+    * params: the parameters that the modules were found with
+    """
+    modules, job = _get_coexpression_modules()
+    if modules is None:
+        return _pending_job_response(job)
+
+    sizes = np.bincount(modules.module_ids, minlength=modules.module_count + 1)
+    return jsonify({
+        'modules': [
+            {
+                'id': module_id,
+                'size': int(sizes[module_id]),
+                'variance_explained': float(modules.variance_explained[module_id - 1]),
+            }
+            for module_id in range(1, modules.module_count + 1)
+        ],
+        'unassigned_count': int(sizes[0]),
+        'params': modules.params,
+    })
 
-    return jsonify(corr_search_result)
+
+@app.route('/modules/<int:module_id>')
+def coexpression_module(module_id):
+    """
+    :param module_id: the module ID (0 for the genes that aren't in a module)
+    :return: a jsonified dict with the module's "id" and its members ordered by decreasing module membership:
+
+    * ids: the expression IDs of the module's genes
+    * names: the gene symbols
+    * kme: each gene's correlation with the module's eigengene (null for unassigned genes)
+    """
+    modules, job = _get_coexpression_modules()
+    if modules is None:
+        return _pending_job_response(job)
+    if not 0 <= module_id <= modules.module_count:
+        abort(404)
+
+    expr_matrix = dataset.get_expression_matrix()
+    members = modules.members(module_id)
+    return jsonify({
+        'id': module_id,
+        'ids': [expr_matrix.gene_ids[i] for i in members],
+        'names': [expr_matrix.gene_symbols[i] for i in members],
+        'kme': [None if np.isnan(kme) else kme for kme in modules.kme[members].tolist()],
+    })
+
+
+@app.route('/modules/<int:module_id>/eigengene')
+def coexpression_module_eigengene(module_id):
+    """
+    :param module_id: the module ID
+    :return: the module's eigengene (standardized to unit variance) in the same format as /expression/<id>
+             (including the "subset" and "slim" query string arguments)
+    """
+    modules, job = _get_coexpression_modules()
+    if modules is None:
+        return _pending_job_response(job)
+    if not 1 <= module_id <= modules.module_count:
+        abort(404)
+
+    sample_index = dataset.get_sample_index()
+    subset = request.args.get('subset')
+    sample_mask = sample_index.select(subset)
+    values = np.asarray(modules.eigengenes[module_id - 1])[sample_mask].tolist()
+
+    if request.args.get('slim'):
+        slim_dict = {'sample_order_version': sample_index.sample_order_version, 'values': values}
+        if subset:
+            slim_dict['sample_indexes'] = np.flatnonzero(sample_mask).tolist()
+        return _compact_json_response(slim_dict)
+
+    eigengene_dict = _sample_columns(sample_index, sample_mask)
+    eigengene_dict['values'] = values
+    return jsonify(eigengene_dict)
+
+
+@app.route('/jobs/', methods=['POST'])
+def submit_job():
+    """
+    Submit a long running analysis to the job queue. The request body is a JSON object with the job "kind" and
+    its "params". For example a whole genome correlation:
+
+        {"kind": "correlation", "params": {"corr_kind": "pearson", "search_id_kind": "expression",
+         "search_id": "ENSMUSG00000019966", "result_id_kind": "expression", "result_count": 20000}}
+
+    Submitting the same job twice (for the same dataset version) returns the job that was already submitted.
+
+    :return: a 202 response with the job state (see job_status). If the queue is full a 503 response is returned
+    """
+    job_request = request.get_json() or {}
+    kind = job_request.get('kind')
+    if kind not in JOB_PARAMS:
+        return jsonify(error='"{}" is not a known job kind'.format(kind)), 400
+
+    try:
+        params = JOB_PARAMS[kind](job_request.get('params') or {})
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    try:
+        job = JOBS.submit(kind, params, dataset.get_dataset_version())
+    except jobs.JobQueueFull as e:
+        response = jsonify(error=str(e))
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    :return: the job's id, kind, params, status ("queued", "starting", "running", "done", "failed" or "cancelled"),
+             progress (a fraction from 0 to 1), submitted, started and finished times, run_time in seconds and the
+             error if it failed. Jobs are forgotten JOB_RESULT_TTL seconds after they finish
+    """
+    job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """
+    :return: the result of a finished job. This is a 409 response if the job hasn't finished successfully
+    """
+    job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != jobs.DONE:
+        return jsonify(job.to_dict()), 409
+
+    return jsonify(job.result)
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    Cancel a queued or running job
+    """
+    job = JOBS.cancel(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    """
+    Return the job queue depth, job counts and run times
+    """
+    return jsonify(JOBS.stats())
+
+
+@app.route('/pca/')
+def sample_pca_overview():
+    """
+    Get a principal component analysis of the samples (with the genes as variables) for a quality control
+    overview: do replicates group together, is there a batch effect? See sample_pca.py
+    :return: a jsonified dict with the following attributes:
+
+    * sample_order_version: the version of the /samples/ table that the samples are from
+    * mouse_ids: the mouse IDs of the samples
+    * sample_indexes: only present if a subset was requested. The sample table index of each sample
+    * coordinates: one array per component of the samples' coordinates
+    * variance_explained: the fraction of the total variance explained by each component
+    * top_genes: one dict per component of the 'ids', 'names' and 'loadings' of the genes with the largest
+      absolute loadings
+    * factors: a dict keyed by factor ID of the samples' levels ('values') along with the factor's
+      'level_order', 'level_styles' and 'level_shapes' from WEB_APP_CONF (where configured)
+    * log: true if the values were log2(x + 1) transformed
+
+    The optional query string arguments are "components" (the number of components, PCA_COMPONENTS by default),
+    "log" (1 to log2(x + 1) transform the values first), "top_genes" (the number of top-loading genes per
+    component, 20 by default) and "subset" (which restricts the samples, see sample_index.py)
+    """
+    subset = request.args.get('subset') or ''
+    components = request.args.get('components', PCA_COMPONENTS, type=int)
+    log = request.args.get('log', '').lower() in ('1', 'true')
+    top_gene_count = request.args.get('top_genes', 20, type=int)
+    cache_key = (dataset.get_dataset_version(), subset, log, components, top_gene_count)
+
+    def compute():
+        expr_matrix = dataset.get_expression_matrix()
+        sample_index = dataset.get_sample_index()
+        sample_mask = sample_index.select(subset)
+        coordinates, loadings, variance_explained = sample_pca.randomized_pca(
+            expr_matrix, sample_mask, components, log)
+
+        factors = {}
+        factor_confs = config.WEB_APP_CONF.get('factors', {})
+        for factor_id in sample_index.factor_ids:
+            factor = {'values': sample_index.factor_values(factor_id, sample_mask)}
+            for key in ('level_order', 'level_styles', 'level_shapes'):
+                if key in factor_confs.get(factor_id, {}):
+                    factor[key] = factor_confs[factor_id][key]
+            factors[factor_id] = factor
+
+        pca_dict = {
+            'sample_order_version': sample_index.sample_order_version,
+            'mouse_ids': [mouse_id for mouse_id, selected in zip(sample_index.mouse_ids, sample_mask) if selected],
+            'coordinates': coordinates.T.tolist(),
+            'variance_explained': variance_explained.tolist(),
+            'top_genes': sample_pca.top_loading_genes(expr_matrix, loadings, top_gene_count),
+            'factors': factors,
+            'log': log,
+        }
+        if subset:
+            pca_dict['sample_indexes'] = np.flatnonzero(sample_mask).tolist()
+
+        return pca_dict
+
+    return _compact_json_response(PCA_CACHE.get_or_compute(cache_key, compute))
+
+
+def _region_genes(chrom, start, end):
+    """
+    :return: the (expression matrix row indexes, interval index positions) of the genes in the expression matrix
+             that overlap the region ordered by start position
+    """
+    expr_matrix = dataset.get_expression_matrix()
+    intervals = dataset.get_gene_intervals()
+    rows = []
+    positions = []
+    for i in intervals.overlapping(chrom, start, end):
+        row = expr_matrix.gene_index(intervals.gene_ids[i])
+        if row is not None:
+            rows.append(row)
+            positions.append(i)
+
+    return np.array(rows, dtype=np.int64), np.array(positions, dtype=np.int64)
+
+
+@app.route('/region/<chrom>/<int:start>/<int:end>/genes')
+def region_genes(chrom, start, end):
+    """
+    Find the genes that overlap a genomic region
+    :param chrom: the chromosome (with or without a "chr" prefix)
+    :param start: the first base pair of the region
+    :param end: the last base pair of the region
+    :return: a jsonified dict with the following attributes (ordered by gene start position):
+
+    * ids: the expression IDs of the genes
+    * names: the gene symbols
+    * starts: the start position of each gene
+    * ends: the end position of each gene
+    """
+    expr_matrix = dataset.get_expression_matrix()
+    intervals = dataset.get_gene_intervals()
+    rows, positions = _region_genes(chrom, start, end)
+
+    return jsonify({
+        'ids': [expr_matrix.gene_ids[row] for row in rows],
+        'names': [expr_matrix.gene_symbols[row] for row in rows],
+        'starts': intervals.starts[positions].tolist(),
+        'ends': intervals.ends[positions].tolist(),
+    })
+
+
+@app.route('/region/<chrom>/<int:start>/<int:end>/expression')
+def region_expression(chrom, start, end):
+    """
+    Get the expression matrix of the genes that overlap a genomic region
+    :param chrom: the chromosome (with or without a "chr" prefix)
+    :param start: the first base pair of the region
+    :param end: the last base pair of the region
+    :return: a jsonified dict with the following attributes:
+
+    * sample_order_version: the version of the /samples/ table that the values are aligned with
+    * ids: the expression IDs of the genes ordered by start position
+    * names: the gene symbols
+    * values: one array per gene of expression values in sample table order (null for missing values)
+    * sample_indexes: only present if a subset was requested. The sample table index of each value
+
+    The optional "subset" query string argument restricts the samples (see sample_index.py)
+    """
+    expr_matrix = dataset.get_expression_matrix()
+    sample_index = dataset.get_sample_index()
+    subset = request.args.get('subset')
+    sample_mask = sample_index.select(subset)
+    rows, _ = _region_genes(chrom, start, end)
+    values = expr_matrix.rows(rows)[:, sample_mask]
+
+    region_dict = {
+        'sample_order_version': sample_index.sample_order_version,
+        'ids': [expr_matrix.gene_ids[row] for row in rows],
+        'names': [expr_matrix.gene_symbols[row] for row in rows],
+        'values': [[None if np.isnan(value) else value for value in gene_values] for gene_values in values.tolist()],
+    }
+    if subset:
+        region_dict['sample_indexes'] = np.flatnonzero(sample_mask).tolist()
+
+    return _compact_json_response(region_dict)
+
+
+@app.route('/nearby-correlation/<corr_kind>/<expr_id>')
+def nearby_correlation(corr_kind, expr_id):
+    """
+    Correlate a gene with the genes near it on the genome
+    :param corr_kind: the kind of correlation that should be calculated. One of: "pearson" or "spearman"
+    :param expr_id: the expression ID of the gene
+    :return: a jsonified dict with the following attributes (ordered by descending absolute correlation)
+
+    * ids: an array of the IDs of the nearby genes
+    * names: the gene symbols of the nearby genes
+    * correlations: an array of correlation values
+    * distances: the number of base pairs between each nearby gene and the searched gene (0 if they overlap)
+    * total_count: the number of nearby genes
+
+    The optional "window" query string argument is the number of base pairs on either side of the gene to search
+    (NEARBY_WINDOW by default) and the optional "subset" argument restricts the samples (see sample_index.py)
+    """
+    expr_id = _decode_uri_slashes(expr_id)
+    if corr_kind not in correlation.CORRELATION_KINDS:
+        return jsonify(error='"{}" corr_kind is not supported'.format(corr_kind)), 400
+    window = request.args.get('window', NEARBY_WINDOW, type=int)
+    if window < 0:
+        return jsonify(error='window must not be negative'), 400
+
+    expr_matrix = dataset.get_expression_matrix()
+    intervals = dataset.get_gene_intervals()
+    location = intervals.location(expr_id)
+    search_values = expr_matrix.row(expr_id)
+    if location is None or search_values is None:
+        return jsonify({'ids': [], 'names': [], 'correlations': [], 'distances': [], 'total_count': 0})
+
+    chrom, gene_start, gene_end = location
+    rows, _ = _region_genes(chrom, gene_start - window, gene_end + window)
+    search = correlation.CorrelationSearch(
+        corr_kind,
+        search_values,
+        [expr_matrix.gene_ids[row] for row in rows],
+        [expr_matrix.gene_symbols[row] for row in rows],
+        correlation.ArrayRows(expr_matrix.rows(rows)),
+        dataset.get_sample_index().select(request.args.get('subset')),
+        exclude_id=expr_id)
+    result = search.top(len(rows))
+
+    distances = []
+    for gene_id in result['ids']:
+        _, start, end = intervals.location(gene_id)
+        distances.append(max(0, start - gene_end, gene_start - end))
+    result['distances'] = distances
+
+    return jsonify(result)
+
+
+def _tsv_response(chunks, filename):
+    if request.values.get('gzip'):
+        response = Response(stream_with_context(tsv_export.iter_gzip(chunks)), mimetype='application/gzip')
+        filename += '.gz'
+    else:
+        response = Response(stream_with_context(chunks), mimetype='text/tab-separated-values')
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+
+    return response
+
+
+@app.route('/export/expression.tsv', methods=['GET', 'POST'])
+def export_expression():
+    """
+    Stream an expression matrix as a tab-separated file in the format that importdesnp.py reads. The genes and
+    samples to export are given as query string arguments or (for long gene lists) as a JSON request body with
+    the same keys:
+
+    * genes: the gene IDs to export (comma-separated in the query string or a JSON list)
+    * region: a region like chr7:1000000-2000000 whose genes are exported (can be repeated in the query string or
+      a JSON list under "regions")
+    * subset: a sample subset filter (see sample_index.py)
+    * gzip: if set the file is gzip-compressed
+
+    All genes are exported if no genes or regions are given.
+    """
+    export_request = request.get_json(silent=True) or {}
+    gene_ids = export_request.get('genes')
+    if gene_ids is None:
+        gene_ids = [gene_id for gene_id in request.values.get('genes', '').split(',') if gene_id]
+    regions = export_request.get('regions')
+    if regions is None:
+        regions = request.values.getlist('region')
+    subset = export_request.get('subset', request.values.get('subset'))
+
+    try:
+        regions = [tsv_export.parse_region(region) for region in regions]
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    expr_matrix = dataset.get_expression_matrix()
+    intervals = dataset.get_gene_intervals()
+    gene_rows = tsv_export.select_gene_rows(expr_matrix, intervals, gene_ids, regions)
+    sample_mask = dataset.get_sample_index().select(subset)
+
+    return _tsv_response(
+        tsv_export.iter_expression_tsv(expr_matrix, intervals, gene_rows, sample_mask),
+        'expression.tsv')
+
+
+@app.route('/export/design.tsv')
+def export_design():
+    """
+    Stream the sample design as a tab-separated file in the format that importdesnp.py reads. Takes the same
+    "subset" and "gzip" query string arguments as /export/expression.tsv
+    """
+    sample_index = dataset.get_sample_index()
+    sample_mask = sample_index.select(request.args.get('subset'))
+
+    return _tsv_response(tsv_export.iter_design_tsv(sample_index, sample_mask), 'design.tsv')
+
+
+@app.route('/heatmap/', methods=['GET', 'POST'])
+def clustered_heatmap():
+    """
+    Get a clustered heatmap of a set of genes (for example the genes of a correlation result or of a region).
+    The genes and samples are given as query string arguments or (for long gene lists) as a JSON request body
+    with the same keys:
+
+    * genes: the gene IDs (comma-separated in the query string or a JSON list)
+    * region: a region like chr7:1000000-2000000 whose genes are included (can be repeated in the query string
+      or a JSON list under "regions")
+    * subset: a sample subset filter (see sample_index.py)
+    * encoding: "uint8" (the default) or "float32" (see heatmap.encode_matrix)
+    * cluster: 0 to keep the genes and samples in the order given rather than clustering them
+
+    At most HEATMAP_MAX_GENES genes can be requested.
+
+    :return: a jsonified dict with the following attributes:
+
+    * sample_order_version: the version of the /samples/ table that the samples are from
+    * ids: the expression IDs of the genes in heatmap row order
+    * names: the gene symbols
+    * sample_indexes: the sample table index of each heatmap column
+    * matrix: the encoded matrix of each gene's values scaled to z-scores over the samples (see
+      heatmap.encode_matrix), in row order
+    """
+    heatmap_request = request.get_json(silent=True) or {}
+    gene_ids = heatmap_request.get('genes')
+    if gene_ids is None:
+        gene_ids = [gene_id for gene_id in request.values.get('genes', '').split(',') if gene_id]
+    regions = heatmap_request.get('regions')
+    if regions is None:
+        regions = request.values.getlist('region')
+    subset = heatmap_request.get('subset', request.values.get('subset'))
+    encoding = heatmap_request.get('encoding', request.values.get('encoding', 'uint8'))
+    cluster = str(heatmap_request.get('cluster', request.values.get('cluster', '1'))).lower() not in ('0', 'false')
+
+    if encoding not in heatmap.ENCODINGS:
+        return jsonify(error='"{}" encoding is not supported'.format(encoding)), 400
+    try:
+        regions = [tsv_export.parse_region(region) for region in regions]
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if not gene_ids and not regions:
+        return jsonify(error='no genes or regions were given'), 400
+
+    expr_matrix = dataset.get_expression_matrix()
+    sample_index = dataset.get_sample_index()
+    gene_rows = tsv_export.select_gene_rows(expr_matrix, dataset.get_gene_intervals(), gene_ids, regions)
+    if len(gene_rows) > HEATMAP_MAX_GENES:
+        return jsonify(error='at most {} genes can be requested'.format(HEATMAP_MAX_GENES)), 400
+    sample_indexes = np.flatnonzero(sample_index.select(subset))
+
+    scaled = heatmap.scale_rows(expr_matrix.rows(gene_rows)[:, sample_indexes])
+    if cluster:
+        gene_order, sample_order = heatmap.cluster_orders(scaled, HEATMAP_ORDER_CACHE)
+        gene_rows = gene_rows[gene_order]
+        sample_indexes = sample_indexes[sample_order]
+        scaled = scaled[gene_order][:, sample_order]
+
+    return _compact_json_response({
+        'sample_order_version': sample_index.sample_order_version,
+        'ids': [expr_matrix.gene_ids[row] for row in gene_rows],
+        'names': [expr_matrix.gene_symbols[row] for row in gene_rows],
+        'sample_indexes': sample_indexes.tolist(),
+        'matrix': heatmap.encode_matrix(scaled, encoding),
+    })
+
+
+@app.route('/gene-sets/scores', methods=['GET', 'POST'])
+def gene_set_scores():
+    """
+    Score one or more gene sets (eg. pathways) in every sample (see gene_sets.py). A single set can be given as
+    query string arguments and any number of sets as a JSON request body:
+
+    * gene_sets: (JSON only) a list of {"name": ..., "genes": [...]} dicts
+    * genes: a single set's gene IDs (comma-separated in the query string or a JSON list)
+    * name: the single set's name
+    * score: "mean_z" (the default) or "rank"
+    * log: 1 to log2(x + 1) transform the values first
+    * subset: a sample subset filter (see sample_index.py)
+
+    At most GENE_SET_MAX_SETS sets can be scored at once.
+
+    :return: a jsonified dict with the same per-mouse columns as /expression/<expr_id> along with:
+
+    * score: the score that was calculated
+    * log: true if the values were log2(x + 1) transformed
+    * gene_sets: one dict per set of its 'name', 'gene_count' (the number of its genes that are in the dataset),
+      'missing_genes' (the IDs of the ones that aren't) and its score in each mouse ('values', empty for mice
+      that have no values for any of the set's genes)
+    * values: only present if a single set was scored. The set's 'values', so that the response can be plotted
+      just like the response of /expression/<expr_id>
+    """
+    score_request = request.get_json(silent=True) or {}
+    sets = score_request.get('gene_sets')
+    if sets is None:
+        gene_ids = score_request.get('genes')
+        if gene_ids is None:
+            gene_ids = [gene_id for gene_id in request.values.get('genes', '').split(',') if gene_id]
+        sets = [{'name': score_request.get('name', request.values.get('name', 'gene set')), 'genes': gene_ids}]
+    score = score_request.get('score', request.values.get('score', 'mean_z'))
+    log = str(score_request.get('log', request.values.get('log', ''))).lower() in ('1', 'true')
+    subset = score_request.get('subset', request.values.get('subset'))
+
+    if score not in gene_sets.SCORES:
+        return jsonify(error='"{}" is not a supported score'.format(score)), 400
+    if not sets or not all(gene_set.get('genes') for gene_set in sets):
+        return jsonify(error='every gene set needs at least one gene'), 400
+    if len(sets) > GENE_SET_MAX_SETS:
+        return jsonify(error='at most {} gene sets can be scored at once'.format(GENE_SET_MAX_SETS)), 400
+
+    sample_index = dataset.get_sample_index()
+    sample_mask = sample_index.select(subset)
+    scores, gene_counts, missing = gene_sets.score_gene_sets(
+        dataset.get_expression_matrix(), [gene_set['genes'] for gene_set in sets], sample_mask, log)
+
+    score_dict = _sample_columns(sample_index, sample_mask)
+    score_dict['score'] = score
+    score_dict['log'] = log
+    score_dict['gene_sets'] = [
+        {
+            'name': gene_set.get('name', ''),
+            'gene_count': int(gene_count),
+            'missing_genes': set_missing,
+            'values': ['' if np.isnan(value) else value for value in set_scores.tolist()],
+        }
+        for gene_set, gene_count, set_missing, set_scores in zip(sets, gene_counts, missing, scores[score])
+    ]
+    if len(sets) == 1:
+        score_dict['values'] = score_dict['gene_sets'][0]['values']
+
+    return _compact_json_response(score_dict)
+
+
+@app.route('/scatter-density/<x_expr_id>/<y_expr_id>')
+def scatter_density_bins(x_expr_id, y_expr_id):
+    """
+    Get the 2D density of a gene vs. gene scatter plot as bin counts (see scatter_density.py) so that plots of
+    many samples can be drawn without a shape per sample. The optional query string arguments are:
+
+    * shape: "hex" (the default) or "rect"
+    * bins: the number of bins across the X range (SCATTER_DENSITY_BINS by default, at most
+      SCATTER_DENSITY_MAX_BINS)
+    * factor: a factor ID. Points are counted separately for each level of the factor
+    * log: 1 to log2(x + 1) transform the values first
+    * subset: a sample subset filter (see sample_index.py)
+
+    :return: a jsonified dict with the following attributes:
+
+    * shape: the bin shape
+    * x_range and y_range: the [min, max] of the binned values (null if no sample has both values)
+    * bin_width and bin_height: the size of the bins in data units
+    * point_count: the number of samples that have both values
+    * factor: the factor ID or null
+    * levels: the factor levels in WEB_APP_CONF level_order (or sorted) order, or ["all"] without a factor
+    * groups: one dict per level with the 'level' and the 'x' and 'y' of the center of every bin that has points
+      along with the 'counts' of points in the bins
+    """
+    x_expr_id = _decode_uri_slashes(x_expr_id)
+    y_expr_id = _decode_uri_slashes(y_expr_id)
+    shape = request.args.get('shape', 'hex')
+    bins = request.args.get('bins', SCATTER_DENSITY_BINS, type=int)
+    factor_id = request.args.get('factor') or None
+    log = request.args.get('log', '').lower() in ('1', 'true')
+    subset = request.args.get('subset')
+
+    if shape not in scatter_density.SHAPES:
+        return jsonify(error='"{}" bins are not supported'.format(shape)), 400
+    if not 0 < bins <= SCATTER_DENSITY_MAX_BINS:
+        return jsonify(error='bins must be between 1 and {}'.format(SCATTER_DENSITY_MAX_BINS)), 400
+
+    expr_matrix = dataset.get_expression_matrix()
+    sample_index = dataset.get_sample_index()
+    if factor_id is not None and factor_id not in sample_index.factor_ids:
+        return jsonify(error='"{}" is not a factor'.format(factor_id)), 400
+    x_values = expr_matrix.row(x_expr_id)
+    y_values = expr_matrix.row(y_expr_id)
+    if x_values is None or y_values is None:
+        abort(404)
+
+    sample_mask = sample_index.select(subset)
+    x_values = x_values[sample_mask]
+    y_values = y_values[sample_mask]
+    if log:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_values = np.log2(x_values + 1.0)
+            y_values = np.log2(y_values + 1.0)
+        x_values[np.isinf(x_values)] = np.nan
+        y_values[np.isinf(y_values)] = np.nan
+
+    if factor_id is None:
+        levels = ['all']
+        groups = None
+    else:
+        sample_levels = sample_index.factor_values(factor_id, sample_mask)
+        level_order = config.WEB_APP_CONF.get('factors', {}).get(factor_id, {}).get('level_order', [])
+        levels = [level for level in level_order if level in set(sample_levels)]
+        levels += sorted(set(sample_levels) - set(levels))
+        level_indexes = {level: i for i, level in enumerate(levels)}
+        groups = np.array([level_indexes[level] for level in sample_levels], dtype=np.int64)
+
+    density_dict = scatter_density.density(x_values, y_values, groups, len(levels), shape, bins)
+    for level, group in zip(levels, density_dict['groups']):
+        group['level'] = level
+    density_dict['factor'] = factor_id
+    density_dict['levels'] = levels
+
+    return _compact_json_response(density_dict)
+
+
+@app.route('/admin/admission')
+def admin_admission():
+    """
+    Return the limits and the current in-flight and queued requests of every admission group
+    """
+    return jsonify(ADMISSION.stats())
+
+
+@app.route('/admin/memory')
+def admin_memory():
+    """
+    Return the resident memory of the process, the bytes held by each long-lived structure and (when
+    MEMORY_TRACING is on) the peak allocation of each route and the top allocation sites. The number of sites
+    can be set with the sites query parameter
+    """
+    site_count = request.args.get('sites', 20, type=int)
+    return jsonify(
+        resident=memory_usage.resident_memory(),
+        structures=memory_usage.structure_memory(),
+        tracing=MEMORY_TRACER.stats(site_count))
+
+
+@app.route('/admin/caches')
+def admin_caches():
+    """
+    Return the size and hit/miss statistics of the result caches
+    """
+    return jsonify(result_cache.all_stats())
 
 
 @app.route('/app-config.json')
@@ -366,4 +1451,6 @@ def index_html():
 
 
 if __name__ == "__main__":
+    if app.config.get('WARM_CACHES_ON_STARTUP'):
+        dataset.warm()
     app.run(host='0.0.0.0', port=app.config['PORT'], threaded=True)
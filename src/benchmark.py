@@ -0,0 +1,251 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks that run against the database configured in config.py using flask's test client, so no server needs
+to be running. Run with -h to see the available benchmarks.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+
+def _percentiles_ms(timings):
+    return tuple(1000.0 * np.percentile(timings, p) for p in (50, 90, 99))
+
+
+def _timed_get(client, url):
+    start = time.time()
+    response = client.get(url)
+    elapsed = time.time() - start
+    if response.status_code != 200:
+        raise Exception('GET {} failed with status {}'.format(url, response.status_code))
+
+    return elapsed
+
+
+def bench_phenotype(client, args):
+    """
+    Repeatedly request a phenotype, interleaved with expression requests for a rotating set of genes (which is
+    what used to grow the shared mouse projection), and report the phenotype latency for each window of
+    requests. The latency should stay flat however long the process runs.
+    """
+    import mongodb_utils
+
+    gene_ids = [gene['ensembl_gene_id'] for gene in mongodb_utils.get_genes(['ensembl_gene_id'])]
+    print('window\tp50_ms\tp90_ms\tp99_ms')
+    for window in range(args.windows):
+        timings = []
+        for i in range(args.window_size):
+            if gene_ids:
+                client.get('/expression/' + gene_ids[(window * args.window_size + i) % len(gene_ids)])
+            timings.append(_timed_get(client, '/phenotype/' + args.phenotype_id))
+        print('{}\t{:.2f}\t{:.2f}\t{:.2f}'.format(window, *_percentiles_ms(timings)))
+
+
+def bench_expression_payload(client, args):
+    """
+    Compare the payload size and server time of the full /expression/<id> response with the slim response
+    (values only, aligned to the /samples/ table).
+    """
+    import mongodb_utils
+
+    gene_ids = [gene['ensembl_gene_id'] for gene in mongodb_utils.get_genes(['ensembl_gene_id'])][:args.genes]
+    table_bytes = len(client.get('/samples/').data)
+
+    print('mode\tavg_bytes\tp50_ms\tp90_ms\tp99_ms')
+    for mode, suffix in (('full', ''), ('slim', '?slim=1')):
+        timings = []
+        total_bytes = 0
+        for gene_id in gene_ids:
+            start = time.time()
+            response = client.get('/expression/' + gene_id + suffix)
+            timings.append(time.time() - start)
+            total_bytes += len(response.data)
+        print('{}\t{:.0f}\t{:.2f}\t{:.2f}\t{:.2f}'.format(
+            mode, total_bytes / float(max(len(gene_ids), 1)), *_percentiles_ms(timings)))
+    print('the sample table is {} bytes and is fetched once'.format(table_bytes))
+
+
+def bench_correlation(client, args):
+    """
+    Time expression correlation searches for a random sample of genes in every available search mode. Searches
+    are prepared (search vector and sample mask read) before timing so only the scan is timed. The sharded mode
+    is only included when CORRELATION_WORKERS is configured and the workers are running. The recall of each mode
+    is the mean fraction of the exact top results that it finds.
+    """
+    import application
+    import correlation
+    import correlation_sketch
+    import dataset
+
+    expr_matrix = dataset.get_expression_matrix()
+    version = dataset.get_dataset_version()
+    gene_ids = np.random.RandomState(args.seed).permutation(expr_matrix.gene_ids)[:args.genes]
+    searches = [
+        correlation.prepare_search(args.corr_kind, 'expression', gene_id, 'expression', expr_matrix)
+        for gene_id in gene_ids
+    ]
+
+    sketch = dataset.get_correlation_sketch()
+
+    modes = [('local', lambda search: search.top(args.result_count))]
+    if application.CORRELATION_SHARDS is not None:
+        shards = application.CORRELATION_SHARDS
+        modes.append(('sharded', lambda search: shards.top(search, args.result_count, version)))
+    for candidate_count in args.candidates:
+        modes.append((
+            'approx-{}'.format(candidate_count),
+            lambda search, candidate_count=candidate_count: correlation_sketch.approximate_top(
+                search, expr_matrix, sketch, args.result_count, candidate_count)))
+
+    print('{} genes x {} samples'.format(*expr_matrix.shape))
+    print('mode\tp50_ms\tp90_ms\tp99_ms\tspeedup\trecall')
+    exact_results = None
+    local_median = None
+    for mode, top in modes:
+        timings = []
+        results = []
+        for search in searches:
+            start = time.time()
+            results.append(top(search))
+            timings.append(time.time() - start)
+        median = np.median(timings)
+        local_median = local_median or median
+        exact_results = exact_results or results
+        mean_recall = np.mean([
+            correlation_sketch.recall(result, exact_result) for result, exact_result in zip(results, exact_results)
+        ])
+        p50, p90, p99 = _percentiles_ms(timings)
+        print('{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}x\t{:.3f}'.format(
+            mode, p50, p90, p99, local_median / median, mean_recall))
+
+
+def bench_memory(client, args):
+    """
+    Report the bytes held by each long-lived structure, the resident memory and (with tracemalloc, so python 3.4
+    or later) the peak memory allocated by requests to each route. With --max-peak-mb or --max-rss-mb the
+    benchmark exits with status 1 if a limit is exceeded so that it can gate memory regressions.
+    """
+    import application
+    import dataset
+    import memory_usage
+
+    tracer = application.MEMORY_TRACER
+    if not tracer.available:
+        print('tracemalloc is not available (it needs python 3.4 or later) so route peaks are not measured')
+
+    urls = args.urls
+    if not urls:
+        expr_matrix = dataset.get_expression_matrix()
+        gene_id = expr_matrix.gene_ids[0]
+        urls = [
+            '/samples/',
+            '/expression/' + gene_id,
+            '/correlation/pearson/expression/{}/expression/100'.format(gene_id),
+        ]
+
+    # warm up first so that building the long-lived structures isn't charged to the first route
+    for url in urls:
+        _timed_get(client, url)
+    if tracer.available:
+        tracer.start()
+
+    for url in urls:
+        for _ in range(args.repeat):
+            application.CORRELATION_CACHE.clear()
+            _timed_get(client, url)
+    routes = tracer.route_stats()
+    resident = memory_usage.resident_memory()
+    structures = memory_usage.structure_memory()
+    tracer.stop()
+
+    print('structure\tmb')
+    for name, nbytes in structures.items():
+        print('{}\t{:.2f}'.format(name, nbytes / 1048576.0))
+    if routes:
+        print('')
+        print('route\trequests\tpeak_mb\tmean_peak_mb')
+        for route, stats in sorted(routes.items()):
+            print('{}\t{}\t{:.2f}\t{:.2f}'.format(
+                route, stats['requests'], stats['peak_bytes'] / 1048576.0, stats['mean_peak_bytes'] / 1048576.0))
+    print('')
+    print('rss_mb\t{:.2f}'.format((resident['rss'] or 0) / 1048576.0))
+    print('peak_rss_mb\t{:.2f}'.format((resident['peak_rss'] or 0) / 1048576.0))
+
+    failures = []
+    if args.max_peak_mb is not None:
+        failures.extend(
+            'a {} request allocated {:.2f}MB at its peak'.format(route, stats['peak_bytes'] / 1048576.0)
+            for route, stats in sorted(routes.items()) if stats['peak_bytes'] > args.max_peak_mb * 1048576)
+    if args.max_rss_mb is not None and resident['peak_rss'] > args.max_rss_mb * 1048576:
+        failures.append('the peak resident memory was {:.2f}MB'.format(resident['peak_rss'] / 1048576.0))
+    if failures:
+        for failure in failures:
+            print('FAIL: ' + failure)
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the factorial experiment viewer')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    pheno_parser = subparsers.add_parser('phenotype', help='phenotype route latency over a long-running process')
+    pheno_parser.add_argument('phenotype_id', help='the phenotype to request (eg. sacrifice_data.weight)')
+    pheno_parser.add_argument('--windows', type=int, default=20, help='the number of windows to report')
+    pheno_parser.add_argument('--window-size', type=int, default=50, help='the number of requests per window')
+    pheno_parser.set_defaults(func=bench_phenotype)
+
+    payload_parser = subparsers.add_parser('expression-payload', help='full vs slim expression responses')
+    payload_parser.add_argument('--genes', type=int, default=200, help='the number of genes to request')
+    payload_parser.set_defaults(func=bench_expression_payload)
+
+    corr_parser = subparsers.add_parser('correlation', help='expression correlation search modes')
+    corr_parser.add_argument('--genes', type=int, default=20, help='the number of genes to search for')
+    corr_parser.add_argument('--result-count', type=int, default=100, help='the number of results per search')
+    corr_parser.add_argument('--corr-kind', default='pearson', choices=['pearson', 'spearman'])
+    corr_parser.add_argument('--seed', type=int, default=0, help='the seed used to pick the genes')
+    corr_parser.add_argument(
+        '--candidates',
+        type=int,
+        nargs='*',
+        default=[500, 2000],
+        help='the shortlist sizes to benchmark approximate searches with')
+    corr_parser.set_defaults(func=bench_correlation)
+
+    memory_parser = subparsers.add_parser('memory', help='structure sizes and peak allocation per request')
+    memory_parser.add_argument(
+        'urls',
+        nargs='*',
+        help='the URLs to request (by default the sample table, a gene and a correlation search for that gene)')
+    memory_parser.add_argument('--repeat', type=int, default=3, help='the number of times to request each URL')
+    memory_parser.add_argument('--max-peak-mb', type=float, help='fail if any request allocates more than this')
+    memory_parser.add_argument('--max-rss-mb', type=float, help='fail if the peak resident memory is more than this')
+    memory_parser.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+
+    import application
+    args.func(application.app.test_client(), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk snapshots of in-memory structures (expression matrices, indexes, ...) so that a restarted worker can
+reuse them instead of rebuilding them from mongo.
+
+Each snapshot lives in its own directory laid out like:
+
+    <snapshot dir>/<database>/<name>/v<dataset version>/manifest.json
+    <snapshot dir>/<database>/<name>/v<dataset version>/<array name>.npy
+
+The manifest holds all of the non-array metadata so that it can be loaded with a single read, and the arrays
+are stored in numpy's .npy format so that they can be memory-mapped.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+SNAPSHOT_FORMAT = 1
+MANIFEST_FILE = 'manifest.json'
+
+SNAPSHOT_DIR = None
+DATABASE = None
+
+
+def set_snapshot_dir(snapshot_dir, database):
+    """
+    Set the directory that snapshots are written to. Snapshots are disabled if the directory is None.
+
+    :param snapshot_dir: the root directory for all snapshots
+    :type snapshot_dir: string
+    :param database: the name of the database that the snapshots are built from
+    :type database: string
+    """
+    global SNAPSHOT_DIR, DATABASE
+    SNAPSHOT_DIR = snapshot_dir
+    DATABASE = database
+
+
+def _structure_dir(name):
+    return os.path.join(SNAPSHOT_DIR, DATABASE, name)
+
+
+def _version_dir(name, dataset_version):
+    return os.path.join(_structure_dir(name), 'v{0}'.format(dataset_version))
+
+
+def save_snapshot(name, dataset_version, arrays, metadata):
+    """
+    Write a snapshot for the given structure. The snapshot is written to a temporary directory and then renamed
+    into place so that readers never see a partial snapshot. Snapshots for older dataset versions are removed.
+
+    :param name: the name of the structure being saved
+    :type name: string
+    :param dataset_version: the dataset version that the structure was built from
+    :type dataset_version: int
+    :param arrays: a dict of numpy arrays to save
+    :type arrays: dict
+    :param metadata: a JSON serializable dict of everything else that is needed to rebuild the structure
+    :type metadata: dict
+    :return: True if a snapshot was written, False otherwise
+    """
+    if SNAPSHOT_DIR is None:
+        return False
+
+    structure_dir = _structure_dir(name)
+    if not os.path.isdir(structure_dir):
+        try:
+            os.makedirs(structure_dir)
+        except OSError:
+            # another worker may have created it in the meantime
+            if not os.path.isdir(structure_dir):
+                raise
+
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=structure_dir)
+    try:
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, array_name + '.npy'), np.ascontiguousarray(array))
+
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as manifest_handle:
+            json.dump({
+                'format': SNAPSHOT_FORMAT,
+                'database': DATABASE,
+                'name': name,
+                'dataset_version': dataset_version,
+                'arrays': sorted(arrays.keys()),
+                'metadata': metadata,
+            }, manifest_handle)
+
+        try:
+            os.rename(tmp_dir, _version_dir(name, dataset_version))
+        except OSError:
+            # a concurrent worker already wrote this snapshot so we can just throw ours away
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    prune_snapshots(name, dataset_version)
+    return True
+
+
+def load_snapshot(name, dataset_version, mmap=True):
+    """
+    Load a snapshot for the given structure if one exists and it matches the dataset version.
+
+    :param name: the name of the structure to load
+    :type name: string
+    :param dataset_version: the current dataset version
+    :type dataset_version: int
+    :param mmap: True to memory-map the arrays (read-only), False to read them into memory
+    :type mmap: boolean
+    :return: an (arrays, metadata) tuple or None if there is no valid snapshot
+    """
+    if SNAPSHOT_DIR is None:
+        return None
+
+    version_dir = _version_dir(name, dataset_version)
+    try:
+        with open(os.path.join(version_dir, MANIFEST_FILE)) as manifest_handle:
+            manifest = json.load(manifest_handle)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('format') != SNAPSHOT_FORMAT or \
+            manifest.get('database') != DATABASE or \
+            manifest.get('dataset_version') != dataset_version:
+        return None
+
+    arrays = {}
+    try:
+        for array_name in manifest['arrays']:
+            arrays[array_name] = np.load(
+                os.path.join(version_dir, array_name + '.npy'),
+                mmap_mode='r' if mmap else None)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return arrays, manifest['metadata']
+
+
+def latest_snapshot_version(name, before_version):
+    """
+    Find the newest snapshot of the given structure that was built from a dataset version older than the given
+    one. This is used to refresh a structure incrementally after the dataset changes.
+
+    :param name: the name of the structure
+    :type name: string
+    :param before_version: only consider snapshots older than this dataset version
+    :type before_version: int
+    :return: the dataset version of the snapshot or None if there isn't one
+    """
+    if SNAPSHOT_DIR is None:
+        return None
+
+    try:
+        entries = os.listdir(_structure_dir(name))
+    except OSError:
+        return None
+
+    versions = []
+    for entry in entries:
+        try:
+            version = int(entry[1:]) if entry.startswith('v') else None
+        except ValueError:
+            continue
+        if version is not None and version < before_version:
+            versions.append(version)
+
+    return max(versions) if versions else None
+
+
+def prune_snapshots(name, dataset_version):
+    """
+    Remove any snapshots of the given structure that were built from a different dataset version.
+
+    :param name: the name of the structure
+    :type name: string
+    :param dataset_version: the dataset version to keep
+    :type dataset_version: int
+    """
+    if SNAPSHOT_DIR is None:
+        return
+
+    structure_dir = _structure_dir(name)
+    keep = os.path.basename(_version_dir(name, dataset_version))
+    for entry in os.listdir(structure_dir):
+        if entry.startswith('v') and entry != keep:
+            shutil.rmtree(os.path.join(structure_dir, entry), ignore_errors=True)
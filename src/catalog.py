@@ -0,0 +1,222 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A catalog of what the dataset contains so that questions like "which genes exist?" can be answered without
+scanning every mouse document. The importer keeps the catalog up to date as it writes data:
+
+* the "catalog" collection holds a single summary document (_id "summary") with the dataset 'version', the
+  'sample_count', the 'gene_count', the design 'factor_ids' and the 'phenotype_ids'
+* the "catalog_genes" collection holds a document per gene (_id is the gene ID) with the gene's 'value_count':
+  the number of samples with a (non-missing) expression value for the gene. The values of sparse genes that
+  aren't stored are 0 (see importdesnp.py) so they count as values too
+
+Value counts are updated incrementally by adding the difference that each import makes. The catalog can be
+checked against the mouse documents (which scans them) or rebuilt from scratch, eg. for datasets imported before
+the catalog existed:
+
+    python src/catalog.py --check
+    python src/catalog.py --rebuild
+"""
+
+import argparse
+import math
+
+import pymongo
+
+SUMMARY_ID = 'summary'
+
+# the number of catalog gene documents written at once
+WRITE_BATCH_SIZE = 1000
+
+
+def is_present(value):
+    """
+    :return: True if the expression value isn't missing (None or NaN)
+    """
+    return value is not None and not (isinstance(value, float) and math.isnan(value))
+
+
+def get_phenotype_ids(db):
+    """
+    :return: the sorted IDs of the phenotypes described in the attributes collection
+    """
+    phenotype_ids = []
+    for pheno in db.attributes.find({}, {'sub_key': 1, 'key_id': 1, '_id': 0}):
+        if pheno.get('sub_key'):
+            phenotype_ids.append('{0}.{1}'.format(pheno['sub_key'], pheno['key_id']))
+        elif pheno.get('key_id'):
+            phenotype_ids.append(pheno['key_id'])
+
+    return sorted(set(phenotype_ids))
+
+
+def update_value_counts(db, count_changes, new_gene_ids=()):
+    """
+    Add to the value counts of genes.
+
+    :param db: the database
+    :param count_changes: a dict of gene ID to the change in its value count
+    :param new_gene_ids: the IDs of new genes. They are added to the catalog even if they have no values
+    """
+    gene_ids = set(gene_id for gene_id, change in count_changes.items() if change) | set(new_gene_ids)
+    requests = [
+        pymongo.UpdateOne({'_id': gene_id}, {'$inc': {'value_count': count_changes.get(gene_id, 0)}}, upsert=True)
+        for gene_id in sorted(gene_ids)
+    ]
+    for start in range(0, len(requests), WRITE_BATCH_SIZE):
+        db.catalog_genes.bulk_write(requests[start:start + WRITE_BATCH_SIZE], ordered=False)
+
+
+def update_summary(db, version, factor_ids=()):
+    """
+    Update the summary after an import.
+
+    :param db: the database
+    :param version: the dataset version that the import created
+    :param factor_ids: the factor IDs in the imported design. These are added to the factor IDs already known
+    """
+    summary = db.catalog.find_one({'_id': SUMMARY_ID}) or {}
+    db.catalog.replace_one(
+        {'_id': SUMMARY_ID},
+        {
+            'version': version,
+            'sample_count': db.mouse.count_documents({}),
+            'gene_count': db.catalog_genes.count_documents({}),
+            'factor_ids': sorted(set(summary.get('factor_ids', [])) | set(factor_ids)),
+            'phenotype_ids': get_phenotype_ids(db),
+        },
+        upsert=True)
+
+
+def _scan(db):
+    """
+    Scan the mouse documents.
+
+    :return: a (value counts, factor IDs, sample count) tuple where value counts is a dict of gene ID to value
+             count (including genes that are annotated but have no values)
+    """
+    value_counts = {}
+    sparse_gene_ids = set()
+    for gene in db.genes.find({}, {'ensembl_gene_id': 1, 'sparse': 1, '_id': 0}):
+        value_counts[gene['ensembl_gene_id']] = 0
+        if gene.get('sparse'):
+            sparse_gene_ids.add(gene['ensembl_gene_id'])
+
+    # sparse genes have a value for every sample except the ones where a missing value is stored
+    missing_counts = {}
+    factor_ids = set()
+    sample_count = 0
+    for mouse in db.mouse.find({}, {'expression_data': 1, 'factors': 1, '_id': 0}):
+        sample_count += 1
+        factor_ids.update(mouse.get('factors') or {})
+        for gene_id, value in (mouse.get('expression_data') or {}).items():
+            if gene_id in sparse_gene_ids:
+                missing_counts[gene_id] = missing_counts.get(gene_id, 0) + (0 if is_present(value) else 1)
+            else:
+                value_counts[gene_id] = value_counts.get(gene_id, 0) + (1 if is_present(value) else 0)
+
+    for gene_id in sparse_gene_ids:
+        value_counts[gene_id] = sample_count - missing_counts.get(gene_id, 0)
+
+    return value_counts, factor_ids, sample_count
+
+
+def check(db, version):
+    """
+    Check the catalog against the mouse documents (this scans every mouse).
+
+    :param db: the database
+    :param version: the current dataset version
+    :return: a list of descriptions of the problems found (empty if the catalog is consistent)
+    """
+    summary = db.catalog.find_one({'_id': SUMMARY_ID})
+    if summary is None:
+        return ['there is no catalog. Run "python src/catalog.py --rebuild" to build it']
+
+    problems = []
+    if summary['version'] != version:
+        problems.append('the catalog is for dataset version {} but the dataset is at version {}'.format(
+            summary['version'], version))
+
+    value_counts, factor_ids, sample_count = _scan(db)
+    catalog_counts = {gene['_id']: gene['value_count'] for gene in db.catalog_genes.find()}
+    if summary['sample_count'] != sample_count:
+        problems.append('the catalog has {} samples but there are {}'.format(summary['sample_count'], sample_count))
+    if summary['gene_count'] != len(catalog_counts):
+        problems.append('the catalog summary has {} genes but the catalog lists {}'.format(
+            summary['gene_count'], len(catalog_counts)))
+    if set(summary['factor_ids']) != factor_ids:
+        problems.append('the catalog has factors {} but the samples have {}'.format(
+            sorted(summary['factor_ids']), sorted(factor_ids)))
+    if summary['phenotype_ids'] != get_phenotype_ids(db):
+        problems.append('the catalog phenotypes differ from the attributes collection')
+
+    for gene_id in sorted(set(value_counts) | set(catalog_counts)):
+        if gene_id not in catalog_counts:
+            problems.append('{} is missing from the catalog'.format(gene_id))
+        elif gene_id not in value_counts:
+            problems.append('{} is in the catalog but not in the dataset'.format(gene_id))
+        elif catalog_counts[gene_id] != value_counts[gene_id]:
+            problems.append('the catalog has {} values for {} but there are {}'.format(
+                catalog_counts[gene_id], gene_id, value_counts[gene_id]))
+
+    return problems
+
+
+def rebuild(db, version):
+    """
+    Rebuild the catalog from the mouse documents (this scans every mouse).
+
+    :param db: the database
+    :param version: the current dataset version
+    """
+    value_counts, factor_ids, _ = _scan(db)
+    db.catalog_genes.delete_many({})
+    update_value_counts(db, value_counts, value_counts)
+    update_summary(db, version, factor_ids)
+
+
+def main():
+    import config
+    import mongodb_utils
+
+    parser = argparse.ArgumentParser(description='check or rebuild the dataset catalog')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--check', action='store_true', help='check the catalog against the mouse documents')
+    action.add_argument('--rebuild', action='store_true', help='rebuild the catalog from the mouse documents')
+    args = parser.parse_args()
+
+    mongodb_utils.connect(config.MONGO_SERVER, config.MONGO_PORT)
+    db = mongodb_utils.MONGO[config.MONGO_DATABASE]
+    version = mongodb_utils.get_dataset_version(config.MONGO_DATABASE)
+
+    if args.rebuild:
+        rebuild(db, version)
+        print('rebuilt the catalog for dataset version {}'.format(version))
+    else:
+        problems = check(db, version)
+        for problem in problems:
+            print(problem)
+        if problems:
+            raise SystemExit(1)
+        print('the catalog is consistent with dataset version {}'.format(version))
+
+
+if __name__ == '__main__':
+    main()
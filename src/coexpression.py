@@ -0,0 +1,360 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Gene co-expression modules. Modules are found in four steps, all of which keep memory bounded by the tile size
+rather than by the square of the gene count:
+
+1. every gene's profile is standardized (see correlation_sketch.standardize_rows) into a scratch file so that
+   correlations are dot products
+2. the all-gene correlation matrix is calculated a tile at a time on a thread pool and written to a
+   memory-mapped scratch file
+3. the correlation matrix is read back a block of rows at a time to find each gene's most highly (positively)
+   correlated neighbours
+4. labels are propagated over the neighbour graph and every group of at least min_module_size genes becomes a
+   module. Genes in smaller groups are left unassigned (module 0)
+
+Each module's eigengene is the first principal component of its members' standardized profiles and each gene's
+module membership (kME) is its correlation with its module's eigengene.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import cache_snapshot
+from correlation_sketch import standardize_rows
+
+SNAPSHOT_NAME = 'coexpression_modules'
+
+# the number of genes on each side of a correlation tile
+TILE_SIZE = 1024
+
+# label propagation stops after this many passes even if labels are still changing
+MAX_PROPAGATION_PASSES = 50
+
+_LOCK = threading.Lock()
+_MODULES = {}
+
+
+class CoexpressionModules(object):
+    """
+    The co-expression modules of the genes of an ExpressionMatrix (in the same row order).
+    """
+
+    def __init__(self, params, module_ids, kme, eigengenes, variance_explained):
+        """
+        :param params: the dict of parameters that the modules were found with
+        :param module_ids: an int32 array of each gene's module (0 for unassigned genes)
+        :param kme: a float array of each gene's correlation with its module's eigengene (NaN for unassigned genes)
+        :param eigengenes: a float array with one row per module (module 1 first) and one column per sample
+        :param variance_explained: a float array of the fraction of its members' variance that each module's
+                                   eigengene explains
+        """
+        self.params = params
+        self.module_ids = module_ids
+        self.kme = kme
+        self.eigengenes = eigengenes
+        self.variance_explained = variance_explained
+
+    @property
+    def module_count(self):
+        return len(self.eigengenes)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.to_arrays().values())
+
+    def members(self, module_id):
+        """
+        :param module_id: the module
+        :return: the row indexes of the module's genes ordered by descending kME
+        """
+        indexes = np.flatnonzero(self.module_ids == module_id)
+        return indexes[np.argsort(-self.kme[indexes], kind='mergesort')]
+
+    def to_arrays(self):
+        return {
+            'module_ids': self.module_ids,
+            'kme': self.kme,
+            'eigengenes': self.eigengenes,
+            'variance_explained': self.variance_explained,
+        }
+
+
+def _standardize(expr_matrix, path):
+    gene_count, sample_count = expr_matrix.shape
+    standardized = np.memmap(path, dtype=np.float32, mode='w+', shape=(gene_count, sample_count))
+    for start, stop, block in expr_matrix.iter_blocks(TILE_SIZE):
+        standardized[start:stop] = standardize_rows(block)
+
+    return standardized
+
+
+def _correlate_tiles(standardized, path, pool, progress):
+    gene_count = len(standardized)
+    correlations = np.memmap(path, dtype=np.float32, mode='w+', shape=(gene_count, gene_count))
+    starts = range(0, gene_count, TILE_SIZE)
+    tiles = [(i, j) for i in starts for j in starts if j >= i]
+
+    def correlate_tile(tile):
+        i, j = tile
+        tile_values = np.dot(standardized[i:i + TILE_SIZE], standardized[j:j + TILE_SIZE].T)
+        correlations[i:i + TILE_SIZE, j:j + TILE_SIZE] = tile_values
+        if i != j:
+            correlations[j:j + TILE_SIZE, i:i + TILE_SIZE] = tile_values.T
+
+    for done, _ in enumerate(pool.imap_unordered(correlate_tile, tiles)):
+        progress(0.8 * (done + 1) / len(tiles))
+
+    # reopen read-only so that the written pages can be dropped from memory once they are on disk
+    correlations.flush()
+    return np.memmap(path, dtype=np.float32, mode='r', shape=(gene_count, gene_count))
+
+
+def _nearest_neighbours(correlations, neighbours, min_correlation, pool):
+    gene_count = len(correlations)
+    neighbours = min(neighbours, gene_count - 1)
+    neighbour_indexes = np.zeros((gene_count, neighbours), dtype=np.int32)
+    neighbour_weights = np.zeros((gene_count, neighbours), dtype=np.float32)
+
+    # read about as many correlations at once as there are in a tile however many genes there are
+    block_size = max(1, TILE_SIZE * TILE_SIZE // gene_count)
+
+    def find_neighbours(start):
+        stop = min(start + block_size, gene_count)
+        block = np.array(correlations[start:stop])
+        block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        best = np.argpartition(-block, neighbours - 1, axis=1)[:, :neighbours]
+        weights = block[np.arange(stop - start)[:, np.newaxis], best]
+        weights[weights < min_correlation] = 0.0
+        neighbour_indexes[start:stop] = best
+        neighbour_weights[start:stop] = weights
+
+    if neighbours > 0:
+        pool.map(find_neighbours, range(0, gene_count, block_size))
+
+    return neighbour_indexes, neighbour_weights
+
+
+def _color_genes(sources, targets, gene_count):
+    """
+    Split the genes into groups (colors) in which no two genes are neighbours, so that every gene in a group can
+    take its neighbours' labels at once with the same outcome as taking them one gene at a time. Each round picks
+    the uncoloured genes whose (random) priority is higher than that of all of their uncoloured neighbours.
+
+    :return: a (colors, color_count) tuple of an array of each gene's color and the number of colors
+    """
+    priorities = np.random.RandomState(0).permutation(gene_count)
+    colors = np.empty(gene_count, dtype=np.int64)
+    colors.fill(-1)
+    color = 0
+    while (colors < 0).any():
+        uncolored = colors < 0
+        outranked = uncolored[sources] & uncolored[targets] & (priorities[targets] > priorities[sources])
+        chosen = uncolored & (np.bincount(sources[outranked], minlength=gene_count) == 0)
+        colors[chosen] = color
+        color += 1
+
+    return colors, color
+
+
+def _best_labels(sources, labels, weights, gene_count):
+    """
+    :param sources: the gene at the start of every edge, in ascending order
+    :param labels: the current label of the gene at the end of every edge
+    :param weights: the weight of every edge
+    :return: a (genes, labels) tuple of the genes that have edges and the label with the most weight among each
+             gene's neighbours, breaking ties with the smallest label
+    """
+    votes, inverse = np.unique(sources * gene_count + labels, return_inverse=True)
+    vote_weights = np.bincount(inverse, weights=weights)
+    vote_genes, vote_labels = votes // gene_count, votes % gene_count
+
+    # votes are sorted by gene and then by label so the first of a gene's heaviest votes has the smallest label
+    gene_starts = np.flatnonzero(np.concatenate([[True], vote_genes[1:] != vote_genes[:-1]]))
+    gene_vote_counts = np.diff(np.concatenate([gene_starts, [len(votes)]]))
+    gene_max_weights = np.repeat(np.maximum.reduceat(vote_weights, gene_starts), gene_vote_counts)
+    heaviest = np.flatnonzero(vote_weights == gene_max_weights)
+    first = np.concatenate([[True], vote_genes[heaviest][1:] != vote_genes[heaviest][:-1]])
+
+    return vote_genes[heaviest][first], vote_labels[heaviest][first]
+
+
+def _propagate_labels(neighbour_indexes, neighbour_weights):
+    """
+    Every gene starts with its own label and then repeatedly takes the label with the most weight among its
+    neighbours until the labels stop changing (or MAX_PROPAGATION_PASSES is reached). Genes are updated a color
+    at a time (see _color_genes) with a few array operations per color, so a pass costs a sort of the edges
+    (O(E log E) for E = 2 x genes x neighbours) rather than a Python loop over the genes.
+
+    :param neighbour_indexes: a (genes, neighbours) array of each gene's neighbours
+    :param neighbour_weights: the weight of each neighbour (0 where there is no edge)
+    :return: an array of each gene's label
+    """
+    gene_count = len(neighbour_indexes)
+
+    # make the neighbour graph undirected so that an edge from either end counts
+    edges = neighbour_weights > 0
+    sources = np.repeat(np.arange(gene_count), edges.sum(axis=1))
+    targets = neighbour_indexes[edges].astype(np.int64)
+    weights = neighbour_weights[edges]
+    sources, targets, weights = (
+        np.concatenate([sources, targets]), np.concatenate([targets, sources]), np.concatenate([weights, weights]))
+
+    # group the edges by the color of their first gene (and then by gene)
+    colors, color_count = _color_genes(sources, targets, gene_count)
+    order = np.lexsort((sources, colors[sources]))
+    sources, targets, weights = sources[order], targets[order], weights[order]
+    color_offsets = np.concatenate([[0], np.cumsum(np.bincount(colors[sources], minlength=color_count))])
+
+    labels = np.arange(gene_count)
+    for _ in range(MAX_PROPAGATION_PASSES):
+        changed = False
+        for start, stop in zip(color_offsets[:-1], color_offsets[1:]):
+            if start == stop:
+                continue
+
+            genes, best_labels = _best_labels(
+                sources[start:stop], labels[targets[start:stop]], weights[start:stop], gene_count)
+            if (labels[genes] != best_labels).any():
+                labels[genes] = best_labels
+                changed = True
+        if not changed:
+            break
+
+    return labels
+
+
+def _eigengenes(standardized, module_ids, module_count):
+    sample_count = standardized.shape[1]
+    kme = np.empty(len(module_ids), dtype=np.float32)
+    kme.fill(np.nan)
+    eigengenes = np.zeros((module_count, sample_count))
+    variance_explained = np.zeros(module_count)
+    for module_id in range(1, module_count + 1):
+        members = np.flatnonzero(module_ids == module_id)
+        member_values = np.asarray(standardized[members], dtype=np.float64)
+        _, singular_values, components = np.linalg.svd(member_values, full_matrices=False)
+
+        # the profiles are centered so the component is too. Flip it to follow the members' average profile
+        eigengene = components[0]
+        if np.dot(member_values.mean(axis=0), eigengene) < 0:
+            eigengene = -eigengene
+
+        kme[members] = member_values.dot(eigengene)
+        eigengenes[module_id - 1] = eigengene * np.sqrt(sample_count)
+        variance_explained[module_id - 1] = singular_values[0] ** 2 / (singular_values ** 2).sum()
+
+    return kme, eigengenes, variance_explained
+
+
+def find_modules(expr_matrix, min_correlation, neighbours, min_module_size, threads=4, scratch_dir=None,
+                 progress=None):
+    """
+    Find the co-expression modules of every gene in the expression matrix.
+
+    :param expr_matrix: the ExpressionMatrix
+    :param min_correlation: genes are only neighbours if their correlation is at least this
+    :param neighbours: the maximum number of neighbours of each gene
+    :param min_module_size: groups of genes smaller than this are left unassigned
+    :param threads: the number of threads to calculate tiles on
+    :param scratch_dir: the directory for the scratch files (the system temp directory by default). The
+                        correlation scratch file takes 4 bytes for every pair of genes
+    :param progress: an optional function that is called with the fraction of the work done so far
+    :return: the CoexpressionModules
+    """
+    params = {'min_correlation': min_correlation, 'neighbours': neighbours, 'min_module_size': min_module_size}
+    progress = progress or (lambda fraction: None)
+    work_dir = tempfile.mkdtemp(prefix='coexpression-', dir=scratch_dir)
+    pool = ThreadPool(threads)
+    try:
+        standardized = _standardize(expr_matrix, os.path.join(work_dir, 'standardized.dat'))
+        correlations = _correlate_tiles(standardized, os.path.join(work_dir, 'correlations.dat'), pool, progress)
+        neighbour_indexes, neighbour_weights = _nearest_neighbours(
+            correlations, neighbours, min_correlation, pool)
+        del correlations
+        progress(0.85)
+
+        labels = _propagate_labels(neighbour_indexes, neighbour_weights)
+        progress(0.95)
+
+        # number the modules that are big enough from 1 in order of decreasing size
+        label_counts = np.bincount(labels, minlength=len(labels))
+        module_labels = np.flatnonzero(label_counts >= min_module_size)
+        module_labels = module_labels[np.argsort(-label_counts[module_labels], kind='mergesort')]
+        label_modules = np.zeros(len(labels), dtype=np.int32)
+        label_modules[module_labels] = np.arange(1, len(module_labels) + 1)
+        module_ids = label_modules[labels]
+
+        kme, eigengenes, variance_explained = _eigengenes(standardized, module_ids, len(module_labels))
+        del standardized
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return CoexpressionModules(params, module_ids, kme, eigengenes, variance_explained)
+
+
+def get_modules(dataset_version, params):
+    """
+    Get the modules found for the given dataset version (in this process or in a snapshot).
+
+    :param dataset_version: the dataset version
+    :param params: the dict of parameters that the modules must have been found with
+    :return: the CoexpressionModules or None if they haven't been found yet
+    """
+    with _LOCK:
+        modules = _MODULES.get(dataset_version)
+        if modules is not None and modules.params == params:
+            return modules
+
+        snapshot = cache_snapshot.load_snapshot(SNAPSHOT_NAME, dataset_version)
+        if snapshot is None or snapshot[1]['params'] != params:
+            return None
+
+        arrays, metadata = snapshot
+        modules = CoexpressionModules(
+            metadata['params'], arrays['module_ids'], arrays['kme'], arrays['eigengenes'], arrays['variance_explained'])
+        _MODULES.clear()
+        _MODULES[dataset_version] = modules
+
+        return modules
+
+
+def cached_nbytes():
+    """
+    :return: the size in bytes of the modules kept in this process
+    """
+    with _LOCK:
+        return sum(modules.nbytes for modules in _MODULES.values())
+
+
+def put_modules(dataset_version, modules):
+    """
+    Keep the modules found for the given dataset version and save them as a snapshot.
+    """
+    with _LOCK:
+        _MODULES.clear()
+        _MODULES[dataset_version] = modules
+    cache_snapshot.save_snapshot(SNAPSHOT_NAME, dataset_version, modules.to_arrays(), {'params': modules.params})
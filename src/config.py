@@ -23,6 +23,114 @@ MONGO_SERVER = 'mr4.jax.org'
 MONGO_PORT = 27017
 MONGO_DATABASE = 'vv_sleepstudy'
 
+# in-memory structures built from the dataset (like the gene expression matrix) are saved under
+# this directory so that restarted workers can reuse them rather than rebuilding them from
+# mongo. Set to None to disable snapshots
+CACHE_SNAPSHOT_DIR = '/tmp/factorial-experiment-viewer-cache'
+
+# how often (in seconds) to check the database for a new dataset version
+DATASET_VERSION_CHECK_INTERVAL = 5.0
+
+# the maximum number of parsed phenotype columns to keep in memory
+PHENOTYPE_CACHE_SIZE = 1000
+
+# correlation results are cached in memory up to this many bytes. The top CORRELATION_CACHE_TOP_K
+# results are cached for every search so that requests for fewer results can be answered from the cache
+CORRELATION_CACHE_BYTES = 64 * 1024 * 1024
+CORRELATION_CACHE_TOP_K = 1000
+
+# correlation searches with mode=approx calculate exact correlations for a shortlist of this many
+# candidates (picked using random projection sketches). Larger shortlists have better recall
+APPROX_CANDIDATES = 2000
+
+# correlation searches with significance=1 shuffle the samples CORRELATION_PERMUTATIONS times by default
+# (at most CORRELATION_MAX_PERMUTATIONS) using CORRELATION_PERMUTATION_SEED as the default random seed
+CORRELATION_PERMUTATIONS = 1000
+CORRELATION_MAX_PERMUTATIONS = 10000
+CORRELATION_PERMUTATION_SEED = 0
+
+# the default number of base pairs on either side of a gene that /nearby-correlation/ searches
+NEARBY_WINDOW = 1000000
+
+# /pca/ finds PCA_COMPONENTS principal components of the samples by default. Results are cached
+# per dataset version, subset and options up to PCA_CACHE_BYTES
+PCA_COMPONENTS = 10
+PCA_CACHE_BYTES = 16 * 1024 * 1024
+
+# /heatmap/ accepts at most HEATMAP_MAX_GENES genes. The clustering orders of recent heatmaps are
+# cached up to HEATMAP_ORDER_CACHE_BYTES
+HEATMAP_MAX_GENES = 5000
+HEATMAP_ORDER_CACHE_BYTES = 16 * 1024 * 1024
+
+# /gene-sets/scores scores at most GENE_SET_MAX_SETS gene sets per request
+GENE_SET_MAX_SETS = 1000
+
+# /scatter-density/ counts points in SCATTER_DENSITY_BINS bins across the X range by default and
+# in at most SCATTER_DENSITY_MAX_BINS
+SCATTER_DENSITY_BINS = 40
+SCATTER_DENSITY_MAX_BINS = 200
+
+# expression correlation searches can be split across shard workers (started with
+# python src/correlation_workers.py) which each own a contiguous shard of the genes. List the
+# (host, port) address of every shard's worker, eg. [('localhost', 6001), ('localhost', 6002)].
+# When this is empty searches are run in the web application's process. If a worker can't be reached or takes
+# more than CORRELATION_WORKER_TIMEOUT seconds to answer, the search is run in the web application's process
+CORRELATION_WORKERS = []
+CORRELATION_WORKER_AUTHKEY = 'change-me'
+CORRELATION_WORKER_TIMEOUT = 30.0
+
+# long running analyses submitted to /jobs/ run in at most JOB_MAX_WORKERS worker processes. At
+# most JOB_MAX_QUEUED jobs can wait to run and finished jobs are kept for JOB_RESULT_TTL seconds
+JOB_MAX_WORKERS = 2
+JOB_MAX_QUEUED = 100
+JOB_RESULT_TTL = 600
+
+# gene co-expression modules (served from /modules/) are found by a background job. Genes are only
+# neighbours if their correlation is at least COEXPRESSION_MIN_CORRELATION, each gene keeps at most
+# COEXPRESSION_NEIGHBOURS neighbours and groups smaller than COEXPRESSION_MIN_MODULE_SIZE genes are left
+# unassigned. The correlation matrix is written to a scratch file under COEXPRESSION_SCRATCH_DIR (the
+# system temp directory if None) which takes 4 bytes for every pair of genes
+COEXPRESSION_MIN_CORRELATION = 0.7
+COEXPRESSION_NEIGHBOURS = 10
+COEXPRESSION_MIN_MODULE_SIZE = 20
+COEXPRESSION_THREADS = 4
+COEXPRESSION_SCRATCH_DIR = None
+
+# admission control keeps expensive routes from tying up every server thread. Each group limits how many
+# requests for its routes (flask endpoint names) run at once and how many may wait (for at most
+# queue_timeout seconds) for a slot. Other requests get a 503 response with a Retry-After header straight
+# away. Routes that aren't in a group are not limited
+ADMISSION_LIMITS = {
+    'analysis': {
+        'routes': [
+            'correlation_search', 'nearby_correlation', 'region_expression', 'export_expression',
+            'coexpression_modules', 'coexpression_module', 'coexpression_module_eigengene', 'sample_pca_overview',
+            'clustered_heatmap', 'gene_set_scores', 'scatter_density_bins',
+        ],
+        'max_concurrent': 4,
+        'max_queued': 8,
+        'queue_timeout': 10.0,
+        'retry_after': 5,
+    },
+    'search': {
+        'routes': ['phenotype_search', 'expression_search'],
+        'max_concurrent': 16,
+        'max_queued': 32,
+        'queue_timeout': 2.0,
+        'retry_after': 1,
+    },
+}
+
+# trace allocations with tracemalloc (python 3.4 or later) to report the peak memory allocated by each route and
+# the top allocation sites at /admin/memory. Tracing slows every allocation down so leave it off in production.
+# Without tracemalloc (python 2) a warning is logged and tracing stays off.
+# MEMORY_TRACING_FRAMES is the number of stack frames recorded for each allocation
+MEMORY_TRACING = False
+MEMORY_TRACING_FRAMES = 1
+
+# build (or load from snapshot) all in-memory structures before serving the first request
+WARM_CACHES_ON_STARTUP = False
+
 # the following values enumerate all possible shapes you can use for 'level_shapes' in
 # the WEB_APP_CONF below
 CIRCLE = "circle"
@@ -127,4 +235,10 @@ WEB_APP_CONF = {
 
     # should we jitter the points?
     'jitter_points': True,
+
+    # gene vs. gene scatter plots of more than this many samples are drawn as density bins (from
+    # /scatter-density/) rather than a point per sample. Bins are colored by the levels of
+    # 'scatter_density_factor' if it is set
+    'scatter_density_threshold': 2000,
+    #'scatter_density_factor': 'treatment',
 }
@@ -0,0 +1,377 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Vectorized correlation of one expression or phenotype vector against many others. Samples that are missing a
+value (NaN) are handled using pairwise-complete statistics: every correlation is calculated using only the
+samples that have a value for both vectors.
+"""
+
+import numpy as np
+
+import mongodb_utils
+import phenotype_cache
+
+CORRELATION_KINDS = ('pearson', 'spearman')
+ID_KINDS = ('expression', 'phenotype')
+
+# the number of rows to correlate at once
+BLOCK_SIZE = 2048
+
+# correlations calculated from fewer samples than this are discarded
+MIN_COMMON_SAMPLES = 3
+
+
+def rank_rows(values):
+    """
+    Rank every row of a 2D array, assigning tied values the average of their ranks (the same as
+    scipy.stats.rankdata). The array must not contain NaNs.
+
+    :param values: a 2D array
+    :return: a float array of ranks starting at 1 with the same shape as values
+    """
+    row_count, col_count = values.shape
+    rows = np.arange(row_count)[:, np.newaxis]
+    order = np.argsort(values, axis=1, kind='mergesort')
+    sorted_values = values[rows, order]
+
+    # give every run of tied values a group ID that is unique across all rows
+    new_group = np.ones((row_count, col_count), dtype=bool)
+    new_group[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    group_ids = (np.cumsum(new_group, axis=1) - 1 + rows * col_count).ravel()
+
+    positions = np.tile(np.arange(1, col_count + 1, dtype=np.float64), row_count)
+    group_sums = np.bincount(group_ids, weights=positions, minlength=row_count * col_count)
+    group_counts = np.bincount(group_ids, minlength=row_count * col_count)
+
+    ranks = np.empty((row_count, col_count), dtype=np.float64)
+    ranks[rows, order] = (group_sums[group_ids] / group_counts[group_ids]).reshape(row_count, col_count)
+
+    return ranks
+
+
+def pearson_rows(x, rows):
+    """
+    Calculate the pairwise-complete Pearson correlation between x and every row.
+
+    :param x: a 1D float array which may contain NaNs
+    :param rows: a 2D float array which may contain NaNs with one column per element of x
+    :return: a 1D array of correlations. Correlations based on fewer than MIN_COMMON_SAMPLES samples or on
+             a constant vector are NaN
+    """
+    mask = ~np.isnan(rows) & ~np.isnan(x)
+    counts = mask.sum(axis=1)
+
+    # centering first keeps the sums below numerically stable
+    x_mean = np.nanmean(x) if counts.any() else 0.0
+    x_centered = np.where(mask, x - x_mean, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row_means = np.where(mask, rows, 0.0).sum(axis=1) / counts
+        rows_centered = np.where(mask, rows - row_means[:, np.newaxis], 0.0)
+
+        x_sums = x_centered.sum(axis=1)
+        row_sums = rows_centered.sum(axis=1)
+        cov = (x_centered * rows_centered).sum(axis=1) - x_sums * row_sums / counts
+        x_var = (x_centered * x_centered).sum(axis=1) - x_sums * x_sums / counts
+        row_var = (rows_centered * rows_centered).sum(axis=1) - row_sums * row_sums / counts
+        corrs = cov / np.sqrt(x_var * row_var)
+
+    corrs[(counts < MIN_COMMON_SAMPLES) | ~np.isfinite(corrs)] = np.nan
+
+    return np.clip(corrs, -1.0, 1.0)
+
+
+def spearman_rows(x, rows):
+    """
+    Calculate the pairwise-complete Spearman correlation between x and every row. Ranks are calculated over the
+    samples that both vectors have values for. Rows without missing values are ranked together in one pass and
+    only rows with missing values are ranked individually.
+
+    :param x: a 1D float array which may contain NaNs
+    :param rows: a 2D float array which may contain NaNs with one column per element of x
+    :return: a 1D array of correlations (see pearson_rows)
+    """
+    x_mask = ~np.isnan(x)
+    x = x[x_mask]
+    rows = rows[:, x_mask]
+    corrs = np.empty(len(rows))
+    corrs.fill(np.nan)
+    if len(x) < MIN_COMMON_SAMPLES:
+        return corrs
+
+    x_ranks = rank_rows(x[np.newaxis, :])
+
+    complete = ~np.isnan(rows).any(axis=1)
+    if complete.any():
+        corrs[complete] = pearson_rows(x_ranks, rank_rows(rows[complete]))
+
+    for i in np.flatnonzero(~complete):
+        common = ~np.isnan(rows[i])
+        if common.sum() >= MIN_COMMON_SAMPLES:
+            corrs[i] = pearson_rows(rank_rows(x[np.newaxis, common]), rank_rows(rows[i:i + 1, common]))[0]
+
+    return corrs
+
+
+CORRELATION_FUNCS = {
+    'pearson': pearson_rows,
+    'spearman': spearman_rows,
+}
+
+
+def phenotype_matrix(phenotype_ids, mouse_ids):
+    """
+    Get the values of the given phenotypes from the phenotype column cache.
+
+    :param phenotype_ids: the phenotype IDs
+    :param mouse_ids: the mouse IDs in the column order that we want
+    :return: a (len(phenotype_ids), len(mouse_ids)) float array with NaN for missing or non-numeric values
+    """
+    columns = phenotype_cache.get_columns(phenotype_ids)
+
+    matrix = np.empty((len(phenotype_ids), len(mouse_ids)), dtype=np.float64)
+    matrix.fill(np.nan)
+    for i, phenotype_id in enumerate(phenotype_ids):
+        if columns[phenotype_id].is_numeric:
+            matrix[i] = columns[phenotype_id].aligned_values(mouse_ids)
+
+    return matrix
+
+
+def _search_vector(id_kind, search_id, expr_matrix):
+    if id_kind == 'expression':
+        return expr_matrix.row(search_id)
+    else:
+        column = phenotype_cache.get_column(search_id)
+        if not column.is_numeric:
+            return None
+        return np.array(column.aligned_values(expr_matrix.mouse_ids))
+
+
+class ArrayRows(object):
+    """
+    Gives a 2D array the same block interface as ExpressionMatrix
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def block(self, start, stop):
+        return self.values[start:stop]
+
+
+class CorrelationSearch(object):
+    """
+    A correlation search where everything that has to be read from mongo or the caches has already been read, so
+    running it is pure computation (which means that it can also be run in a forked worker process).
+    """
+
+    def __init__(self, corr_kind, search_values, ids, names, rows, sample_mask=None, exclude_id=None):
+        """
+        :param corr_kind: one of CORRELATION_KINDS
+        :param search_values: the values to correlate against (over all samples) or None if the search ID was
+                              not found, in which case there are no results
+        :param ids: the IDs of the candidate rows
+        :param names: the names of the candidate rows
+        :param rows: the candidate rows. Anything with a block(start, stop) method like ExpressionMatrix
+        :param sample_mask: an optional boolean mask of the samples to use
+        :param exclude_id: a candidate ID that should never be returned (the search ID itself)
+        """
+        self.corr_kind = corr_kind
+        self.corr_func = CORRELATION_FUNCS[corr_kind]
+        self.unmasked_search_values = search_values
+        self.search_values = search_values
+        self.ids = ids
+        self.names = names
+        self.rows = rows
+        self.sample_mask = sample_mask
+        self.exclude_id = exclude_id
+
+        if search_values is not None and sample_mask is not None:
+            self.search_values = search_values[sample_mask]
+
+    @property
+    def row_count(self):
+        return len(self.ids) if self.search_values is not None else 0
+
+    def iter_block_correlations(self, block_size=BLOCK_SIZE):
+        """
+        Score the candidates a block at a time with a single vectorized pass per block.
+
+        :param block_size: the number of candidate rows per block
+        :return: a generator of (start, stop, correlations) tuples. Correlations that can't be calculated or
+                 that belong to the excluded ID are NaN
+        """
+        for start in range(0, self.row_count, block_size):
+            stop = min(start + block_size, self.row_count)
+            block = np.asarray(self.rows.block(start, stop), dtype=np.float64)
+            if self.sample_mask is not None:
+                block = block[:, self.sample_mask]
+
+            corrs = self.corr_func(self.search_values, block)
+            if self.exclude_id is not None:
+                for i in range(start, stop):
+                    if self.ids[i] == self.exclude_id:
+                        corrs[i - start] = np.nan
+
+            yield start, stop, corrs
+
+    def iter_top(self, result_count, block_size=BLOCK_SIZE):
+        """
+        Keep a running top result_count as the candidates are scored.
+
+        :param result_count: the maximum number of results to keep
+        :param block_size: the number of candidate rows per block
+        :return: a generator which yields (rows_scored, indexes, correlations) after every block where indexes
+                 are the candidate row indexes of the current leaders. These are not sorted
+        """
+        top_indexes = np.empty(0, dtype=np.int64)
+        top_corrs = np.empty(0)
+        for start, stop, corrs in self.iter_block_correlations(block_size):
+            keep = np.flatnonzero(~np.isnan(corrs))
+            top_indexes = np.concatenate([top_indexes, keep + start])
+            top_corrs = np.concatenate([top_corrs, corrs[keep]])
+
+            # only hang on to the best result_count candidates between blocks
+            if len(top_corrs) > result_count:
+                best = np.argpartition(-np.abs(top_corrs), result_count - 1)[:result_count]
+                top_indexes = top_indexes[best]
+                top_corrs = top_corrs[best]
+
+            yield stop, top_indexes, top_corrs
+
+    def result(self, indexes, corrs):
+        """
+        Build a result dict from candidate row indexes and their correlations.
+
+        :return: a dict with 'ids', 'names', 'correlations' and 'total_count' ordered by descending absolute
+                 correlation
+        """
+        order = np.argsort(-np.abs(corrs), kind='mergesort')
+
+        return {
+            'ids': [self.ids[indexes[i]] for i in order],
+            'names': [self.names[indexes[i]] for i in order],
+            'correlations': [float(corrs[i]) for i in order],
+            'total_count': len(order),
+        }
+
+    def top(self, result_count, progress=None):
+        """
+        Find the result_count most highly correlated candidates.
+
+        :param result_count: the maximum number of results to return
+        :param progress: an optional function that is called with the fraction of candidates scored so far
+        :return: a result dict (see result)
+        """
+        indexes = np.empty(0, dtype=np.int64)
+        corrs = np.empty(0)
+        if result_count > 0:
+            for rows_scored, indexes, corrs in self.iter_top(result_count):
+                if progress is not None:
+                    progress(float(rows_scored) / self.row_count)
+
+        return self.result(indexes, corrs)
+
+    def iter_results(self, result_count, block_size=BLOCK_SIZE):
+        """
+        Like top but yields the provisional result after every block so that the leaders can be shown before
+        every candidate has been scored.
+
+        :param result_count: the maximum number of results to return
+        :param block_size: the number of candidate rows per block
+        :return: a generator of (rows_scored, result) tuples. There is always at least one and the last result
+                 is the same as the one returned by top
+        """
+        rows_scored = 0
+        indexes = np.empty(0, dtype=np.int64)
+        corrs = np.empty(0)
+        if result_count > 0:
+            for rows_scored, indexes, corrs in self.iter_top(result_count, block_size):
+                if rows_scored < self.row_count:
+                    yield rows_scored, self.result(indexes, corrs)
+
+        yield rows_scored, self.result(indexes, corrs)
+
+
+def prepare_search(corr_kind, search_id_kind, search_id, result_id_kind, expr_matrix, sample_mask=None):
+    """
+    Read everything that a correlation search needs.
+
+    :param corr_kind: one of CORRELATION_KINDS
+    :param search_id_kind: "expression" or "phenotype"
+    :param search_id: the expression or phenotype ID to find correlations for
+    :param result_id_kind: "expression" or "phenotype"
+    :param expr_matrix: the ExpressionMatrix for the current dataset
+    :param sample_mask: an optional boolean mask (from the SampleIndex) of the samples to use
+    :return: a CorrelationSearch
+    """
+    search_values = _search_vector(search_id_kind, search_id, expr_matrix)
+    exclude_id = search_id if search_id_kind == result_id_kind else None
+
+    if result_id_kind == 'expression':
+        ids, names, rows = expr_matrix.gene_ids, expr_matrix.gene_symbols, expr_matrix
+    else:
+        phenotypes = mongodb_utils.get_numeric_phenotypes()
+        ids = [phenotype['id'] for phenotype in phenotypes]
+        names = [phenotype['name'] for phenotype in phenotypes]
+        rows = ArrayRows(phenotype_matrix(ids, expr_matrix.mouse_ids))
+
+    return CorrelationSearch(corr_kind, search_values, ids, names, rows, sample_mask, exclude_id)
+
+
+def correlation_search(corr_kind, search_id_kind, search_id, result_id_kind, result_count, expr_matrix,
+                       sample_mask=None, progress=None):
+    """
+    Find the expression or phenotype values that are most highly correlated with the given expression or
+    phenotype.
+
+    :param corr_kind: one of CORRELATION_KINDS
+    :param search_id_kind: "expression" or "phenotype"
+    :param search_id: the expression or phenotype ID to find correlations for
+    :param result_id_kind: "expression" or "phenotype"
+    :param result_count: the maximum number of results to return
+    :param expr_matrix: the ExpressionMatrix for the current dataset
+    :param sample_mask: an optional boolean mask (from the SampleIndex) of the samples to use
+    :param progress: an optional function that is called with the fraction of candidates scored so far
+    :return: a dict with 'ids', 'names', 'correlations' and 'total_count' ordered by descending absolute
+             correlation
+    """
+    search = prepare_search(corr_kind, search_id_kind, search_id, result_id_kind, expr_matrix, sample_mask)
+
+    return search.top(result_count, progress)
+
+
+def slice_result(result, result_count):
+    """
+    Take the top result_count results from a correlation_search result.
+
+    :param result: the result returned by correlation_search
+    :param result_count: the maximum number of results to keep
+    :return: a new result dict
+    """
+    sliced = {key: result[key][:result_count] for key in ('ids', 'names', 'correlations')}
+    sliced['total_count'] = len(sliced['ids'])
+
+    # results with significance (see correlation_significance.py)
+    if 'p_values' in result:
+        sliced['p_values'] = result['p_values'][:result_count]
+        sliced['q_values'] = result['q_values'][:result_count]
+        sliced['permutations'] = result['permutations']
+
+    return sliced
@@ -0,0 +1,154 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Empirical significance of correlation search results. The search vector's sample labels are shuffled many
+times and every candidate is correlated with every shuffled vector: a candidate's p-value is the fraction of
+shuffles that correlate with it at least as strongly (in absolute value) as the real vector does. The p-values of
+all candidates are then adjusted for multiple testing with the Benjamini-Hochberg procedure to give q-values
+(false discovery rates).
+
+The shuffles are generated up front as a (permutations, samples) matrix of permuted search vectors. For the
+candidates that have a value for every sample the correlations with a whole batch of permutations are a single
+matrix product of standardized rows, so each block of candidates is read once and scored against every
+permutation. Candidates with missing values need pairwise-complete correlations and are scored against all of
+the permutations at once one candidate at a time.
+"""
+
+import numpy as np
+
+import correlation
+import correlation_sketch
+
+# the number of permuted search vectors that are multiplied by a block of candidates at once
+PERMUTATION_BATCH_SIZE = 256
+
+# correlations this close to the observed correlation count as being at least as strong (so that permutations
+# which give back the same correlation aren't lost to rounding)
+TOLERANCE = 1e-12
+
+
+def permutation_matrix(sample_count, permutations, seed):
+    """
+    :param sample_count: the number of samples
+    :param permutations: the number of permutations
+    :param seed: the random seed
+    :return: a (permutations, sample_count) int array with a permutation of the sample indexes in every row
+    """
+    random_values = np.random.RandomState(seed).random_sample((permutations, sample_count))
+
+    return np.argsort(random_values, axis=1)
+
+
+def benjamini_hochberg(p_values):
+    """
+    :param p_values: a 1D array of p-values which may contain NaNs (which aren't counted as tests)
+    :return: the Benjamini-Hochberg adjusted p-values (q-values) with NaN where p_values is NaN
+    """
+    q_values = np.empty(len(p_values))
+    q_values.fill(np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    if len(tested) == 0:
+        return q_values
+
+    order = np.argsort(p_values[tested], kind='mergesort')
+    ranked = p_values[tested][order] * len(tested) / np.arange(1, len(tested) + 1)
+    q_values[tested[order]] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+
+    return q_values
+
+
+def permutation_p_values(search, permutations, seed, block_size=correlation.BLOCK_SIZE):
+    """
+    Calculate the empirical p-value of every candidate of a correlation search.
+
+    :param search: the CorrelationSearch
+    :param permutations: the number of permutations
+    :param seed: the random seed for the permutations
+    :param block_size: the number of candidate rows to read at once
+    :return: a (correlations, p_values) tuple of arrays with an element per candidate. Both are NaN for the
+             candidates that have no correlation (see CorrelationSearch.iter_block_correlations)
+    """
+    correlations = np.empty(search.row_count)
+    correlations.fill(np.nan)
+    exceed_counts = np.zeros(search.row_count)
+    if search.row_count == 0:
+        return correlations, correlations.copy()
+
+    # samples that the search vector is missing never count towards a correlation so they aren't shuffled
+    present = ~np.isnan(search.search_values)
+    search_values = search.search_values[present]
+    shuffled = search_values[permutation_matrix(len(search_values), permutations, seed)]
+
+    spearman = search.corr_kind == 'spearman'
+    standardized_shuffled = correlation_sketch.standardize_rows(
+        correlation.rank_rows(shuffled) if spearman else shuffled)
+
+    for start, stop, block_correlations in search.iter_block_correlations(block_size):
+        correlations[start:stop] = block_correlations
+        block = np.asarray(search.rows.block(start, stop), dtype=np.float64)
+        if search.sample_mask is not None:
+            block = block[:, search.sample_mask]
+        block = block[:, present]
+
+        observed = np.abs(block_correlations) - TOLERANCE
+        scored = ~np.isnan(block_correlations)
+        complete = scored & ~np.isnan(block).any(axis=1)
+        if complete.any():
+            complete_rows = block[complete]
+            standardized_rows = correlation_sketch.standardize_rows(
+                correlation.rank_rows(complete_rows) if spearman else complete_rows)
+            complete_observed = observed[complete]
+            complete_counts = np.zeros(len(complete_rows))
+            for batch_start in range(0, permutations, PERMUTATION_BATCH_SIZE):
+                batch = standardized_shuffled[batch_start:batch_start + PERMUTATION_BATCH_SIZE]
+                complete_counts += (np.abs(batch.dot(standardized_rows.T)) >= complete_observed).sum(axis=0)
+            exceed_counts[start + np.flatnonzero(complete)] = complete_counts
+
+        for i in np.flatnonzero(scored & ~complete):
+            with np.errstate(invalid='ignore'):
+                exceed_counts[start + i] = (np.abs(search.corr_func(block[i], shuffled)) >= observed[i]).sum()
+
+    p_values = (exceed_counts + 1.0) / (permutations + 1.0)
+    p_values[np.isnan(correlations)] = np.nan
+
+    return correlations, p_values
+
+
+def add_significance(search, result, permutations, seed):
+    """
+    Add empirical p-values and q-values to a correlation search result.
+
+    :param search: the CorrelationSearch that gave the result
+    :param result: the result dict (see CorrelationSearch.result)
+    :param permutations: the number of permutations
+    :param seed: the random seed for the permutations
+    :return: a copy of result with 'p_values' and 'q_values' lists in result order along with the number of
+             'permutations'
+    """
+    _, p_values = permutation_p_values(search, permutations, seed)
+    q_values = benjamini_hochberg(p_values)
+    candidate_indexes = {candidate_id: i for i, candidate_id in enumerate(search.ids)}
+    result_indexes = [candidate_indexes[result_id] for result_id in result['ids']]
+
+    significant_result = dict(result)
+    significant_result['p_values'] = [float(p_values[i]) for i in result_indexes]
+    significant_result['q_values'] = [float(q_values[i]) for i in result_indexes]
+    significant_result['permutations'] = permutations
+
+    return significant_result
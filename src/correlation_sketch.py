@@ -0,0 +1,184 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Approximate correlation searches using random projection sketches. Every gene's expression profile is
+standardized (centered and scaled to unit length, with missing values set to the mean) so that the Pearson
+correlation of two profiles is their dot product. The standardized profiles are multiplied by a random Gaussian
+projection to give short sketches whose dot products approximate the correlations. A search scores every gene's
+sketch, keeps a shortlist of the best candidates and calculates exact correlations for the shortlist only.
+
+Sketches are only built from the Pearson standardization of the profiles so only Pearson searches can be
+approximated. Rank-based (Spearman) correlations can order genes quite differently, so their top results could be
+missing from a Pearson shortlist.
+
+The shortlist size controls the trade off between speed and recall (the fraction of the exact top results that
+are found). Use recall() or "python src/benchmark.py correlation" to measure it.
+"""
+
+import numpy as np
+
+import correlation
+
+# the kinds of correlation that can be approximated with the sketches
+APPROX_CORR_KINDS = ('pearson',)
+
+# the number of dimensions of each sketch
+SKETCH_DIM = 64
+
+# the projection is seeded so that it is the same in every process
+SKETCH_SEED = 0
+
+# the number of rows to sketch at once
+BLOCK_SIZE = 2048
+
+
+def standardize_rows(rows):
+    """
+    :param rows: a 2D float array which may contain NaNs
+    :return: the rows centered and scaled to unit length with NaNs replaced by 0 (the mean). Constant rows are
+             all 0
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centered = rows - np.nanmean(rows, axis=1)[:, np.newaxis]
+        centered[np.isnan(centered)] = 0.0
+        norms = np.sqrt((centered * centered).sum(axis=1))
+        standardized = centered / norms[:, np.newaxis]
+    standardized[~np.isfinite(standardized)] = 0.0
+
+    return standardized
+
+
+class CorrelationSketch(object):
+    """
+    Random projection sketches of every row of the ExpressionMatrix (in the same row order).
+    """
+
+    SNAPSHOT_NAME = 'correlation_sketch'
+
+    def __init__(self, projection, sketches):
+        """
+        :param projection: a float64 array with shape (sample count, sketch dimensions)
+        :type projection: numpy.ndarray
+        :param sketches: a float32 array with shape (gene count, sketch dimensions)
+        :type sketches: numpy.ndarray
+        """
+        self.projection = projection
+        self.sketches = sketches
+
+    @property
+    def nbytes(self):
+        return self.projection.nbytes + self.sketches.nbytes
+
+    def sketch(self, values):
+        """
+        :param values: a 1D float array with one value per sample which may contain NaNs
+        :return: the sketch of the values
+        """
+        return standardize_rows(values[np.newaxis, :]).dot(self.projection)[0].astype(np.float32)
+
+    def shortlist(self, values, candidate_count):
+        """
+        :param values: a 1D float array with one value per sample which may contain NaNs
+        :param candidate_count: the maximum number of candidates to return
+        :return: the sorted row indexes of the candidate_count rows with the highest absolute approximate
+                 correlation
+        """
+        scores = np.abs(self.sketches.dot(self.sketch(values)))
+        if candidate_count < len(scores):
+            return np.sort(np.argpartition(-scores, candidate_count - 1)[:candidate_count])
+
+        return np.arange(len(scores))
+
+    @classmethod
+    def from_matrix(cls, expr_matrix, dim=SKETCH_DIM, seed=SKETCH_SEED):
+        """
+        :param expr_matrix: the ExpressionMatrix to sketch
+        :param dim: the number of dimensions of each sketch
+        :param seed: the seed of the random projection
+        """
+        gene_count, sample_count = expr_matrix.shape
+        projection = np.random.RandomState(seed).standard_normal((sample_count, dim)) / np.sqrt(dim)
+        sketches = np.empty((gene_count, dim), dtype=np.float32)
+        for start, stop, block in expr_matrix.iter_blocks(BLOCK_SIZE):
+            sketches[start:stop] = standardize_rows(block).dot(projection)
+
+        return cls(projection, sketches)
+
+    @classmethod
+    def from_mongo(cls):
+        """
+        Sketch the expression matrix for the current dataset version (which is itself built from mongo or loaded
+        from its snapshot)
+        """
+        import dataset
+
+        return cls.from_matrix(dataset.get_expression_matrix())
+
+    def to_snapshot(self):
+        """
+        :return: the (arrays, metadata) tuple used by cache_snapshot.save_snapshot
+        """
+        return {'projection': self.projection, 'sketches': self.sketches}, {}
+
+    @classmethod
+    def from_snapshot(cls, arrays, metadata):
+        """
+        Rebuild the sketch from the (arrays, metadata) tuple returned by cache_snapshot.load_snapshot
+        """
+        return cls(arrays['projection'], arrays['sketches'])
+
+
+def approximate_top(search, expr_matrix, sketch, result_count, candidate_count):
+    """
+    Find the approximate top correlations for a prepared search by calculating exact correlations for a
+    shortlist of candidates only.
+
+    :param search: a CorrelationSearch over all samples (from correlation.prepare_search with result_id_kind
+                   "expression" and no sample mask)
+    :param expr_matrix: the ExpressionMatrix that the search was prepared with
+    :param sketch: the CorrelationSketch of expr_matrix
+    :param result_count: the maximum number of results to return
+    :param candidate_count: the number of candidates to shortlist. This is raised to result_count if it is lower
+    :return: a result dict (see CorrelationSearch.result). Searches whose corr_kind isn't in APPROX_CORR_KINDS
+             are exact
+    """
+    if search.search_values is None or result_count <= 0 or search.corr_kind not in APPROX_CORR_KINDS:
+        return search.top(result_count)
+
+    # one more candidate in case the search ID itself is shortlisted
+    indexes = sketch.shortlist(search.search_values, max(candidate_count, result_count) + 1)
+    shortlist_search = correlation.CorrelationSearch(
+        search.corr_kind,
+        search.search_values,
+        [expr_matrix.gene_ids[i] for i in indexes],
+        [expr_matrix.gene_symbols[i] for i in indexes],
+        correlation.ArrayRows(expr_matrix.rows(indexes)),
+        exclude_id=search.exclude_id)
+
+    return shortlist_search.top(result_count)
+
+
+def recall(approx_result, exact_result):
+    """
+    :return: the fraction of the IDs in the exact result that are also in the approximate result
+    """
+    if not exact_result['ids']:
+        return 1.0
+
+    return len(set(approx_result['ids']) & set(exact_result['ids'])) / float(len(exact_result['ids']))
@@ -0,0 +1,322 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scatter-gather correlation searches over genes. The genes of the expression matrix are split into contiguous
+shards and every shard is owned by a worker process that listens on a socket. A search sends the search vector to
+every worker, each worker finds the top correlations in its own shard and the results are merged.
+
+Each worker only loads its own shard's rows of the expression matrix (from the shard's cache snapshot if there is
+one) so the matrix is partitioned across the workers' memory. Workers must be configured with the same database as
+the web application. Run every shard's worker on the local machine with:
+
+    python src/correlation_workers.py --shards 4 --port 6001
+
+which listens on ports 6001 to 6004, or run a single shard (eg. on another host) with:
+
+    python src/correlation_workers.py --shards 4 --shard 2 --host 0.0.0.0 --port 6001
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from multiprocessing.connection import answer_challenge
+from multiprocessing.connection import deliver_challenge
+
+try:
+    from multiprocessing.connection import Connection
+except ImportError:
+    # python 2
+    from _multiprocessing import Connection
+
+import numpy as np
+
+import correlation
+import dataset
+from expression_matrix import ExpressionMatrix
+from expression_matrix import shard_bounds
+
+# the errors raised by a connection to a worker that is down, hung, not answering in time or using another key
+CONNECTION_ERRORS = (AuthenticationError, EOFError, IOError, OSError)
+
+
+class WorkerError(Exception):
+    """
+    Raised when a shard worker can't be reached, doesn't answer in time or fails to answer a search
+    """
+
+
+def _authkey(authkey):
+    if isinstance(authkey, bytes):
+        return authkey
+    return authkey.encode('utf-8')
+
+
+def _connect(address, authkey, timeout):
+    """
+    Connect to a worker like multiprocessing.connection.Client does but with a timeout on connecting and on every
+    send and recv on the connection (including the authentication handshake).
+
+    :param address: the (host, port) of the worker
+    :param authkey: the key that the worker was started with
+    :param timeout: the timeout in seconds. A call that times out raises an IOError or OSError
+    :return: the connection
+    """
+    sock = socket.create_connection(address, timeout)
+    try:
+        # the connection does blocking reads and writes on the socket's file descriptor so the timeouts are set on
+        # the socket itself (as a struct timeval) rather than with settimeout
+        sock.settimeout(None)
+        seconds = int(timeout)
+        timeval = struct.pack('ll', seconds, int((timeout - seconds) * 1000000))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+        conn = Connection(os.dup(sock.fileno()))
+    finally:
+        sock.close()
+
+    try:
+        answer_challenge(conn, authkey)
+        deliver_challenge(conn, authkey)
+    except BaseException:
+        conn.close()
+        raise
+
+    return conn
+
+
+class ShardWorker(object):
+    """
+    Answers top-K correlation requests for one shard of the genes of the current expression matrix.
+    """
+
+    def __init__(self, shard, shard_count):
+        self.shard = shard
+        self.shard_count = shard_count
+        self.matrix_cls = ExpressionMatrix.shard_class(shard, shard_count)
+
+    def get_expression_matrix(self):
+        """
+        :return: the matrix of the shard's genes for the current dataset version
+        """
+        return dataset.get_structure(self.matrix_cls)
+
+    def top(self, corr_kind, search_values, sample_mask, result_count, exclude_id):
+        """
+        :return: a dict with the worker's 'shard', 'shard_count', dataset 'version' and the top 'result' for
+                 the shard (see CorrelationSearch.result)
+        """
+        version = dataset.get_dataset_version()
+        expr_matrix = self.get_expression_matrix()
+        search = correlation.CorrelationSearch(
+            corr_kind,
+            search_values,
+            expr_matrix.gene_ids,
+            expr_matrix.gene_symbols,
+            expr_matrix,
+            sample_mask,
+            exclude_id)
+
+        return {
+            'shard': self.shard,
+            'shard_count': self.shard_count,
+            'version': version,
+            'result': search.top(result_count),
+        }
+
+    def handle(self, conn):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except CONNECTION_ERRORS:
+                    return
+
+                try:
+                    reply = ('ok', self.top(**request))
+                except Exception as e:
+                    reply = ('error', '{}: {}'.format(type(e).__name__, e))
+
+                try:
+                    conn.send(reply)
+                except CONNECTION_ERRORS:
+                    # the client gave up waiting
+                    return
+        finally:
+            conn.close()
+
+    def serve(self, address, authkey):
+        """
+        Accept connections forever, answering each connection's requests on its own thread.
+
+        :param address: the (host, port) to listen on
+        :param authkey: the key that clients must authenticate with
+        """
+        listener = Listener(address, authkey=_authkey(authkey))
+        print('shard {} of {} listening on {}:{}'.format(self.shard, self.shard_count, *address))
+        while True:
+            try:
+                conn = listener.accept()
+            except CONNECTION_ERRORS:
+                # a client that went away or used the wrong key during the handshake
+                continue
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+
+class ShardedCorrelation(object):
+    """
+    Sends correlation searches to the shard workers and merges their results.
+    """
+
+    def __init__(self, addresses, authkey, timeout=30.0):
+        """
+        :param addresses: the (host, port) address of every shard's worker
+        :param authkey: the key that the workers were started with
+        :param timeout: the seconds to wait for a worker to accept a connection and for each message from it
+        """
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey = _authkey(authkey)
+        self.timeout = timeout
+
+    def top(self, search, result_count, version):
+        """
+        Find the top correlations for a prepared search over the expression matrix's genes.
+
+        :param search: a CorrelationSearch (from correlation.prepare_search with result_id_kind "expression")
+        :param result_count: the maximum number of results to return
+        :param version: the dataset version that the search was prepared for
+        :return: the merged result (see CorrelationSearch.result) or None if the workers have loaded a
+                 different dataset version, in which case the search should be run locally
+        :raise WorkerError: if a worker can't be reached, doesn't answer in time or fails, in which case the search
+                            should also be run locally
+        """
+        if search.search_values is None or result_count <= 0:
+            return search.top(result_count)
+
+        request = {
+            'corr_kind': search.corr_kind,
+            'search_values': search.unmasked_search_values,
+            'sample_mask': search.sample_mask,
+            'result_count': result_count,
+            'exclude_id': search.exclude_id,
+        }
+
+        # send to every worker before waiting on any of them so that the shards are scanned in parallel
+        conns = []
+        address = None
+        try:
+            for address in self.addresses:
+                conns.append(_connect(address, self.authkey, self.timeout))
+            for address, conn in zip(self.addresses, conns):
+                conn.send(request)
+            replies = []
+            for address, conn in zip(self.addresses, conns):
+                status, reply = conn.recv()
+                if status != 'ok':
+                    raise WorkerError('correlation worker {}:{} failed: {}'.format(address[0], address[1], reply))
+                replies.append(reply)
+        except CONNECTION_ERRORS as e:
+            raise WorkerError('correlation worker {}:{} is unavailable: {}: {}'.format(
+                address[0], address[1], type(e).__name__, e))
+        finally:
+            for conn in conns:
+                conn.close()
+
+        if any(reply['version'] != version for reply in replies):
+            return None
+        shards = sorted(reply['shard'] for reply in replies)
+        if any(reply['shard_count'] != len(replies) for reply in replies) or shards != list(range(len(replies))):
+            raise WorkerError('the correlation workers do not cover every shard exactly once')
+
+        return merge_results([reply['result'] for reply in replies], result_count)
+
+
+def merge_results(results, result_count):
+    """
+    Merge correlation results (each ordered by descending absolute correlation) into a single result.
+
+    :param results: the results to merge
+    :param result_count: the maximum number of results to keep
+    :return: the merged result dict
+    """
+    ids = [result_id for result in results for result_id in result['ids']]
+    names = [name for result in results for name in result['names']]
+    corrs = np.array([corr for result in results for corr in result['correlations']])
+    order = np.argsort(-np.abs(corrs), kind='mergesort')[:result_count]
+
+    return {
+        'ids': [ids[i] for i in order],
+        'names': [names[i] for i in order],
+        'correlations': [float(corrs[i]) for i in order],
+        'total_count': len(order),
+    }
+
+
+def _serve_shard(shard, shard_count, address, authkey):
+    import cache_snapshot
+    import config
+    import mongodb_utils
+
+    mongodb_utils.connect(config.MONGO_SERVER, config.MONGO_PORT)
+    mongodb_utils.set_default_database(config.MONGO_DATABASE)
+    cache_snapshot.set_snapshot_dir(getattr(config, 'CACHE_SNAPSHOT_DIR', None), config.MONGO_DATABASE)
+
+    worker = ShardWorker(shard, shard_count)
+    worker.get_expression_matrix()
+    worker.serve(address, authkey)
+
+
+def main():
+    import config
+
+    parser = argparse.ArgumentParser(description='run correlation shard workers')
+    parser.add_argument('--shards', type=int, required=True, help='the total number of shards')
+    parser.add_argument(
+        '--shard',
+        type=int,
+        help='run only this shard (numbered from 0). By default a process is started for every shard with '
+             'consecutive port numbers')
+    parser.add_argument('--host', default='localhost', help='the interface to listen on')
+    parser.add_argument('--port', type=int, required=True, help='the port to listen on')
+    args = parser.parse_args()
+
+    authkey = config.CORRELATION_WORKER_AUTHKEY
+    if args.shard is not None:
+        _serve_shard(args.shard, args.shards, (args.host, args.port), authkey)
+    else:
+        processes = [
+            multiprocessing.Process(
+                target=_serve_shard,
+                args=(shard, args.shards, (args.host, args.port + shard), authkey))
+            for shard in range(args.shards)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Long-lived in-memory structures built from the imported dataset. Structures are built once per dataset version,
+either from a cache snapshot on disk or (if there is no valid snapshot) from mongo, in which case a new snapshot
+is written for the next worker that starts up.
+
+A structure class must provide:
+
+* SNAPSHOT_NAME: the name used for the structure's snapshot
+* from_mongo(): a classmethod which builds the structure from the database
+* to_snapshot(): returns an (arrays, metadata) tuple for cache_snapshot.save_snapshot
+* from_snapshot(arrays, metadata): a classmethod which rebuilds the structure from a snapshot
+* nbytes: a property giving the size of the structure's arrays in bytes (for memory accounting)
+
+and may optionally provide:
+
+* apply_changes(previous, changes): a classmethod which builds the structure for the new dataset version from the
+  structure built for a previous version and the merged changes recorded by the importer since then (a dict of
+  'genes', 'new_genes', 'samples' and 'new_samples' sets). It returns None if the structure should be rebuilt
+  from scratch instead
+"""
+
+import threading
+import time
+
+import cache_snapshot
+import correlation_sketch
+import mongodb_utils
+from expression_matrix import ExpressionMatrix
+from gene_intervals import GeneIntervalIndex
+from sample_index import SampleIndex
+
+VERSION_CHECK_INTERVAL = 5.0
+
+_LOCK = threading.RLock()
+_VERSION = None
+_VERSION_CHECKED = 0.0
+_STRUCTURES = {}
+
+
+def set_version_check_interval(seconds):
+    """
+    Set how often (in seconds) we ask mongo for the dataset version. Between checks the last seen version
+    is assumed to be current.
+
+    :param seconds: the check interval
+    :type seconds: float
+    """
+    global VERSION_CHECK_INTERVAL
+    VERSION_CHECK_INTERVAL = seconds
+
+
+def get_dataset_version():
+    """
+    Get the current dataset version.
+
+    :return: the dataset version
+    """
+    global _VERSION, _VERSION_CHECKED
+
+    with _LOCK:
+        now = time.time()
+        if _VERSION is None or now - _VERSION_CHECKED >= VERSION_CHECK_INTERVAL:
+            _VERSION = mongodb_utils.get_dataset_version()
+            _VERSION_CHECKED = now
+
+        return _VERSION
+
+
+def get_changes(since_version, version):
+    """
+    Merge the changes that the importer recorded between two dataset versions.
+
+    :param since_version: the dataset version that the changes are relative to
+    :param version: the dataset version to get changes up to
+    :return: a dict of 'genes', 'new_genes', 'samples' and 'new_samples' sets or None if the changes
+             were not all recorded or if one of the imports was a full import
+    """
+    changes = {'genes': set(), 'new_genes': set(), 'samples': set(), 'new_samples': set()}
+    expected_version = since_version + 1
+    for change_doc in mongodb_utils.get_dataset_changes(since_version):
+        if change_doc['version'] > version:
+            break
+        if change_doc['version'] != expected_version or change_doc.get('full'):
+            return None
+
+        for key, ids in changes.items():
+            ids.update(change_doc.get(key, []))
+        expected_version += 1
+
+    if expected_version != version + 1:
+        return None
+
+    return changes
+
+
+def get_structure(structure_cls):
+    """
+    Get the structure of the given class for the current dataset version, building it if needed.
+
+    :param structure_cls: the structure class
+    :return: the structure
+    """
+    with _LOCK:
+        version = get_dataset_version()
+        previous = _STRUCTURES.get(structure_cls.SNAPSHOT_NAME)
+        if previous is not None and previous[0] == version:
+            return previous[1]
+
+        structure = _load_structure(structure_cls, version, previous)
+        _STRUCTURES[structure_cls.SNAPSHOT_NAME] = (version, structure)
+
+        return structure
+
+
+def _load_structure(structure_cls, version, previous):
+    name = structure_cls.SNAPSHOT_NAME
+    snapshot = cache_snapshot.load_snapshot(name, version)
+    if snapshot is not None:
+        return structure_cls.from_snapshot(*snapshot)
+
+    structure = None
+    if hasattr(structure_cls, 'apply_changes'):
+        if previous is None:
+            previous_version = cache_snapshot.latest_snapshot_version(name, version)
+            if previous_version is not None:
+                previous_snapshot = cache_snapshot.load_snapshot(name, previous_version)
+                if previous_snapshot is not None:
+                    previous = previous_version, structure_cls.from_snapshot(*previous_snapshot)
+
+        if previous is not None and previous[0] < version:
+            changes = get_changes(previous[0], version)
+            if changes is not None:
+                structure = structure_cls.apply_changes(previous[1], changes)
+
+    if structure is None:
+        structure = structure_cls.from_mongo()
+
+    arrays, metadata = structure.to_snapshot()
+    cache_snapshot.save_snapshot(name, version, arrays, metadata)
+
+    return structure
+
+
+def structure_nbytes():
+    """
+    :return: a dict of the size in bytes of every structure that is loaded, keyed by snapshot name
+    """
+    with _LOCK:
+        return {name: structure.nbytes for name, (_, structure) in _STRUCTURES.items()}
+
+
+def get_expression_matrix():
+    """
+    :return: the ExpressionMatrix for the current dataset version
+    """
+    return get_structure(ExpressionMatrix)
+
+
+def get_sample_index():
+    """
+    :return: the SampleIndex for the current dataset version
+    """
+    return get_structure(SampleIndex)
+
+
+def get_gene_intervals():
+    """
+    :return: the GeneIntervalIndex for the current dataset version
+    """
+    return get_structure(GeneIntervalIndex)
+
+
+def get_correlation_sketch():
+    """
+    :return: the CorrelationSketch of the expression matrix for the current dataset version
+    """
+    return get_structure(correlation_sketch.CorrelationSketch)
+
+
+def warm():
+    """
+    Build (or load from snapshot) all of the structures for the current dataset version.
+    """
+    get_expression_matrix()
+    get_sample_index()
+    get_gene_intervals()
+    get_correlation_sketch()
+
+
+if __name__ == '__main__':
+    import config
+
+    mongodb_utils.connect(config.MONGO_SERVER, config.MONGO_PORT)
+    mongodb_utils.set_default_database(config.MONGO_DATABASE)
+    cache_snapshot.set_snapshot_dir(getattr(config, 'CACHE_SNAPSHOT_DIR', None), config.MONGO_DATABASE)
+
+    print('building caches for dataset version {}'.format(get_dataset_version()))
+    warm()
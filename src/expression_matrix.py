@@ -0,0 +1,337 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import scipy.sparse
+
+import mongodb_utils
+
+
+def shard_bounds(row_count, shard, shard_count):
+    """
+    :return: the (start, stop) rows of the given shard when the rows are split into shard_count contiguous shards
+    """
+    return row_count * shard // shard_count, row_count * (shard + 1) // shard_count
+
+
+class ExpressionMatrix(object):
+    """
+    An in-memory genes x samples matrix of expression values. Rows are ordered by gene ID and columns are ordered
+    by mouse ID (the same order used by the /expression/ route). Missing values are stored as NaN.
+
+    Datasets with sparse genes (see importdesnp.py) are held as a scipy CSR matrix whose implicit entries are 0
+    and whose missing values are explicit NaNs, unless so many values are stored that a dense array is smaller.
+    Either way rows are only ever handed out as dense float64 copies (see row, block and rows) so callers never
+    need to know which representation is in use.
+
+    A matrix can also hold just one contiguous shard of the genes (see shard_class) so that the correlation
+    workers only load the rows they search.
+    """
+
+    SNAPSHOT_NAME = 'expression_matrix'
+
+    # if more than this fraction of genes changed we rebuild the whole matrix rather than patching it
+    MAX_INCREMENTAL_FRACTION = 0.25
+
+    # sparse matrices are kept sparse unless more than this fraction of their values are stored (each stored
+    # value takes 12 bytes rather than 8)
+    MAX_SPARSE_DENSITY = 0.5
+
+    # the (shard, shard_count) of the genes held by the matrix or None for every gene
+    SHARD = None
+
+    def __init__(self, gene_ids, gene_symbols, mouse_ids, values):
+        """
+        :param gene_ids: the gene IDs in row order
+        :type gene_ids: list
+        :param gene_symbols: the gene symbols in row order
+        :type gene_symbols: list
+        :param mouse_ids: the mouse IDs in column order
+        :type mouse_ids: list
+        :param values: a float64 array or CSR matrix with shape (len(gene_ids), len(mouse_ids))
+        :type values: numpy.ndarray or scipy.sparse.csr_matrix
+        """
+        self.gene_ids = gene_ids
+        self.gene_symbols = gene_symbols
+        self.mouse_ids = mouse_ids
+        self.values = values
+        self.gene_indexes = {gene_id: i for i, gene_id in enumerate(gene_ids)}
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def is_sparse(self):
+        return scipy.sparse.issparse(self.values)
+
+    @property
+    def nbytes(self):
+        if self.is_sparse:
+            return self.values.data.nbytes + self.values.indices.nbytes + self.values.indptr.nbytes
+
+        return self.values.nbytes
+
+    @classmethod
+    def shard_class(cls, shard, shard_count):
+        """
+        :param shard: the shard (numbered from 0)
+        :param shard_count: the total number of shards
+        :return: a structure class (see dataset.py) for the matrix of the genes in the shard (see shard_bounds)
+        """
+        return type(cls.__name__ + 'Shard', (cls,), {
+            'SNAPSHOT_NAME': '{}_shard_{}_of_{}'.format(cls.SNAPSHOT_NAME, shard, shard_count),
+            'SHARD': (shard, shard_count),
+        })
+
+    @classmethod
+    def _get_genes(cls):
+        """
+        :return: a (genes, read_gene_ids) tuple of the gene documents of the matrix's rows and the gene IDs to read
+                 from the mouse documents (None to read every gene)
+        """
+        genes = mongodb_utils.get_genes(['ensembl_gene_id', 'gene_symbol', 'sparse'])
+        if cls.SHARD is None:
+            return genes, None
+
+        start, stop = shard_bounds(len(genes), *cls.SHARD)
+        genes = genes[start:stop]
+        return genes, [gene['ensembl_gene_id'] for gene in genes]
+
+    def _dense_copy(self, rows):
+        if self.is_sparse:
+            return rows.toarray().astype(np.float64, copy=False)
+
+        return np.array(rows, dtype=np.float64)
+
+    def gene_index(self, gene_id):
+        """
+        :param gene_id: the gene ID
+        :return: the row index of the gene or None if the gene is not in the matrix
+        """
+        return self.gene_indexes.get(gene_id)
+
+    def row(self, gene_id):
+        """
+        :param gene_id: the gene ID
+        :return: a float64 copy of the gene's expression values or None if the gene is not in the matrix
+        """
+        i = self.gene_index(gene_id)
+        if i is None:
+            return None
+
+        return self._dense_copy(self.values[i:i + 1])[0]
+
+    def block(self, start, stop):
+        """
+        :param start: the first row of the block
+        :param stop: one past the last row of the block
+        :return: a float64 copy of the rows in [start, stop)
+        """
+        return self._dense_copy(self.values[start:stop])
+
+    def rows(self, indexes):
+        """
+        :param indexes: an array of row indexes
+        :return: a float64 copy of the given rows (in the given order)
+        """
+        return self._dense_copy(self.values[indexes])
+
+    def iter_blocks(self, block_size):
+        """
+        Iterate over the matrix in blocks of rows.
+
+        :param block_size: the maximum number of rows per block
+        :return: a generator of (start, stop, block) tuples
+        """
+        for start in range(0, len(self.gene_ids), block_size):
+            stop = min(start + block_size, len(self.gene_ids))
+            yield start, stop, self.block(start, stop)
+
+    @classmethod
+    def from_mongo(cls):
+        """
+        Build the matrix by reading all genes (or the shard's genes) and all mouse expression data from mongo.
+        """
+        genes, read_gene_ids = cls._get_genes()
+        gene_ids = [gene['ensembl_gene_id'] for gene in genes]
+        gene_symbols = [gene.get('gene_symbol', '') for gene in genes]
+        gene_indexes = {gene_id: i for i, gene_id in enumerate(gene_ids)}
+
+        sparse_genes = np.array([bool(gene.get('sparse')) for gene in genes], dtype=bool)
+        if sparse_genes.any():
+            return cls._from_mongo_sparse(gene_ids, gene_symbols, gene_indexes, sparse_genes, read_gene_ids)
+
+        mouse_ids = []
+        columns = []
+        for mouse_id, expression_data in mongodb_utils.iter_mouse_expression(read_gene_ids):
+            column = np.empty(len(gene_ids), dtype=np.float64)
+            column.fill(np.nan)
+            for gene_id, value in expression_data.items():
+                i = gene_indexes.get(gene_id)
+                if i is not None:
+                    column[i] = value
+
+            mouse_ids.append(mouse_id)
+            columns.append(column)
+
+        if columns:
+            values = np.column_stack(columns)
+        else:
+            values = np.empty((len(gene_ids), 0), dtype=np.float64)
+
+        return cls(gene_ids, gene_symbols, mouse_ids, values)
+
+    @classmethod
+    def _from_mongo_sparse(cls, gene_ids, gene_symbols, gene_indexes, sparse_genes, read_gene_ids):
+        """
+        Build a matrix that has sparse genes from mongo without ever holding a dense copy of it.
+
+        :param sparse_genes: a boolean array that is True for the genes whose values that aren't stored are 0
+        :param read_gene_ids: the gene IDs to read from the mouse documents (None to read every gene)
+        """
+        mouse_ids = []
+        row_chunks, col_chunks, value_chunks = [], [], []
+        for j, (mouse_id, expression_data) in enumerate(mongodb_utils.iter_mouse_expression(read_gene_ids)):
+            mouse_ids.append(mouse_id)
+            stored = np.zeros(len(gene_ids), dtype=bool)
+            rows, values = [], []
+            for gene_id, value in expression_data.items():
+                i = gene_indexes.get(gene_id)
+                if i is not None:
+                    stored[i] = True
+                    if value != 0:
+                        rows.append(i)
+                        values.append(value)
+
+            # the dense genes' missing values have to be stored (as NaN) because the implicit value is 0
+            missing_rows = np.flatnonzero(~(stored | sparse_genes))
+            row_chunks.append(np.concatenate([np.array(rows, dtype=np.int64), missing_rows]))
+            missing_values = np.full(len(missing_rows), np.nan)
+            value_chunks.append(np.concatenate([np.array(values, dtype=np.float64), missing_values]))
+            col_chunks.append(np.full(len(rows) + len(missing_rows), j, dtype=np.int64))
+
+        shape = (len(gene_ids), len(mouse_ids))
+        if mouse_ids:
+            coordinates = (np.concatenate(row_chunks), np.concatenate(col_chunks))
+            values = scipy.sparse.csr_matrix((np.concatenate(value_chunks), coordinates), shape=shape)
+        else:
+            values = scipy.sparse.csr_matrix(shape, dtype=np.float64)
+
+        if shape[0] and shape[1] and values.nnz > cls.MAX_SPARSE_DENSITY * shape[0] * shape[1]:
+            values = values.toarray()
+
+        return cls(gene_ids, gene_symbols, mouse_ids, values)
+
+    @classmethod
+    def apply_changes(cls, previous, changes):
+        """
+        Build the matrix for a new dataset version by copying the unchanged values from the previous matrix and
+        only reading the changed genes and the new samples from mongo.
+
+        :param previous: the matrix built from the previous dataset version
+        :param changes: the changes recorded by the importer since the previous version
+        :return: the new matrix or None if so much changed that it should be rebuilt from scratch
+        """
+        genes, read_gene_ids = cls._get_genes()
+        gene_ids = [gene['ensembl_gene_id'] for gene in genes]
+        gene_symbols = [gene.get('gene_symbol', '') for gene in genes]
+        mouse_ids = mongodb_utils.get_mouse_ids()
+
+        # patching assumes that values that aren't stored are missing, so datasets with sparse genes are always
+        # rebuilt (which only reads the values that are stored)
+        if previous.is_sparse or any(gene.get('sparse') for gene in genes):
+            return None
+
+        # genes can move between shards as genes are added so any gene that the previous matrix didn't hold is read
+        changed_genes = set(
+            gene_id for gene_id in gene_ids
+            if gene_id in changes['genes'] or previous.gene_index(gene_id) is None)
+        new_samples = changes['new_samples']
+        if len(changed_genes) > cls.MAX_INCREMENTAL_FRACTION * len(gene_ids) or \
+                len(new_samples) > cls.MAX_INCREMENTAL_FRACTION * len(mouse_ids):
+            return None
+
+        values = np.empty((len(gene_ids), len(mouse_ids)), dtype=np.float64)
+        values.fill(np.nan)
+        matrix = cls(gene_ids, gene_symbols, mouse_ids, values)
+        mouse_indexes = {mouse_id: j for j, mouse_id in enumerate(mouse_ids)}
+
+        # copy over everything that didn't change
+        old_rows, new_rows = [], []
+        for i, gene_id in enumerate(gene_ids):
+            old_i = previous.gene_index(gene_id)
+            if old_i is not None and gene_id not in changed_genes:
+                old_rows.append(old_i)
+                new_rows.append(i)
+
+        old_cols, new_cols = [], []
+        for old_j, mouse_id in enumerate(previous.mouse_ids):
+            if mouse_id in mouse_indexes and mouse_id not in new_samples:
+                old_cols.append(old_j)
+                new_cols.append(mouse_indexes[mouse_id])
+
+        if new_rows and new_cols:
+            values[np.ix_(new_rows, new_cols)] = previous.values[np.ix_(old_rows, old_cols)]
+
+        # and read the rest from mongo
+        if changed_genes:
+            matrix._fill_from_mongo(mouse_indexes, gene_ids=sorted(changed_genes))
+        if new_samples:
+            matrix._fill_from_mongo(mouse_indexes, gene_ids=read_gene_ids, mouse_ids=sorted(new_samples))
+
+        return matrix
+
+    def _fill_from_mongo(self, mouse_indexes, gene_ids=None, mouse_ids=None):
+        for mouse_id, expression_data in mongodb_utils.iter_mouse_expression(gene_ids, mouse_ids):
+            j = mouse_indexes.get(mouse_id)
+            if j is None:
+                continue
+
+            for gene_id, value in expression_data.items():
+                i = self.gene_indexes.get(gene_id)
+                if i is not None:
+                    self.values[i, j] = value
+
+    def to_snapshot(self):
+        """
+        :return: the (arrays, metadata) tuple used by cache_snapshot.save_snapshot
+        """
+        metadata = {
+            'gene_ids': self.gene_ids,
+            'gene_symbols': self.gene_symbols,
+            'mouse_ids': self.mouse_ids,
+        }
+        if self.is_sparse:
+            metadata['shape'] = list(self.shape)
+            return {'data': self.values.data, 'indices': self.values.indices, 'indptr': self.values.indptr}, metadata
+
+        return {'values': self.values}, metadata
+
+    @classmethod
+    def from_snapshot(cls, arrays, metadata):
+        """
+        Rebuild the matrix from the (arrays, metadata) tuple returned by cache_snapshot.load_snapshot
+        """
+        if 'data' in arrays:
+            values = scipy.sparse.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(metadata['shape']))
+        else:
+            values = arrays['values']
+
+        return cls(metadata['gene_ids'], metadata['gene_symbols'], metadata['mouse_ids'], values)
@@ -0,0 +1,182 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An index of gene coordinates for finding the genes that overlap a genomic region. Genes are sorted by chromosome
+and then by start position. Because no gene on a chromosome is longer than that chromosome's longest gene, the
+genes that can overlap a region all start between (region start - longest gene length) and the region end, so a
+lookup is two binary searches followed by a check of the end positions of the genes in between.
+"""
+
+import numpy as np
+
+import mongodb_utils
+
+
+def normalize_chrom(chrom):
+    """
+    :return: the chromosome name without any "chr" prefix so that "chr7" and "7" are the same chromosome
+    """
+    chrom = str(chrom)
+    if chrom.lower().startswith('chr'):
+        chrom = chrom[3:]
+
+    return chrom
+
+
+class GeneIntervalIndex(object):
+    """
+    The coordinates of every gene ordered by chromosome and start position.
+    """
+
+    SNAPSHOT_NAME = 'gene_intervals'
+
+    def __init__(self, gene_ids, starts, ends, chrom_ranges, chrom_names, unlocated_chroms=None):
+        """
+        :param gene_ids: the gene IDs ordered by chromosome and start position
+        :type gene_ids: list
+        :param starts: an int64 array of gene start positions in gene_ids order
+        :type starts: numpy.ndarray
+        :param ends: an int64 array of gene end positions in gene_ids order
+        :type ends: numpy.ndarray
+        :param chrom_ranges: a dict of (normalized) chromosome name to [first index, one past the last index,
+                             length of the longest gene]
+        :type chrom_ranges: dict
+        :param chrom_names: a dict of (normalized) chromosome name to the name used in the imported annotation
+        :type chrom_names: dict
+        :param unlocated_chroms: a dict of gene ID to chromosome (as imported) for the genes that have a
+                                 chromosome but no start or end position
+        :type unlocated_chroms: dict
+        """
+        self.gene_ids = gene_ids
+        self.starts = starts
+        self.ends = ends
+        self.chrom_ranges = chrom_ranges
+        self.chrom_names = chrom_names
+        self.unlocated_chroms = unlocated_chroms or {}
+        self.gene_indexes = {gene_id: i for i, gene_id in enumerate(gene_ids)}
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.ends.nbytes
+
+    def overlapping(self, chrom, start, end):
+        """
+        Find the genes that overlap a region (including genes that only touch it).
+
+        :param chrom: the chromosome (with or without a "chr" prefix)
+        :param start: the first base pair of the region
+        :param end: the last base pair of the region
+        :return: an array of the index positions (into gene_ids) of the overlapping genes ordered by start position
+        """
+        chrom_range = self.chrom_ranges.get(normalize_chrom(chrom))
+        if chrom_range is None or end < start:
+            return np.empty(0, dtype=np.int64)
+
+        first, last, longest = chrom_range
+        starts = self.starts[first:last]
+        lo = np.searchsorted(starts, start - longest, side='left')
+        hi = np.searchsorted(starts, end, side='right')
+        candidates = np.arange(first + lo, first + hi)
+
+        return candidates[self.ends[candidates] >= start]
+
+    def location(self, gene_id):
+        """
+        :param gene_id: the gene ID
+        :return: the gene's (chromosome, start, end) or None if the gene has no coordinates. The chromosome is
+                 named as it was in the imported annotation
+        """
+        i = self.gene_indexes.get(gene_id)
+        if i is None:
+            return None
+
+        for chrom, (first, last, _) in self.chrom_ranges.items():
+            if first <= i < last:
+                return self.chrom_names[chrom], int(self.starts[i]), int(self.ends[i])
+
+    def chromosome(self, gene_id):
+        """
+        :param gene_id: the gene ID
+        :return: the gene's chromosome as named in the imported annotation (also for genes that have a chromosome
+                 but no positions) or None
+        """
+        location = self.location(gene_id)
+        if location is not None:
+            return location[0]
+
+        return self.unlocated_chroms.get(gene_id)
+
+    @classmethod
+    def from_genes(cls, genes):
+        """
+        :param genes: gene dicts with 'ensembl_gene_id', 'chrom', 'gene_start' and 'gene_end'. Genes without
+                      coordinates are skipped (but the chromosome of genes without positions is kept)
+        """
+        located = []
+        chrom_names = {}
+        unlocated_chroms = {}
+        for gene in genes:
+            if gene.get('chrom') in (None, ''):
+                continue
+            if gene.get('gene_start') is None or gene.get('gene_end') is None:
+                unlocated_chroms[gene['ensembl_gene_id']] = gene['chrom']
+                continue
+
+            chrom = normalize_chrom(gene['chrom'])
+            chrom_names.setdefault(chrom, gene['chrom'])
+            located.append((chrom, int(gene['gene_start']), int(gene['gene_end']), gene['ensembl_gene_id']))
+        located.sort()
+
+        gene_ids = [gene[3] for gene in located]
+        starts = np.array([gene[1] for gene in located], dtype=np.int64)
+        ends = np.array([gene[2] for gene in located], dtype=np.int64)
+        chrom_ranges = {}
+        for i, gene in enumerate(located):
+            chrom_range = chrom_ranges.setdefault(gene[0], [i, i, 0])
+            chrom_range[1] = i + 1
+            chrom_range[2] = max(chrom_range[2], int(ends[i] - starts[i]))
+
+        return cls(gene_ids, starts, ends, chrom_ranges, chrom_names, unlocated_chroms)
+
+    @classmethod
+    def from_mongo(cls):
+        """
+        Build the index from the gene annotation in mongo.
+        """
+        return cls.from_genes(mongodb_utils.get_genes(['ensembl_gene_id', 'chrom', 'gene_start', 'gene_end']))
+
+    def to_snapshot(self):
+        """
+        :return: the (arrays, metadata) tuple used by cache_snapshot.save_snapshot
+        """
+        return {'starts': self.starts, 'ends': self.ends}, {
+            'gene_ids': self.gene_ids,
+            'chrom_ranges': self.chrom_ranges,
+            'chrom_names': self.chrom_names,
+            'unlocated_chroms': self.unlocated_chroms,
+        }
+
+    @classmethod
+    def from_snapshot(cls, arrays, metadata):
+        """
+        Rebuild the index from the (arrays, metadata) tuple returned by cache_snapshot.load_snapshot
+        """
+        return cls(
+            metadata['gene_ids'], arrays['starts'], arrays['ends'], metadata['chrom_ranges'], metadata['chrom_names'],
+            metadata.get('unlocated_chroms'))
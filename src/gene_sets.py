@@ -0,0 +1,145 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-sample scores of gene sets (eg. pathways) so that a set can be plotted across the factors like a single gene.
+Two scores are calculated for every set and selected sample:
+
+* mean_z: the mean over the set's genes of each gene's value as a z-score over the selected samples
+* rank: the mean over the set's genes of each gene's rank among the selected samples, scaled to [0, 1] (ties
+  get their average rank). It is less sensitive to outlying values than mean_z
+
+Missing values are left out of the means. Any number of sets are scored together: the genes in any of the sets
+are read a block at a time (so only once however many sets they are in) and every set's sums are accumulated
+by multiplying the block by a sparse sets x genes membership matrix.
+"""
+
+import numpy as np
+import scipy.sparse
+
+import heatmap
+
+# the number of genes to read from the matrix at once
+BLOCK_SIZE = 2048
+
+SCORES = ('mean_z', 'rank')
+
+
+def row_ranks(values):
+    """
+    :param values: a 2D float array which may contain NaNs
+    :return: the rank of each value within its row scaled to [0, 1] (0 for the smallest value and 1 for the
+             largest, with ties given their average rank). NaNs are kept and rows with a single value are 0.5
+    """
+    row_count, col_count = values.shape
+    if col_count == 0:
+        return np.empty(values.shape)
+
+    # NaNs sort to the end of each row and every NaN is unequal to everything so they never tie
+    order = np.argsort(values, axis=1, kind='mergesort')
+    sorted_values = values[np.arange(row_count)[:, np.newaxis], order]
+    positions = np.broadcast_to(np.arange(col_count), values.shape)
+    with np.errstate(invalid='ignore'):
+        ties_previous = np.zeros(values.shape, dtype=bool)
+        ties_previous[:, 1:] = sorted_values[:, 1:] == sorted_values[:, :-1]
+    ties_next = np.zeros(values.shape, dtype=bool)
+    ties_next[:, :-1] = ties_previous[:, 1:]
+
+    # the first and last position of each value's run of ties
+    first = np.maximum.accumulate(np.where(ties_previous, 0, positions), axis=1)
+    last = np.minimum.accumulate(np.where(ties_next, col_count - 1, positions)[:, ::-1], axis=1)[:, ::-1]
+
+    present_counts = (~np.isnan(values)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = (first + last) / 2.0 / (present_counts - 1)[:, np.newaxis]
+    scaled[present_counts == 1] = 0.5
+
+    ranks = np.empty(values.shape)
+    ranks[np.arange(row_count)[:, np.newaxis], order] = scaled
+    ranks[np.isnan(values)] = np.nan
+
+    return ranks
+
+
+def membership_matrix(expr_matrix, gene_sets):
+    """
+    :param expr_matrix: the ExpressionMatrix
+    :param gene_sets: a list of lists of gene IDs
+    :return: a (membership, rows, missing) tuple of a sparse (sets, len(rows)) matrix that is 1 where a set
+             includes a gene, the sorted matrix rows of the genes in any of the sets and a list (one per set) of
+             the set's gene IDs that aren't in the matrix
+    """
+    set_indexes, row_indexes, missing = [], [], []
+    for set_index, gene_ids in enumerate(gene_sets):
+        set_rows = set()
+        set_missing = []
+        for gene_id in gene_ids:
+            row = expr_matrix.gene_index(gene_id)
+            if row is None:
+                set_missing.append(gene_id)
+            else:
+                set_rows.add(row)
+        set_indexes.extend([set_index] * len(set_rows))
+        row_indexes.extend(set_rows)
+        missing.append(set_missing)
+
+    rows, columns = np.unique(np.array(row_indexes, dtype=np.int64), return_inverse=True)
+    membership = scipy.sparse.csr_matrix(
+        (np.ones(len(columns)), (np.array(set_indexes, dtype=np.int64), columns)),
+        shape=(len(gene_sets), len(rows)))
+
+    return membership, rows, missing
+
+
+def score_gene_sets(expr_matrix, gene_sets, sample_mask, log=False):
+    """
+    Score gene sets in the selected samples.
+
+    :param expr_matrix: the ExpressionMatrix
+    :param gene_sets: a list of lists of gene IDs
+    :param sample_mask: a boolean mask of the samples to score
+    :param log: True to log2(x + 1) transform the values first
+    :return: a (scores, gene_counts, missing) tuple of a dict of each score name in SCORES to a (sets, samples)
+             array (NaN where a sample has no values for any of a set's genes), an array of the number of each
+             set's genes that are in the matrix and a list (one per set) of the set's gene IDs that aren't
+    """
+    membership, rows, missing = membership_matrix(expr_matrix, gene_sets)
+    sample_count = int(sample_mask.sum())
+    sums = {score: np.zeros((len(gene_sets), sample_count)) for score in SCORES}
+    value_counts = np.zeros((len(gene_sets), sample_count))
+
+    for start in range(0, len(rows), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(rows))
+        block = expr_matrix.rows(rows[start:stop])[:, sample_mask]
+        if log:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.log2(block + 1.0, out=block)
+            block[np.isinf(block)] = np.nan
+
+        present = ~np.isnan(block)
+        block_membership = membership[:, start:stop]
+        value_counts += block_membership.dot(present.astype(np.float64))
+        for score, scored in (('mean_z', heatmap.scale_rows(block)), ('rank', row_ranks(block))):
+            scored[~present] = 0.0
+            sums[score] += block_membership.dot(scored)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = {score: score_sums / value_counts for score, score_sums in sums.items()}
+    gene_counts = np.asarray(membership.sum(axis=1)).ravel().astype(int)
+
+    return scores, gene_counts, missing
@@ -0,0 +1,151 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Clustered heatmaps of a set of genes. Each gene's values are scaled to z-scores over the selected samples and
+the genes and samples are ordered by average linkage hierarchical clustering on correlation distance (the
+Euclidean distance between standardized profiles, with missing values at the mean).
+
+Clustering is the slow part, so the orders are cached under a hash of the exact values that were clustered:
+the same genes and samples give the same hash whatever route or request they came from, and a new dataset
+version that changes the values gives a new hash.
+
+Matrices are encoded compactly for the client (see encode_matrix): as one byte per value by default, which is
+plenty for a color scale, or as float32.
+"""
+
+import base64
+import hashlib
+
+import numpy as np
+from scipy.cluster import hierarchy
+
+# scaled values are clipped to this many standard deviations when they are encoded as bytes
+CLIP = 3.0
+
+# the byte used for missing values in the uint8 encoding. The other 255 bytes cover [-CLIP, CLIP]
+MISSING_BYTE = 255
+
+ENCODINGS = ('uint8', 'float32')
+
+
+def scale_rows(values):
+    """
+    :param values: a 2D float array which may contain NaNs
+    :return: the rows scaled to z-scores (mean 0 and standard deviation 1). NaNs are kept and constant rows
+             are all 0
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        present = ~np.isnan(values)
+        counts = present.sum(axis=1)
+        filled = np.where(present, values, 0.0)
+        means = filled.sum(axis=1) / counts
+        centered = np.where(present, values - means[:, np.newaxis], 0.0)
+        stds = np.sqrt((centered * centered).sum(axis=1) / counts)
+        scaled = centered / stds[:, np.newaxis]
+    scaled[~np.isfinite(scaled)] = 0.0
+    scaled[~present] = np.nan
+
+    return scaled
+
+
+def _cluster_order(rows):
+    """
+    :param rows: a 2D float array without NaNs
+    :return: an int array of the row order given by average linkage clustering on correlation distance
+    """
+    if len(rows) < 3:
+        return np.arange(len(rows))
+
+    # rows scaled to unit length are as far apart in Euclidean distance as they are in correlation distance
+    # (up to a monotonic transform which doesn't change the clustering order)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centered = rows - rows.mean(axis=1)[:, np.newaxis]
+        unit = centered / np.sqrt((centered * centered).sum(axis=1))[:, np.newaxis]
+    unit[~np.isfinite(unit)] = 0.0
+
+    return hierarchy.leaves_list(hierarchy.linkage(unit, method='average', metric='euclidean'))
+
+
+def cluster_orders(scaled, cache=None):
+    """
+    Cluster the genes and the samples of a scaled matrix.
+
+    :param scaled: the matrix returned by scale_rows
+    :param cache: an optional ResultCache that the orders are cached in under a hash of the matrix
+    :return: a (gene order, sample order) tuple of int arrays
+    """
+    filled = np.ascontiguousarray(np.nan_to_num(scaled), dtype=np.float64)
+    key = hashlib.sha1(filled.tobytes() + str(filled.shape).encode('utf-8')).hexdigest()
+
+    def compute():
+        return _cluster_order(filled), _cluster_order(filled.T)
+
+    if cache is None:
+        return compute()
+
+    return cache.get_or_compute(key, compute)
+
+
+def encode_matrix(scaled, encoding='uint8'):
+    """
+    Encode a scaled matrix compactly.
+
+    :param scaled: the matrix returned by scale_rows
+    :param encoding: "uint8" to quantize the values clipped to [-CLIP, CLIP] into bytes 0 to 254 with
+                     MISSING_BYTE for missing values, or "float32" for little-endian float32 values with NaN for
+                     missing values
+    :return: a dict of the 'encoding', the 'shape' and the base64 encoded row-major 'values' (plus 'clip' and
+             'missing' for uint8)
+    """
+    if encoding == 'uint8':
+        steps = MISSING_BYTE - 1
+        with np.errstate(invalid='ignore'):
+            quantized = np.round((np.clip(scaled, -CLIP, CLIP) + CLIP) * (steps / (2 * CLIP)))
+        quantized[np.isnan(scaled)] = MISSING_BYTE
+        data = quantized.astype(np.uint8)
+        encoded = {'clip': CLIP, 'missing': MISSING_BYTE}
+    elif encoding == 'float32':
+        data = scaled.astype('<f4')
+        encoded = {}
+    else:
+        raise ValueError('"{}" encoding is not supported'.format(encoding))
+
+    encoded.update(
+        encoding=encoding,
+        shape=list(scaled.shape),
+        values=base64.b64encode(np.ascontiguousarray(data).tobytes()).decode('ascii'))
+
+    return encoded
+
+
+def decode_matrix(encoded):
+    """
+    Decode a matrix encoded by encode_matrix (uint8 values come back as the values of their quantization steps).
+
+    :return: a 2D float array with NaN for missing values
+    """
+    data = base64.b64decode(encoded['values'])
+    if encoded['encoding'] == 'uint8':
+        quantized = np.frombuffer(data, dtype=np.uint8).reshape(encoded['shape'])
+        steps = encoded['missing'] - 1
+        values = quantized * (2 * encoded['clip'] / steps) - encoded['clip']
+        values[quantized == encoded['missing']] = np.nan
+        return values
+
+    return np.frombuffer(data, dtype='<f4').reshape(encoded['shape']).astype(np.float64)
@@ -18,7 +18,14 @@
 
 import argparse
 import csv
+import gzip
+import io
+import math
+
 import pymongo
+import scipy.io
+
+import catalog
 import config
 
 SAMPLE_ID_HEADER = 'SampleID'
@@ -31,6 +38,59 @@ CHR_HEADER = 'Chr'
 START_POS_HEADER = 'Start'
 END_POS_HEADER = 'End'
 
+# the number of intensity rows that are compared against the database and written at once
+IMPORT_CHUNK_SIZE = 1000
+
+# change sets larger than this are recorded as a full change rather than listing every ID
+MAX_RECORDED_CHANGES = 100000
+
+
+def open_input(path):
+    """
+    Open a tab-separated input file for csv.reader. Files ending in ".gz" are decompressed as they are read.
+    """
+    if path.endswith('.gz'):
+        handle = gzip.open(path, 'rb')
+        return handle if str is bytes else io.TextIOWrapper(handle, newline='')
+
+    return open(path, 'rU') if str is bytes else open(path, newline='')
+
+
+def iter_matrix_market_rows(matrix_path, annotation_table, all_mouse_ids):
+    """
+    Read a Matrix Market matrix of genes (rows) x samples (columns), eg. sparse RNA-seq counts, into intensity
+    row dicts. Only the sparse entries are read into memory and each row dict only holds the gene's non-zero
+    values.
+
+    :param matrix_path: the matrix file (which may be gzip-compressed)
+    :param annotation_table: a csv.reader of the gene annotation table with a header row and then a row per gene
+                             in matrix row order
+    :param all_mouse_ids: the mouse IDs from the design file in matrix column order
+    :return: a generator of intensity row dicts
+    """
+    matrix = scipy.io.mmread(matrix_path).tocsr()
+    matrix.eliminate_zeros()
+    if matrix.shape[1] != len(all_mouse_ids):
+        raise ValueError('the matrix has {} columns but the design file has {} samples'.format(
+            matrix.shape[1], len(all_mouse_ids)))
+
+    annotation_header = next(annotation_table)
+    gene_count = 0
+    for i, annotation_row in enumerate(annotation_table):
+        if i >= matrix.shape[0]:
+            raise ValueError('the annotation file has more genes than the matrix has rows')
+
+        row_dict = dict(zip(annotation_header, annotation_row))
+        start, stop = matrix.indptr[i], matrix.indptr[i + 1]
+        for j, value in zip(matrix.indices[start:stop], matrix.data[start:stop]):
+            row_dict[all_mouse_ids[j]] = float(value)
+        gene_count += 1
+        yield row_dict
+
+    if gene_count != matrix.shape[0]:
+        raise ValueError('the matrix has {} rows but the annotation file has {} genes'.format(
+            matrix.shape[0], gene_count))
+
 
 def get_db():
     client = pymongo.MongoClient(config.MONGO_SERVER, config.MONGO_PORT)
@@ -43,12 +103,220 @@ def get_db():
 def init_db(db):
     db.mouse.create_index('mouse_id', unique=True)
     db.genes.create_index('ensembl_gene_id', unique=True)
+    db.dataset_changes.create_index('version', unique=True)
+
+
+def bump_dataset_version(db):
+    """
+    Increment the dataset version so that caches built from the previous version of the data are invalidated
+    """
+    version = db.dataset.find_one_and_update(
+        {'_id': 'version'},
+        {'$inc': {'version': 1}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER)
+
+    return version['version']
+
+
+def record_changes(db, version, changes, full):
+    """
+    Record what changed in the given dataset version so that caches and indexes built from the previous version
+    can be refreshed incrementally rather than being rebuilt.
+
+    :param db: the database
+    :param version: the new dataset version
+    :param changes: a dict of ID sets. 'genes' holds genes whose annotation or values for existing samples changed,
+                    'samples' holds samples whose factors or values changed and 'new_genes' and 'new_samples'
+                    hold the IDs that were added
+    :param full: True if every gene and sample should be considered changed (eg. for a fresh import)
+    """
+    full = full or any(len(ids) > MAX_RECORDED_CHANGES for ids in changes.values())
+    change_doc = {'version': version, 'full': full}
+    if not full:
+        for key, ids in changes.items():
+            change_doc[key] = sorted(ids)
+
+    db.dataset_changes.insert_one(change_doc)
+
+
+def import_design(db, design_file_handle):
+    """
+    Add new samples from the design file and update the factors of any existing samples that have changed.
+
+    :param db: the database
+    :param design_file_handle: the tab-separated design file
+    :return: a tuple of the list of mouse IDs in the design file, the set of new mouse IDs, the set of mouse
+             IDs whose factors were added or changed and the list of factor IDs in the design file
+    """
+    design_table = csv.reader(design_file_handle, delimiter='\t')
+    design_header = next(design_table)
+    factor_ids = [header for header in design_header if header != SAMPLE_ID_HEADER]
+
+    existing_factors = {
+        mouse['mouse_id']: mouse.get('factors')
+        for mouse in db.mouse.find({}, {'mouse_id': 1, 'factors': 1, '_id': 0})
+    }
+
+    all_mouse_ids = []
+    mouse_requests = []
+    new_samples = set()
+    changed_samples = set()
+    for design_row in design_table:
+        row_dict = dict(zip(design_header, design_row))
+        mouse_id = row_dict[SAMPLE_ID_HEADER]
+        del row_dict[SAMPLE_ID_HEADER]
+        all_mouse_ids.append(mouse_id)
+
+        if mouse_id not in existing_factors:
+            new_samples.add(mouse_id)
+        elif existing_factors[mouse_id] == row_dict:
+            continue
+
+        changed_samples.add(mouse_id)
+        mouse_requests.append(pymongo.UpdateOne(
+            {'mouse_id': mouse_id},
+            {'$set': {'factors': row_dict}},
+            upsert=True))
+
+    if mouse_requests:
+        db.mouse.bulk_write(mouse_requests, ordered=False)
+
+    return all_mouse_ids, new_samples, changed_samples, factor_ids
+
+
+def _parse_position(position):
+    """
+    :return: the integer gene coordinate or None if it is empty (for genes without coordinates)
+    """
+    position = position.strip()
+    return int(position) if position else None
+
+
+def _same_value(value, existing_value):
+    """
+    :param value: the imported value
+    :param existing_value: the value in the database or None if there isn't one
+    :return: True if the values are the same. Missing values (NaNs) are the same as each other
+    """
+    if existing_value is None:
+        return False
+
+    return existing_value == value or (math.isnan(value) and math.isnan(existing_value))
+
+
+def import_intensities_chunk(db, rows, all_mouse_ids, changes, sparse=False):
+    """
+    Write the genes and expression values from a chunk of intensity rows that differ from what is already in the
+    database.
+
+    Genes imported from sparse data are marked as sparse and only their non-zero values are stored: readers
+    treat a sparse gene's missing expression_data entries as 0 rather than as missing.
+
+    :param db: the database
+    :param rows: a list of intensity row dicts
+    :param all_mouse_ids: the mouse IDs from the design file
+    :param changes: the dict of change sets to update
+    :param sparse: True if the rows only hold the non-zero values (the other samples' values are 0)
+    """
+    gene_ids = [row_dict[GENE_ID_HEADER] for row_dict in rows]
+
+    existing_genes = {
+        gene['ensembl_gene_id']: gene
+        for gene in db.genes.find({'ensembl_gene_id': {'$in': gene_ids}}, {'_id': 0})
+    }
+
+    # only pull back the expression values for the genes in this chunk
+    expr_fields = {'expression_data.' + gene_id: 1 for gene_id in gene_ids}
+    expr_fields['mouse_id'] = 1
+    existing_values = {
+        mouse['mouse_id']: mouse.get('expression_data', {})
+        for mouse in db.mouse.find({'mouse_id': {'$in': all_mouse_ids}}, expr_fields)
+    }
+
+    gene_requests = []
+    mouse_sets = {}
+    mouse_unsets = {}
+    count_changes = {}
+    for row_dict in rows:
+        gene_id = row_dict[GENE_ID_HEADER]
+        gene = {
+            'ensembl_gene_id': gene_id,
+            'gene_symbol': row_dict[GENE_SYMBOL_HEADER],
+            'chrom': row_dict[CHR_HEADER],
+            'gene_start': _parse_position(row_dict[START_POS_HEADER]),
+            'gene_end': _parse_position(row_dict[END_POS_HEADER]),
+        }
+        if sparse:
+            gene['sparse'] = True
+        if gene_id not in existing_genes:
+            changes['new_genes'].add(gene_id)
+        if existing_genes.get(gene_id) != gene:
+            changes['genes'].add(gene_id)
+            update = {'$set': gene}
+            if not sparse:
+                update['$unset'] = {'sparse': ''}
+            gene_requests.append(pymongo.UpdateOne({'ensembl_gene_id': gene_id}, update, upsert=True))
+
+        # when a gene switches between sparse and dense storage every value is rewritten so that the values
+        # that weren't stored keep their meaning
+        was_sparse = bool(existing_genes.get(gene_id, {}).get('sparse'))
+        storage_changed = was_sparse != sparse
+        for mouse_id in all_mouse_ids:
+            value = float(row_dict.get(mouse_id, 0.0) if sparse else row_dict[mouse_id])
+            stored_values = existing_values.get(mouse_id, {})
+            existing_value = stored_values.get(gene_id, 0.0 if was_sparse else None)
+            count_change = catalog.is_present(value) - catalog.is_present(existing_value)
+            if count_change:
+                count_changes[gene_id] = count_changes.get(gene_id, 0) + count_change
+            if not _same_value(value, existing_value):
+                # values for new samples are implied by the sample being new so we don't mark every gene
+                # as changed when samples are added
+                if mouse_id not in changes['new_samples']:
+                    changes['genes'].add(gene_id)
+                changes['samples'].add(mouse_id)
+            elif not storage_changed:
+                continue
+
+            if sparse and value == 0.0:
+                if gene_id in stored_values:
+                    mouse_unsets.setdefault(mouse_id, {})['expression_data.' + gene_id] = ''
+            else:
+                mouse_sets.setdefault(mouse_id, {})['expression_data.' + gene_id] = value
+
+    if gene_requests:
+        db.genes.bulk_write(gene_requests, ordered=False)
+
+    mouse_requests = []
+    for mouse_id in set(mouse_sets) | set(mouse_unsets):
+        update = {}
+        if mouse_id in mouse_sets:
+            update['$set'] = mouse_sets[mouse_id]
+        if mouse_id in mouse_unsets:
+            update['$unset'] = mouse_unsets[mouse_id]
+        mouse_requests.append(pymongo.UpdateOne({'mouse_id': mouse_id}, update))
+    if mouse_requests:
+        db.mouse.bulk_write(mouse_requests, ordered=False)
+
+    catalog.update_value_counts(db, count_changes, [gene_id for gene_id in gene_ids if gene_id not in existing_genes])
 
 
 def main():
 
     # parse command line arguments
     parser = argparse.ArgumentParser(description='import data into')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='add to (rather than create) the dataset. New samples and genes are added and only values that '
+             'differ from the ones already in the database are written')
+    parser.add_argument(
+        '--matrix-market',
+        metavar='MATRIX_FILE',
+        help='read the values from this Matrix Market file of genes (rows) x samples (columns), eg. sparse '
+             'counts, rather than from the intensities file. The intensities file then only holds the gene '
+             'annotation columns with a row per matrix row and the design file lists the samples in matrix '
+             'column order. Only non-zero values are stored')
     parser.add_argument(
         'design_file',
         help='the tab-separated design file')
@@ -58,53 +326,54 @@ def main():
              'probe IDs and annotation')
     args = parser.parse_args()
 
-    with open(args.design_file, 'rU') as design_file_handle, \
-         open(args.intensities_file, 'rU') as intensities_file_handle:
+    # any of the input files can be gzip-compressed (named *.gz)
+    with open_input(args.design_file) as design_file_handle, \
+         open_input(args.intensities_file) as intensities_file_handle:
 
         db = get_db()
+        if not args.incremental and db.mouse.find_one():
+            parser.error('the database already contains samples. Use --incremental to add to it')
 
-        design_table = csv.reader(design_file_handle, delimiter='\t')
-        design_header = next(design_table)
-        all_mouse_ids = set()
-        for design_row in design_table:
-            row_dict = dict(zip(design_header, design_row))
-            mouse_id = row_dict[SAMPLE_ID_HEADER]
-            del row_dict[SAMPLE_ID_HEADER]
-            all_mouse_ids.add(mouse_id)
-            sample = {
-                'mouse_id': mouse_id,
-                'factors': row_dict,
-            }
-
-            db.mouse.insert_one(sample)
+        all_mouse_ids, new_samples, changed_samples, factor_ids = import_design(db, design_file_handle)
+        changes = {
+            'genes': set(),
+            'new_genes': set(),
+            'samples': changed_samples,
+            'new_samples': new_samples,
+        }
 
         intensities_table = csv.reader(intensities_file_handle, delimiter='\t')
-        intensities_header = next(intensities_table)
-        genes_bulk = db.genes.initialize_unordered_bulk_op()
-        mouse_bulk = db.mouse.initialize_unordered_bulk_op()
-        for i, intensities_row in enumerate(intensities_table):
+        if args.matrix_market:
+            row_dicts = iter_matrix_market_rows(args.matrix_market, intensities_table, all_mouse_ids)
+        else:
+            intensities_header = next(intensities_table)
+            row_dicts = (dict(zip(intensities_header, intensities_row)) for intensities_row in intensities_table)
+
+        sparse = bool(args.matrix_market)
+        rows = []
+        for i, row_dict in enumerate(row_dicts):
             if i % 1000 == 0:
                 print('processing {}th row from intensities files'.format(i))
 
-            row_dict = dict(zip(intensities_header, intensities_row))
-            gene_id = row_dict[GENE_ID_HEADER]
-            #db.genes.insert_one({
-            genes_bulk.insert({
-                'ensembl_gene_id': gene_id,
-                'gene_symbol': row_dict[GENE_SYMBOL_HEADER],
-                'chrom': row_dict[CHR_HEADER],
-                'gene_start': int(row_dict[START_POS_HEADER]),
-                'gene_end': int(row_dict[END_POS_HEADER]),
-            })
-            for mouse_id in all_mouse_ids:
-                #db.mouse.update_one(
-                mouse_bulk.find({'mouse_id': mouse_id}).update(
-                    {'$set': {'expression_data.' + gene_id: float(row_dict[mouse_id])}}
-                )
-        print('processing bulk update for genes')
-        genes_bulk.execute()
-        print('processing bulk update for mice')
-        mouse_bulk.execute()
+            rows.append(row_dict)
+            if len(rows) == IMPORT_CHUNK_SIZE:
+                import_intensities_chunk(db, rows, all_mouse_ids, changes, sparse)
+                rows = []
+
+        if rows:
+            import_intensities_chunk(db, rows, all_mouse_ids, changes, sparse)
+
+        if not any(changes.values()):
+            print('no changes found, dataset version is unchanged')
+            return
+
+        print('{} genes and {} samples changed ({} new genes, {} new samples)'.format(
+            len(changes['genes']), len(changes['samples']), len(changes['new_genes']), len(changes['new_samples'])))
+
+        version = bump_dataset_version(db)
+        record_changes(db, version, changes, full=not args.incremental)
+        catalog.update_summary(db, version, factor_ids)
+        print('dataset version is now {}'.format(version))
 
 
 if __name__ == '__main__':
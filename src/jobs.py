@@ -0,0 +1,350 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local job queue for analyses that take too long to run inside of a request. Jobs are run in a bounded number of
+forked worker processes. No broker is needed: the queue and finished results live in the web server process.
+
+Every job kind is registered with two functions:
+
+* prepare(params) is called in the server process just before the job starts (without holding the job manager's
+  lock, so it may take a while). It should do everything that needs the database or the in-memory caches (eg.
+  reading the expression matrix) and return what run needs. It may raise ValueError if the parameters are bad
+* run(prepared, progress) is called in the forked worker process. It should only compute (no database access)
+  and can call progress(fraction) to report how far along it is. Its return value is the job's result and must
+  be picklable
+
+Every job gets a freshly forked process rather than a slot in a pool of long-lived workers: the fork hands the
+prepared data (often the whole expression matrix) to the job copy-on-write rather than pickling it over a pipe,
+it always sees the current dataset version and a job is cancelled by terminating its process. At most
+max_workers processes are forked at once. Only the forking thread exists in the child so run must not rely on
+locks that other server threads may have held.
+"""
+
+import collections
+import json
+import multiprocessing
+import threading
+import time
+import traceback
+import uuid
+
+QUEUED = 'queued'
+STARTING = 'starting'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+# how often (in seconds) the dispatcher checks on running jobs
+POLL_INTERVAL = 0.05
+
+# the number of recent run times that stats are reported over
+RUN_TIME_HISTORY = 100
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job(object):
+    """
+    A submitted job. Only the JobManager should change a job's attributes.
+    """
+
+    def __init__(self, kind, params, key):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.key = key
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._progress = multiprocessing.Value('d', 0.0, lock=False)
+        self._process = None
+        self._conn = None
+
+    @property
+    def progress(self):
+        if self.status == DONE:
+            return 1.0
+        return self._progress.value
+
+    @property
+    def run_time(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        """
+        :return: a JSON-friendly dict of the job's state (not including the result)
+        """
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'progress': self.progress,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'run_time': self.run_time,
+            'error': self.error,
+        }
+
+
+def _run_in_worker(run, prepared, progress_value, conn):
+    def progress(fraction):
+        progress_value.value = fraction
+
+    try:
+        conn.send(('done', run(prepared, progress)))
+    except Exception:
+        conn.send(('failed', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class JobManager(object):
+    """
+    Queues jobs and runs at most max_workers of them at once in forked worker processes. Jobs with the same kind
+    and parameters (and dataset version) are deduplicated: submitting one while an identical job is queued,
+    running or finished (and not expired) returns the existing job.
+    """
+
+    def __init__(self, max_workers, max_queued, result_ttl):
+        """
+        :param max_workers: the maximum number of jobs that run at once
+        :param max_queued: the maximum number of jobs waiting to run. Submitting past this raises JobQueueFull
+        :param result_ttl: the number of seconds that a finished job (and its result) is kept for
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._kinds = {}
+        self._jobs = {}
+        self._job_ids_by_key = {}
+        self._queue = collections.deque()
+        self._running = []
+        self._counts = collections.Counter()
+        self._run_times = collections.deque(maxlen=RUN_TIME_HISTORY)
+        self._wait_times = collections.deque(maxlen=RUN_TIME_HISTORY)
+        self._lock = threading.Condition()
+        self._dispatcher = None
+
+    def register(self, kind, prepare, run):
+        """
+        Register a kind of job (see the module documentation).
+
+        :param kind: the name that jobs of this kind are submitted with
+        :param prepare: the function that is called with the job's parameters in the server process
+        :param run: the function that is called in the worker process
+        """
+        self._kinds[kind] = (prepare, run)
+
+    def submit(self, kind, params, version=None):
+        """
+        Submit a job or find an identical one that has already been submitted.
+
+        :param kind: a registered job kind
+        :param params: a JSON-serializable dict of parameters
+        :param version: the dataset version that the job runs against. Jobs for different versions are never
+                        deduplicated
+        :return: the Job
+        """
+        if kind not in self._kinds:
+            raise ValueError('"{}" is not a known job kind'.format(kind))
+
+        key = json.dumps([kind, params, version], sort_keys=True)
+        with self._lock:
+            existing_id = self._job_ids_by_key.get(key)
+            if existing_id is not None:
+                self._counts['deduplicated'] += 1
+                return self._jobs[existing_id]
+
+            if len(self._queue) >= self.max_queued:
+                self._counts['rejected'] += 1
+                raise JobQueueFull('the job queue is full ({} jobs)'.format(len(self._queue)))
+
+            job = Job(kind, params, key)
+            self._jobs[job.id] = job
+            self._job_ids_by_key[key] = job.id
+            self._queue.append(job)
+            self._counts['submitted'] += 1
+
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='job-dispatcher')
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+            self._lock.notify()
+
+            return job
+
+    def get(self, job_id):
+        """
+        :param job_id: the job ID
+        :return: the Job or None if there is no such job (or it expired)
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job. Running jobs have their worker process terminated.
+
+        :param job_id: the job ID
+        :return: the Job or None if there is no such job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+
+            if job.status == QUEUED:
+                self._queue.remove(job)
+            elif job.status == RUNNING:
+                self._running.remove(job)
+                job._process.terminate()
+                job._process.join()
+                job._conn.close()
+            self._finish(job, CANCELLED)
+
+            return job
+
+    def stats(self):
+        """
+        :return: a dict of queue depth, job counts and run time statistics
+        """
+        with self._lock:
+            status_counts = collections.Counter(job.status for job in self._jobs.values())
+            return {
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+                'result_ttl': self.result_ttl,
+                'queue_depth': len(self._queue),
+                'running': len(self._running),
+                'jobs': dict(status_counts),
+                'totals': dict(self._counts),
+                'run_time': _time_stats(self._run_times),
+                'wait_time': _time_stats(self._wait_times),
+            }
+
+    def _finish(self, job, status, result=None, error=None):
+        job.status = status
+        job.finished = time.time()
+        job.result = result
+        job.error = error
+        job._process = None
+        job._conn = None
+        self._counts[status] += 1
+        if job.started is not None and status == DONE:
+            self._run_times.append(job.finished - job.started)
+
+        # failed and cancelled jobs can be resubmitted
+        if status != DONE and self._job_ids_by_key.get(job.key) == job.id:
+            del self._job_ids_by_key[job.key]
+
+    def _fork(self, job, prepared):
+        _, run = self._kinds[job.kind]
+        job._conn, child_conn = multiprocessing.Pipe(duplex=False)
+        job._process = multiprocessing.Process(
+            target=_run_in_worker,
+            args=(run, prepared, job._progress, child_conn),
+            name='job-{}'.format(job.id))
+        job._process.daemon = True
+        job._process.start()
+        child_conn.close()
+        job.status = RUNNING
+        self._running.append(job)
+
+    def _check_running(self):
+        for job in list(self._running):
+            # check is_alive before polling so that a result sent just before the worker exits isn't missed
+            alive = job._process.is_alive()
+            if job._conn.poll():
+                try:
+                    outcome, value = job._conn.recv()
+                except EOFError:
+                    outcome, value = FAILED, 'the worker process exited without a result'
+                job._process.join()
+                job._conn.close()
+                self._running.remove(job)
+                if outcome == 'done':
+                    self._finish(job, DONE, result=value)
+                else:
+                    self._finish(job, FAILED, error=value)
+            elif not alive:
+                self._running.remove(job)
+                self._finish(job, FAILED, error='the worker process exited with code {}'.format(
+                    job._process.exitcode))
+
+    def _expire(self):
+        now = time.time()
+        for job in list(self._jobs.values()):
+            if job.status in FINISHED_STATUSES and now - job.finished > self.result_ttl:
+                del self._jobs[job.id]
+                if self._job_ids_by_key.get(job.key) == job.id:
+                    del self._job_ids_by_key[job.key]
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                self._check_running()
+                self._expire()
+                if not self._queue or len(self._running) >= self.max_workers:
+                    self._lock.wait(POLL_INTERVAL)
+                    continue
+
+                job = self._queue.popleft()
+                job.status = STARTING
+                job.started = time.time()
+                self._wait_times.append(job.started - job.submitted)
+
+            # prepare can take as long as building the expression matrix so it's called without the lock to keep
+            # submit, get, stats and cancel responsive. A job cancelled meanwhile is left unstarted
+            prepare, _ = self._kinds[job.kind]
+            try:
+                prepared, error = prepare(job.params), None
+            except Exception:
+                prepared, error = None, traceback.format_exc()
+
+            with self._lock:
+                if job.status == CANCELLED:
+                    continue
+                if error is not None:
+                    self._finish(job, FAILED, error=error)
+                else:
+                    self._fork(job, prepared)
+
+
+def _time_stats(times):
+    if not times:
+        return {'count': 0, 'mean': None, 'max': None, 'last': None}
+
+    return {
+        'count': len(times),
+        'mean': sum(times) / len(times),
+        'max': max(times),
+        'last': times[-1],
+    }
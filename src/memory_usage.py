@@ -0,0 +1,226 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory accounting. resident_memory() reports the process's resident set size and structure_memory() breaks down
+how much of it is held by the long-lived structures (the dataset structures, the phenotype columns, the result
+caches and the co-expression modules).
+
+AllocationTracer is an opt-in mode that uses tracemalloc (python 3.4 or later) to record the peak memory
+allocated by each route and to report the source lines that hold the most memory. Tracing slows every
+allocation down so it is meant for benchmarks and diagnosis rather than for production. tracemalloc's peak is
+process-wide, so when requests overlap a request's peak includes memory allocated by the others and should be
+read as an upper bound.
+"""
+
+import collections
+import os
+import sys
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# allocation sites in these files are the tracer's own bookkeeping and are left out of the top sites
+_IGNORED_SITES = ('<frozen importlib._bootstrap>', '<unknown>', 'tracemalloc.py', 'memory_usage.py')
+
+
+def resident_memory():
+    """
+    :return: a dict of the process's current ('rss') and peak ('peak_rss') resident set size in bytes. Either
+             is None if the platform doesn't report it
+    """
+    rss = None
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    peak_rss = None
+    if resource is not None:
+        # ru_maxrss is in bytes on mac and in kilobytes everywhere else
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak_rss *= 1024
+
+    return {'rss': rss, 'peak_rss': peak_rss}
+
+
+def structure_memory():
+    """
+    :return: a dict of the bytes held by each long-lived structure that is currently loaded, keyed by
+             'dataset.<structure>', 'phenotype_columns', 'result_cache.<cache>' and 'coexpression_modules'
+    """
+    import coexpression
+    import dataset
+    import phenotype_cache
+    import result_cache
+
+    sizes = collections.OrderedDict()
+    for name, nbytes in sorted(dataset.structure_nbytes().items()):
+        sizes['dataset.' + name] = nbytes
+    sizes['phenotype_columns'] = phenotype_cache.cached_nbytes()
+    for name, cache in result_cache.CACHES.items():
+        sizes['result_cache.' + name] = cache.nbytes
+    sizes['coexpression_modules'] = coexpression.cached_nbytes()
+
+    return sizes
+
+
+class AllocationTracer(object):
+    """
+    Records the peak memory allocated by the requests for each route using tracemalloc.
+    """
+
+    def __init__(self, frames=1):
+        """
+        :param frames: the number of stack frames recorded for each allocation. One frame (the default) is enough
+                       for the top sites by line. More frames are slower but let the sites be grouped by traceback
+        """
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    @property
+    def available(self):
+        return tracemalloc is not None
+
+    @property
+    def enabled(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def start(self):
+        """
+        Start tracing allocations. Tracing stays off if tracemalloc isn't available (python 2).
+
+        :return: True if allocations are being traced
+        """
+        if tracemalloc is None:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+        return True
+
+    def stop(self):
+        """
+        Stop tracing allocations and forget the recorded routes.
+        """
+        if self.enabled:
+            tracemalloc.stop()
+        with self._lock:
+            self._routes.clear()
+
+    def begin(self):
+        """
+        Mark the start of a request.
+
+        :return: a token to pass to end() or None if tracing is off
+        """
+        if not self.enabled:
+            return None
+
+        # reset_peak was added in python 3.9. Before that the peak is the process's peak so far and a request
+        # is only charged for it if it raised the peak. Either way the peak is process-wide: with threaded=True
+        # a request's peak includes the allocations of the requests that overlap it, and a request that starts
+        # while another is running resets the other's peak as well
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end(self, route, token):
+        """
+        Mark the end of a request and record its peak allocation against its route.
+
+        :param route: the route (endpoint) name
+        :param token: the token returned by begin()
+        """
+        if token is None or not self.enabled:
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        request_peak = max(peak - token, 0)
+        retained = current - token
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = collections.Counter()
+            stats['requests'] += 1
+            stats['peak_bytes'] = max(stats['peak_bytes'], request_peak)
+            stats['total_peak_bytes'] += request_peak
+            stats['retained_bytes'] += retained
+
+    def route_stats(self):
+        """
+        :return: a dict keyed by route of the number of traced requests, the largest and mean peak allocation
+                 of a request and the net bytes that the requests left allocated
+        """
+        with self._lock:
+            return {
+                route: {
+                    'requests': stats['requests'],
+                    'peak_bytes': stats['peak_bytes'],
+                    'mean_peak_bytes': stats['total_peak_bytes'] // stats['requests'],
+                    'retained_bytes': stats['retained_bytes'],
+                }
+                for route, stats in self._routes.items()
+            }
+
+    def top_sites(self, count=20):
+        """
+        :param count: the number of sites to return
+        :return: a list of dicts of the 'site' (file:line), 'bytes' and 'allocations' of the source lines that
+                 hold the most traced memory, biggest first. Empty if tracing is off
+        """
+        if not self.enabled:
+            return []
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, '*' + pattern) for pattern in _IGNORED_SITES])
+        return [
+            {
+                'site': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                'bytes': stat.size,
+                'allocations': stat.count,
+            }
+            for stat in snapshot.statistics('lineno')[:count]
+        ]
+
+    def stats(self, site_count=20):
+        """
+        :param site_count: the number of top allocation sites to include
+        :return: a dict of whether tracing is available and enabled, the traced memory and peak, the route stats
+                 and the top allocation sites
+        """
+        current, peak = tracemalloc.get_traced_memory() if self.enabled else (0, 0)
+        return {
+            'available': self.available,
+            'enabled': self.enabled,
+            'traced_bytes': current,
+            'peak_traced_bytes': peak,
+            'routes': self.route_stats(),
+            'top_sites': self.top_sites(site_count),
+        }
@@ -108,6 +108,123 @@ def get_collection_data(collection, database=None, object_id=True):
     return data
 
 
+def get_dataset_version(database=None):
+    """
+    Retrieve the version of the imported dataset. The importer bumps this version every time that it writes
+    data so that in-memory and on-disk caches can tell whether they are stale.
+
+    :param database: the name of the database
+    :type database: string
+    :return: the dataset version (0 for datasets imported before versions were recorded)
+    """
+    database = database if database else DEFAULT_DB
+
+    version = MONGO[database]['dataset'].find_one({'_id': 'version'})
+
+    return version['version'] if version else 0
+
+
+def get_genes(fields=None):
+    """
+    Retrieve the annotation for all genes ordered by gene ID
+
+    :param fields: the gene fields to return. All fields are returned if None
+    :type fields: list
+    :return: a list of gene dicts
+    """
+    projection = {'_id': 0}
+    if fields:
+        projection.update({field: 1 for field in fields})
+
+    return list(MONGO[DEFAULT_DB]['genes'].find({}, projection).sort('ensembl_gene_id', 1))
+
+
+def get_catalog():
+    """
+    Retrieve the catalog summary that the importer maintains (see catalog.py)
+
+    :return: a dict of the dataset 'version', 'sample_count', 'gene_count', 'factor_ids' and 'phenotype_ids' or
+             None if the dataset has no catalog
+    """
+    return MONGO[DEFAULT_DB]['catalog'].find_one({'_id': 'summary'}, {'_id': 0})
+
+
+def get_catalog_genes():
+    """
+    Retrieve the IDs and value counts of all genes in the catalog ordered by gene ID
+
+    :return: a list of (gene ID, number of samples with a value) tuples
+    """
+    data = MONGO[DEFAULT_DB]['catalog_genes'].find({}, {'value_count': 1}).sort('_id', 1)
+
+    return [(res['_id'], res['value_count']) for res in data]
+
+
+def get_dataset_changes(since_version):
+    """
+    Retrieve the changes that the importer recorded after the given dataset version.
+
+    :param since_version: the dataset version to get changes since
+    :type since_version: int
+    :return: a list of change dicts ordered by version. See importdesnp.record_changes
+    """
+    data = MONGO[DEFAULT_DB]['dataset_changes'].find({'version': {'$gt': since_version}}, {'_id': 0})
+
+    return list(data.sort('version', 1))
+
+
+def get_mouse_ids():
+    """
+    Retrieve the IDs of all mice ordered by mouse ID
+
+    :return: a list of mouse IDs
+    """
+    data = MONGO[DEFAULT_DB]['mouse'].find({}, {'mouse_id': 1, '_id': 0}).sort('mouse_id', 1)
+
+    return [res['mouse_id'] for res in data if res.get('mouse_id')]
+
+
+def get_sample_metadata():
+    """
+    Retrieve the metadata (factors, group and diet) for all mice ordered by mouse ID
+
+    :return: a list of dicts with the 'mouse_id', 'factors', 'group' and 'diet_desc' of each mouse
+    """
+    fields = {'mouse_id': 1, 'factors': 1, 'group': 1, 'diet_desc': 1, '_id': 0}
+    data = MONGO[DEFAULT_DB]['mouse'].find({}, fields).sort('mouse_id', 1)
+
+    return [res for res in data if res.get('mouse_id')]
+
+
+def iter_mouse_expression(gene_ids=None, mouse_ids=None):
+    """
+    Iterate over the expression data for mice ordered by mouse ID. This is the same order that is used by
+    get_expression_data.
+
+    :param gene_ids: only return expression data for these genes. All genes are returned if None
+    :type gene_ids: list
+    :param mouse_ids: only return these mice. All mice are returned if None
+    :type mouse_ids: list
+    :return: a generator of (mouse_id, expression_data) tuples. expression_data is an empty dict for mice
+             without any expression data
+    """
+    fields = {'mouse_id': 1}
+    if gene_ids is None:
+        fields['expression_data'] = 1
+    else:
+        fields.update({'expression_data.{0}'.format(gene_id): 1 for gene_id in gene_ids})
+
+    params = {}
+    if mouse_ids is not None:
+        params['mouse_id'] = {'$in': list(mouse_ids)}
+
+    data = MONGO[DEFAULT_DB]['mouse'].find(params, fields).sort('mouse_id', 1)
+
+    for res in data:
+        if res.get('mouse_id'):
+            yield res['mouse_id'], res.get('expression_data') or {}
+
+
 def get_mouse(mouse_id):
     """
     Retrieve the information for a mouse.
@@ -123,23 +240,27 @@ def get_mouse(mouse_id):
     return mouse
 
 
-def find_mice(param):
+def find_mice(param, fields=None, limit=0):
     """
     Find a mouse based upon generic criteria.
 
     :param param: a dictionary of values to match a mouse on
     :type param: dict
-    :return: the mice that match
+    :param fields: the fields to return for each mouse. If None only the mouse metadata and factors
+                   (MOUSE_FIELDS) are returned
+    :type fields: list
+    :param limit: the maximum number of mice to return. 0 means no limit
+    :type limit: int
+    :return: a generator of the mice that match
     """
-    mice = []
-    data = MONGO[DEFAULT_DB]['mouse'].find(param)
-
-    if data:
-        for mouse in data:
-            mouse.pop('_id', None)
-            mice.append(mouse)
+    if fields:
+        projection = {field: 1 for field in fields}
+    else:
+        projection = dict(MOUSE_FIELDS)
 
-    return mice
+    for mouse in MONGO[DEFAULT_DB]['mouse'].find(param, projection, limit=limit):
+        mouse.pop('_id', None)
+        yield mouse
 
 
 def get_phenotype(phenotype_id):
@@ -186,19 +307,72 @@ def get_phenotype_data(phenotype_id):
     :param phenotype_id: the phenotype id
     :return: a list of dicts that contain info about a mouse
     """
-    fields = MOUSE_FIELDS
+    # copy the shared projection so that we never add request specific fields to it
+    fields = dict(MOUSE_FIELDS)
     fields[phenotype_id] = 1
 
     data = []
 
     for res in MONGO[DEFAULT_DB]['mouse'].find({}, fields).sort('mouse_id', 1):
-        print res
         if res['mouse_id']:
             data.append(res)
 
     return data
 
 
+def _phenotype_value(mouse, phenotype_id):
+    value = mouse
+    for key in phenotype_id.split('.', 1):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+
+    return value
+
+
+def get_phenotype_columns(phenotype_ids):
+    """
+    Get the values of several phenotypes for all mice using a single query
+
+    :param phenotype_ids: the phenotype IDs
+    :type phenotype_ids: list
+    :return: a dict with a 'mouse_ids' list ordered by mouse ID and a 'values' dict mapping each phenotype ID
+             to a list of values aligned with the mouse IDs (None for missing values)
+    """
+    fields = {phenotype_id: 1 for phenotype_id in phenotype_ids}
+    fields['mouse_id'] = 1
+    fields['_id'] = 0
+
+    mouse_ids = []
+    values = {phenotype_id: [] for phenotype_id in phenotype_ids}
+    for res in MONGO[DEFAULT_DB]['mouse'].find({}, fields).sort('mouse_id', 1):
+        if res.get('mouse_id'):
+            mouse_ids.append(res['mouse_id'])
+            for phenotype_id in phenotype_ids:
+                values[phenotype_id].append(_phenotype_value(res, phenotype_id))
+
+    return {'mouse_ids': mouse_ids, 'values': values}
+
+
+def get_numeric_phenotypes():
+    """
+    Get all of the phenotypes that have numeric values
+
+    :return: a list of dicts with the phenotype 'id' and human-readable 'name' ordered by ID
+    """
+    data = MONGO[DEFAULT_DB]['attributes'].find({'type': {'$in': ['FLOAT', 'INT']}})
+
+    phenotypes = []
+    for pheno in data:
+        if pheno.get('sub_key'):
+            pheno_id = '{0}.{1}'.format(pheno['sub_key'], pheno['key_id'])
+        else:
+            pheno_id = pheno['key_id']
+        phenotypes.append({'id': pheno_id, 'name': pheno.get('key_id_desc', pheno_id)})
+
+    return sorted(phenotypes, key=lambda pheno: pheno['id'])
+
+
 def get_expression_data(expr_id):
     """
     Get the expression data for all mice
@@ -206,7 +380,8 @@ def get_expression_data(expr_id):
     :param expr_id: the expression id
     :return: a list of dicts that contain info about a mouse
     """
-    fields = MOUSE_FIELDS
+    # copy the shared projection so that we never add request specific fields to it
+    fields = dict(MOUSE_FIELDS)
     fields["expression_data.{0}".format(expr_id)] = 1
 
     data = []
@@ -239,48 +414,6 @@ def expression_search(text):
     return expressions
 
 
-def correlation_search(corr_func, search_id_kind, search_id, result_id_kind, result_count):
-    if search_id_kind == 'expression' and result_id_kind == 'expression':
-        ens_ids = MONGO[DEFAULT_DB]['genes'].find({}, {'ensembl_gene_id': 1, 'gene_symbol': 1, '_id': 0})
-        ens_id_gene_name_dict = {x['ensembl_gene_id']: x['gene_symbol'] for x in ens_ids}
-
-        mice_gene_intens = MONGO[DEFAULT_DB]['mouse'].find({}, {'expression_data': 1})
-        mice_expression = [mouse['expression_data'] for mouse in mice_gene_intens if 'expression_data' in mouse]
-
-        ref_intens_dict = {i: mouse[search_id] for i, mouse in enumerate(mice_expression) if search_id in mouse}
-        ref_mouse_indexes = set(ref_intens_dict.keys())
-
-        corr_id_tuples = []
-        for ens_id in ens_id_gene_name_dict.keys():
-            if ens_id == search_id:
-                continue
-
-            curr_intens_dict = {i: mouse[ens_id] for i, mouse in enumerate(mice_expression) if ens_id in mouse}
-            if len(curr_intens_dict) == 0:
-                continue
-
-            common_mouse_indexes = set(curr_intens_dict.keys())
-            common_mouse_indexes &= ref_mouse_indexes
-            common_mouse_indexes = list(common_mouse_indexes)
-
-            ref_intens = [ref_intens_dict[i] for i in common_mouse_indexes]
-            curr_intens = [curr_intens_dict[i] for i in common_mouse_indexes]
-
-            corr = corr_func(ref_intens, curr_intens)
-            corr_id_tuples.append((abs(corr), ens_id, corr))
-
-        corr_id_tuples.sort(reverse=True)
-        corr_id_tuples = corr_id_tuples[: result_count]
-        return {
-            'ids': [ens_id for _, ens_id, _ in corr_id_tuples],
-            'names': [ens_id_gene_name_dict[ens_id] for _, ens_id, _ in corr_id_tuples],
-            'correlations': [corr for _, _, corr in corr_id_tuples],
-            'total_count': len(corr_id_tuples),
-        }
-    else:
-        return None
-
-
 if __name__ == '__main__':
     from config import *
     from scipy.stats import pearsonr, spearmanr
@@ -0,0 +1,177 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A cache of parsed phenotype columns. Each phenotype is read from mongo (with a projection built for just that
+request) the first time that it is needed and kept as a typed array until the dataset version changes.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+import dataset
+import mongodb_utils
+
+NUMERIC_TYPES = ('FLOAT', 'INT')
+
+MAX_CACHED_COLUMNS = 1000
+
+_LOCK = threading.Lock()
+_VERSION = None
+_COLUMNS = collections.OrderedDict()
+
+
+def set_max_cached_columns(max_columns):
+    """
+    Set the maximum number of phenotype columns to keep. The least recently used columns are dropped first.
+
+    :param max_columns: the maximum number of columns
+    :type max_columns: int
+    """
+    global MAX_CACHED_COLUMNS
+    MAX_CACHED_COLUMNS = max_columns
+
+
+class PhenotypeColumn(object):
+    """
+    The values of one phenotype for all mice ordered by mouse ID. Numeric phenotypes are held in a float64 array
+    with NaN for missing values and all other phenotypes in an object array with None for missing values.
+    """
+
+    def __init__(self, phenotype_id, phenotype_type, mouse_ids, values):
+        self.phenotype_id = phenotype_id
+        self.type = phenotype_type
+        self.mouse_ids = mouse_ids
+        self.values = values
+
+    @property
+    def is_numeric(self):
+        return self.type in NUMERIC_TYPES
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def aligned_values(self, mouse_ids):
+        """
+        :param mouse_ids: the mouse IDs to align to
+        :return: the numeric values reordered to match mouse_ids (NaN for mice we don't have)
+        """
+        if mouse_ids == self.mouse_ids:
+            return self.values
+
+        indexes = {mouse_id: i for i, mouse_id in enumerate(self.mouse_ids)}
+        aligned = np.empty(len(mouse_ids), dtype=np.float64)
+        aligned.fill(np.nan)
+        for j, mouse_id in enumerate(mouse_ids):
+            i = indexes.get(mouse_id)
+            if i is not None:
+                aligned[j] = self.values[i]
+
+        return aligned
+
+    def json_values(self):
+        """
+        :return: the values as a list that can be serialized as JSON. Missing values are ''
+        """
+        if self.is_numeric:
+            return ['' if np.isnan(value) else float(value) for value in self.values]
+        else:
+            return ['' if value is None else value for value in self.values]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _load_columns(phenotype_ids):
+    types = {}
+    for phenotype_id in phenotype_ids:
+        phenotype = mongodb_utils.get_phenotype(phenotype_id)
+        types[phenotype_id] = phenotype.get('type') if phenotype else None
+
+    data = mongodb_utils.get_phenotype_columns(phenotype_ids)
+    columns = {}
+    for phenotype_id in phenotype_ids:
+        raw_values = data['values'][phenotype_id]
+        if types[phenotype_id] in NUMERIC_TYPES:
+            values = np.array([_to_float(value) for value in raw_values], dtype=np.float64)
+        else:
+            values = np.empty(len(raw_values), dtype=object)
+            values[:] = raw_values
+        columns[phenotype_id] = PhenotypeColumn(phenotype_id, types[phenotype_id], data['mouse_ids'], values)
+
+    return columns
+
+
+def get_columns(phenotype_ids):
+    """
+    Get the columns for the given phenotypes. Any columns that aren't cached yet are read from mongo in a single
+    query.
+
+    :param phenotype_ids: the phenotype IDs
+    :type phenotype_ids: list
+    :return: a dict mapping phenotype ID to PhenotypeColumn
+    """
+    global _VERSION
+
+    version = dataset.get_dataset_version()
+    columns = {}
+    with _LOCK:
+        if version != _VERSION:
+            _COLUMNS.clear()
+            _VERSION = version
+
+        for phenotype_id in phenotype_ids:
+            column = _COLUMNS.pop(phenotype_id, None)
+            if column is not None:
+                columns[phenotype_id] = column
+                _COLUMNS[phenotype_id] = column
+
+    missing_ids = [phenotype_id for phenotype_id in phenotype_ids if phenotype_id not in columns]
+    if missing_ids:
+        loaded = _load_columns(missing_ids)
+        columns.update(loaded)
+        with _LOCK:
+            if version == _VERSION:
+                _COLUMNS.update(loaded)
+                while len(_COLUMNS) > MAX_CACHED_COLUMNS:
+                    _COLUMNS.popitem(last=False)
+
+    return columns
+
+
+def get_column(phenotype_id):
+    """
+    :param phenotype_id: the phenotype ID
+    :return: the PhenotypeColumn for the phenotype
+    """
+    return get_columns([phenotype_id])[phenotype_id]
+
+
+def cached_nbytes():
+    """
+    :return: the total size of the cached phenotype values in bytes
+    """
+    with _LOCK:
+        return sum(column.nbytes for column in _COLUMNS.values())
@@ -0,0 +1,212 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+LRU caches for computed results with a byte budget. Concurrent requests for the same key are coalesced so that
+the result is only computed once and the other requests wait for it.
+"""
+
+import collections
+import sys
+import threading
+
+import numpy as np
+
+# all caches by name so that their stats can be reported together
+CACHES = collections.OrderedDict()
+
+
+def estimate_size(obj):
+    """
+    Estimate the number of bytes used by a result made of dicts, lists, tuples, strings, numbers and numpy
+    arrays.
+
+    :param obj: the result
+    :return: the estimated size in bytes
+    """
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_size(item) for item in obj)
+    else:
+        return sys.getsizeof(obj)
+
+
+class _Pending(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache(object):
+    """
+    A thread-safe LRU cache that evicts the least recently used results once the estimated size of all results
+    goes over max_bytes.
+    """
+
+    def __init__(self, name, max_bytes):
+        """
+        :param name: the name that the cache's stats are reported under
+        :param max_bytes: the byte budget for all cached results
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+
+        CACHES[name] = self
+
+    def get(self, key):
+        """
+        Get the cached value for the key without computing it. If another thread is computing the value (in
+        get_or_compute) we wait for it. Lookups are counted in the stats the same way as get_or_compute's.
+
+        :param key: the (hashable) key
+        :return: the cached value or None if it isn't cached
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._hits += 1
+                return entry[0]
+
+            pending = self._pending.get(key)
+            if pending is None:
+                self._misses += 1
+                return None
+            self._coalesced += 1
+
+        # the value is None if computing it failed
+        pending.done.wait()
+        return pending.value
+
+    def put(self, key, value):
+        """
+        Add a value to the cache. Values bigger than the whole budget are not cached.
+
+        :param key: the (hashable) key
+        :param value: the value
+        """
+        size = estimate_size(value)
+        with self._lock:
+            self._put(key, value, size)
+
+    def _put(self, key, value, size):
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._total_bytes -= old_entry[1]
+
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (value, size)
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._total_bytes -= evicted_size
+            self._evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        Get the cached value for the key, calling compute() to create it if needed. If another thread is already
+        computing the value for the same key we wait for it rather than computing it again.
+
+        :param key: the (hashable) key
+        :param compute: a function taking no arguments which returns the value
+        :return: the value
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._hits += 1
+                return entry[0]
+
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _Pending()
+                owner = True
+                self._misses += 1
+            else:
+                owner = False
+                self._coalesced += 1
+
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = compute()
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            size = estimate_size(pending.value) if pending.error is None else 0
+            with self._lock:
+                del self._pending[key]
+                if pending.error is None:
+                    self._put(key, pending.value, size)
+            pending.done.set()
+
+        return pending.value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    @property
+    def nbytes(self):
+        return self._total_bytes
+
+    def stats(self):
+        """
+        :return: a dict of the cache's size and hit/miss statistics
+        """
+        with self._lock:
+            lookups = self._hits + self._misses + self._coalesced
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'coalesced': self._coalesced,
+                'evictions': self._evictions,
+                'in_flight': len(self._pending),
+                'hit_rate': float(self._hits + self._coalesced) / lookups if lookups else 0.0,
+            }
+
+
+def all_stats():
+    """
+    :return: a dict of the stats of every cache keyed by cache name
+    """
+    return {name: cache.stats() for name, cache in CACHES.items()}
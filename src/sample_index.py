@@ -0,0 +1,225 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-memory index over the sample metadata (mouse.factors) for selecting subsets of samples without going back
+to mongo.
+
+Subsets are selected with a filter string made of clauses separated by ';' which are ANDed together. Each clause
+names a factor and one or more levels separated by '|' which are ORed together. A clause using '!=' rather than
+'=' selects the samples that are not at any of the given levels. For example:
+
+    tissue=hypothalamus;treatment=sleepdeprivation;time=6hrs|9hrs
+    tissue!=cerebral_cortex
+"""
+
+import hashlib
+import json
+
+import numpy as np
+
+import mongodb_utils
+
+
+def _dictionary_encode(values):
+    levels = sorted(set(values))
+    level_codes = {level: code for code, level in enumerate(levels)}
+
+    return {'levels': levels, 'codes': [level_codes[value] for value in values]}
+
+
+class SubsetError(ValueError):
+    """
+    Raised for a subset filter that can't be evaluated (a malformed clause or an unknown factor)
+    """
+
+
+class SampleIndex(object):
+    """
+    Boolean masks for every factor level. Samples are ordered by mouse ID which is the same order as the
+    columns of the ExpressionMatrix.
+    """
+
+    SNAPSHOT_NAME = 'sample_index'
+
+    def __init__(self, mouse_ids, factor_ids, factor_levels, factor_codes, strains, diets):
+        """
+        :param mouse_ids: the mouse IDs in sample order
+        :param factor_ids: the factor IDs in the order of the rows of factor_codes
+        :param factor_levels: a list (one per factor) of the level names for the factor
+        :param factor_codes: an int32 (len(factor_ids), len(mouse_ids)) array of indexes into the factor's
+                             levels with -1 for samples that don't have a value for the factor
+        :param strains: the mouse strains (group) in sample order
+        :param diets: the mouse diets in sample order
+        """
+        self.mouse_ids = mouse_ids
+        self.factor_ids = factor_ids
+        self.factor_levels = factor_levels
+        self.factor_codes = factor_codes
+        self.strains = strains
+        self.diets = diets
+
+        self._sample_table = None
+        self._sample_table_json = None
+
+        self.level_masks = {}
+        for factor_id, levels, codes in zip(factor_ids, factor_levels, factor_codes):
+            for level_code, level in enumerate(levels):
+                self.level_masks[factor_id, level] = codes == level_code
+
+    @property
+    def sample_count(self):
+        return len(self.mouse_ids)
+
+    @property
+    def nbytes(self):
+        return self.factor_codes.nbytes + sum(mask.nbytes for mask in self.level_masks.values())
+
+    def factor_values(self, factor_id, mask=None):
+        """
+        :param factor_id: the factor ID
+        :param mask: an optional boolean sample mask
+        :return: the level of each (selected) sample as a list of strings. Missing levels are ''
+        """
+        factor_index = self.factor_ids.index(factor_id)
+        levels = self.factor_levels[factor_index] + ['']
+        codes = self.factor_codes[factor_index]
+        if mask is not None:
+            codes = codes[mask]
+
+        return [levels[code] for code in codes]
+
+    def sample_table(self):
+        """
+        Get the dictionary-encoded sample table. Every column is encoded as a list of 'levels' and a list of
+        'codes' (one per sample, indexing into the levels, -1 if missing). Clients fetch this once and then only
+        need the values for each gene (in the same sample order).
+
+        :return: a dict with the 'sample_order_version', 'mouse_ids', 'strains', 'diets' and 'factors' (a dict
+                 of encoded columns keyed by factor ID)
+        """
+        if self._sample_table is None:
+            table = {
+                'mouse_ids': self.mouse_ids,
+                'strains': _dictionary_encode(self.strains),
+                'diets': _dictionary_encode(self.diets),
+                'factors': {
+                    factor_id: {'levels': levels, 'codes': codes.tolist()}
+                    for factor_id, levels, codes in zip(self.factor_ids, self.factor_levels, self.factor_codes)
+                },
+            }
+
+            # the version identifies both the sample order and the sample table contents
+            table_hash = hashlib.sha1(json.dumps(table, sort_keys=True).encode('utf-8'))
+            table['sample_order_version'] = table_hash.hexdigest()[:16]
+            self._sample_table = table
+
+        return self._sample_table
+
+    def sample_table_json(self):
+        """
+        :return: the sample table serialized as compact JSON. This is only serialized once
+        """
+        if self._sample_table_json is None:
+            self._sample_table_json = json.dumps(self.sample_table(), separators=(',', ':'))
+
+        return self._sample_table_json
+
+    @property
+    def sample_order_version(self):
+        return self.sample_table()['sample_order_version']
+
+    def select(self, subset):
+        """
+        Evaluate a subset filter (see the module documentation).
+
+        :param subset: the filter string. None or '' selects all samples
+        :return: a boolean mask over the samples
+        :raises SubsetError: if the filter is malformed or names a factor that doesn't exist
+        """
+        selected = np.ones(self.sample_count, dtype=bool)
+        if not subset:
+            return selected
+
+        for clause in subset.split(';'):
+            if not clause:
+                continue
+
+            negate = '!=' in clause
+            factor_id, sep, levels = clause.partition('!=' if negate else '=')
+            if not sep:
+                raise SubsetError('bad subset clause "{}". Expected factor=level'.format(clause))
+            if factor_id not in self.factor_ids:
+                raise SubsetError('"{}" is not a factor'.format(factor_id))
+
+            clause_mask = np.zeros(self.sample_count, dtype=bool)
+            for level in levels.split('|'):
+                level_mask = self.level_masks.get((factor_id, level))
+                if level_mask is not None:
+                    clause_mask |= level_mask
+
+            if negate:
+                clause_mask = ~clause_mask
+            selected &= clause_mask
+
+        return selected
+
+    @classmethod
+    def from_mongo(cls):
+        samples = mongodb_utils.get_sample_metadata()
+        mouse_ids = [sample['mouse_id'] for sample in samples]
+        factor_ids = sorted(set(factor_id for sample in samples for factor_id in sample.get('factors', {})))
+
+        factor_levels = []
+        factor_codes = np.empty((len(factor_ids), len(samples)), dtype=np.int32)
+        factor_codes.fill(-1)
+        for i, factor_id in enumerate(factor_ids):
+            levels = sorted(set(
+                sample['factors'][factor_id]
+                for sample in samples
+                if factor_id in sample.get('factors', {})))
+            level_codes = {level: code for code, level in enumerate(levels)}
+            for j, sample in enumerate(samples):
+                level = sample.get('factors', {}).get(factor_id)
+                if level is not None:
+                    factor_codes[i, j] = level_codes[level]
+            factor_levels.append(levels)
+
+        strains = [sample.get('group', '') for sample in samples]
+        diets = [sample.get('diet_desc', '') for sample in samples]
+
+        return cls(mouse_ids, factor_ids, factor_levels, factor_codes, strains, diets)
+
+    def to_snapshot(self):
+        return {'factor_codes': self.factor_codes}, {
+            'mouse_ids': self.mouse_ids,
+            'factor_ids': self.factor_ids,
+            'factor_levels': self.factor_levels,
+            'strains': self.strains,
+            'diets': self.diets,
+        }
+
+    @classmethod
+    def from_snapshot(cls, arrays, metadata):
+        return cls(
+            metadata['mouse_ids'],
+            metadata['factor_ids'],
+            metadata['factor_levels'],
+            np.asarray(arrays['factor_codes']),
+            metadata['strains'],
+            metadata['diets'])
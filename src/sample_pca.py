@@ -0,0 +1,168 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Principal component analysis of the samples (the columns of the ExpressionMatrix) with genes as the variables.
+Each gene is centered over the selected samples (after an optional log2(x + 1) transform, the same transform
+that the client offers) and missing values are set to the gene's mean.
+
+The components are found with a randomized truncated SVD (Halko, Martinsson and Tropp, 2011): the centered
+matrix is multiplied by a small random matrix to find a basis for its dominant column space, a few power
+iterations sharpen the basis and the SVD of the matrix projected onto the basis gives the top components. Every
+step only multiplies the matrix by thin matrices, which is done a block of genes at a time, so the centered
+matrix is never held in memory and a few passes over the matrix are all that is needed.
+"""
+
+import numpy as np
+
+# the number of genes to read from the matrix at once
+BLOCK_SIZE = 2048
+
+# the number of extra random vectors used to find the basis. More are slower but more accurate
+OVERSAMPLES = 10
+
+# the number of power iterations. Each one costs two passes over the matrix but makes the components more
+# accurate when the singular values decay slowly
+POWER_ITERATIONS = 2
+
+# the random matrix is seeded so that the same request always gives the same answer
+SEED = 0
+
+
+def _centered_blocks(expr_matrix, sample_mask, log):
+    """
+    :return: a generator of (start, stop, block) tuples of the selected samples' values with every gene centered
+             and missing values set to 0 (the gene's mean)
+    """
+    all_samples = sample_mask.all()
+    for start, stop, block in expr_matrix.iter_blocks(BLOCK_SIZE):
+        if not all_samples:
+            block = block[:, sample_mask]
+        if log:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.log2(block + 1.0, out=block)
+            block[np.isinf(block)] = np.nan
+
+        missing = np.isnan(block)
+        if missing.any():
+            block[missing] = 0.0
+            counts = np.maximum(block.shape[1] - missing.sum(axis=1), 1)
+            block -= (block.sum(axis=1) / counts)[:, np.newaxis]
+            block[missing] = 0.0
+        else:
+            block -= block.mean(axis=1)[:, np.newaxis]
+
+        yield start, stop, block
+
+
+def _multiply(expr_matrix, sample_mask, log, right):
+    """
+    :return: the centered matrix multiplied by right (which has a row per selected sample)
+    """
+    product = np.empty((expr_matrix.shape[0], right.shape[1]))
+    for start, stop, block in _centered_blocks(expr_matrix, sample_mask, log):
+        product[start:stop] = block.dot(right)
+
+    return product
+
+
+def _multiply_transposed(expr_matrix, sample_mask, log, left):
+    """
+    :return: a (product, sum of squares) tuple of the transposed centered matrix multiplied by left (which has a
+             row per gene) and the sum of the squares of the centered values
+    """
+    product = np.zeros((int(sample_mask.sum()), left.shape[1]))
+    sum_of_squares = 0.0
+    for start, stop, block in _centered_blocks(expr_matrix, sample_mask, log):
+        product += block.T.dot(left[start:stop])
+        sum_of_squares += np.einsum('ij,ij->', block, block)
+
+    return product, sum_of_squares
+
+
+def randomized_pca(expr_matrix, sample_mask, components, log=False):
+    """
+    Find the top principal components of the samples.
+
+    :param expr_matrix: the ExpressionMatrix
+    :param sample_mask: a boolean mask of the samples to include
+    :param components: the number of components to find. This is lowered if there aren't enough samples or genes
+    :param log: True to log2(x + 1) transform the values first
+    :return: a (coordinates, loadings, variance_explained) tuple of a (samples, components) array of the
+             selected samples' coordinates, a (genes, components) array of each gene's loading on each component
+             and an array of the fraction of the total variance that each component explains
+    """
+    gene_count = expr_matrix.shape[0]
+    sample_count = int(sample_mask.sum())
+    components = max(0, min(components, sample_count - 1, gene_count))
+    if components == 0:
+        return np.zeros((sample_count, 0)), np.zeros((gene_count, 0)), np.zeros(0)
+
+    basis_size = min(components + OVERSAMPLES, sample_count, gene_count)
+    random_matrix = np.random.RandomState(SEED).standard_normal((sample_count, basis_size))
+    basis, _ = np.linalg.qr(_multiply(expr_matrix, sample_mask, log, random_matrix))
+    for _ in range(POWER_ITERATIONS):
+        sample_basis, _ = np.linalg.qr(_multiply_transposed(expr_matrix, sample_mask, log, basis)[0])
+        basis, _ = np.linalg.qr(_multiply(expr_matrix, sample_mask, log, sample_basis))
+
+    # the projection of the matrix onto the basis (transposed) is small enough to decompose exactly
+    projection, sum_of_squares = _multiply_transposed(expr_matrix, sample_mask, log, basis)
+    sample_vectors, singular_values, basis_vectors = np.linalg.svd(projection, full_matrices=False)
+    sample_vectors = sample_vectors[:, :components]
+    singular_values = singular_values[:components]
+    loadings = basis.dot(basis_vectors[:components].T)
+
+    # the sign of a component is arbitrary. Make the loading with the largest magnitude positive so that the
+    # answer doesn't change between runs
+    largest = loadings[np.argmax(np.abs(loadings), axis=0), np.arange(components)]
+    signs = np.where(largest < 0, -1.0, 1.0)
+    loadings *= signs
+    coordinates = sample_vectors * (singular_values * signs)
+
+    if sum_of_squares > 0:
+        variance_explained = singular_values ** 2 / sum_of_squares
+    else:
+        variance_explained = np.zeros(components)
+
+    return coordinates, loadings, variance_explained
+
+
+def top_loading_genes(expr_matrix, loadings, count):
+    """
+    :param expr_matrix: the ExpressionMatrix
+    :param loadings: the loadings returned by randomized_pca
+    :param count: the number of genes per component
+    :return: a list (one per component) of dicts of the 'ids', 'names' and 'loadings' of the genes with the
+             largest absolute loadings, largest first
+    """
+    top_genes = []
+    count = min(count, len(loadings))
+    for component_loadings in loadings.T:
+        if count <= 0:
+            top_genes.append({'ids': [], 'names': [], 'loadings': []})
+            continue
+
+        indexes = np.argpartition(-np.abs(component_loadings), count - 1)[:count]
+        indexes = indexes[np.argsort(-np.abs(component_loadings[indexes]), kind='mergesort')]
+        top_genes.append({
+            'ids': [expr_matrix.gene_ids[i] for i in indexes],
+            'names': [expr_matrix.gene_symbols[i] for i in indexes],
+            'loadings': component_loadings[indexes].tolist(),
+        })
+
+    return top_genes
@@ -0,0 +1,150 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+2D density summaries of gene vs. gene scatter plots so that plots of thousands of samples can be drawn as a few
+hundred bins rather than one shape per sample. Points are counted in rectangular or hexagonal bins (separately
+for each level of a factor) with a single vectorized pass over the points.
+
+Hexagonal bins use the same lattice as matplotlib's hexbin: with bin width w and bin height h the centers are at
+(x_min + i * w, y_min + j * h) and (x_min + (i + 0.5) * w, y_min + (j + 0.5) * h), every point is counted in the
+nearest center and a bin's hexagon has its vertices at (0, +/-h / 3) and (+/-w / 2, +/-h / 6) from its center.
+"""
+
+import numpy as np
+
+SHAPES = ('hex', 'rect')
+
+
+def _bin_range(values):
+    low, high = float(values.min()), float(values.max())
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+
+    return low, high
+
+
+def bin_points(x, y, shape='hex', bins=40):
+    """
+    Assign points to bins.
+
+    :param x: a 1D float array of the points' X values (without NaNs)
+    :param y: a 1D float array of the points' Y values (without NaNs)
+    :param shape: "hex" or "rect"
+    :param bins: the number of bins across the X range. Rectangular bins are square in data range units (there
+                 are as many bins across the Y range) and hexagonal bins are regular when the ranges are drawn as
+                 a square
+    :return: a (bin_indexes, centers, grid) tuple of an int array of each point's bin, a (bin count, 2) array of
+             the X and Y of every bin's center and a dict of the 'x_range', 'y_range', 'bin_width' and 'bin_height'
+    """
+    if shape not in SHAPES:
+        raise ValueError('"{}" bins are not supported'.format(shape))
+
+    x_min, x_max = _bin_range(x)
+    y_min, y_max = _bin_range(y)
+    bin_width = (x_max - x_min) / bins
+    x_scaled = (x - x_min) / bin_width
+
+    if shape == 'rect':
+        bin_height = (y_max - y_min) / bins
+        y_scaled = (y - y_min) / bin_height
+        columns = np.minimum(x_scaled.astype(np.int64), bins - 1)
+        rows = np.minimum(y_scaled.astype(np.int64), bins - 1)
+        bin_indexes = rows * bins + columns
+
+        center_columns, center_rows = np.meshgrid(np.arange(bins) + 0.5, np.arange(bins) + 0.5)
+        centers = np.column_stack([
+            x_min + center_columns.ravel() * bin_width,
+            y_min + center_rows.ravel() * bin_height])
+    else:
+        row_count = max(int(round(bins / np.sqrt(3.0))), 1)
+        bin_height = (y_max - y_min) / row_count
+        y_scaled = (y - y_min) / bin_height
+
+        # the nearest center on each of the two offset lattices (the factor of 3 makes the distances those of a
+        # regular hexagonal grid)
+        columns1, rows1 = np.round(x_scaled).astype(np.int64), np.round(y_scaled).astype(np.int64)
+        columns2, rows2 = np.floor(x_scaled).astype(np.int64), np.floor(y_scaled).astype(np.int64)
+        distances1 = (x_scaled - columns1) ** 2 + 3.0 * (y_scaled - rows1) ** 2
+        distances2 = (x_scaled - columns2 - 0.5) ** 2 + 3.0 * (y_scaled - rows2 - 0.5) ** 2
+        on_lattice1 = distances1 <= distances2
+
+        # lattice 1 has (bins + 1) x (row_count + 1) centers and lattice 2 has bins x row_count centers after it
+        lattice1_size = (bins + 1) * (row_count + 1)
+        bin_indexes = np.where(
+            on_lattice1,
+            rows1 * (bins + 1) + columns1,
+            lattice1_size + np.minimum(rows2, row_count - 1) * bins + np.minimum(columns2, bins - 1))
+
+        columns1, rows1 = np.meshgrid(np.arange(bins + 1), np.arange(row_count + 1))
+        columns2, rows2 = np.meshgrid(np.arange(bins) + 0.5, np.arange(row_count) + 0.5)
+        centers = np.column_stack([
+            x_min + np.concatenate([columns1.ravel(), columns2.ravel()]) * bin_width,
+            y_min + np.concatenate([rows1.ravel(), rows2.ravel()]) * bin_height])
+
+    grid = {
+        'x_range': [x_min, x_max],
+        'y_range': [y_min, y_max],
+        'bin_width': bin_width,
+        'bin_height': bin_height,
+    }
+
+    return bin_indexes, centers, grid
+
+
+def density(x, y, groups=None, group_count=1, shape='hex', bins=40):
+    """
+    Count the points in every bin for each group of points.
+
+    :param x: a 1D float array of the points' X values. Points with a NaN X or Y are left out
+    :param y: a 1D float array of the points' Y values
+    :param groups: an optional int array of each point's group (from 0 to group_count - 1). Points whose group is
+                   negative are left out. All points are in group 0 if None
+    :param group_count: the number of groups
+    :param shape: "hex" or "rect"
+    :param bins: the number of bins across the X range (see bin_points)
+    :return: a dict of the 'shape', the grid (see bin_points), the 'point_count' and 'groups': a list with a dict
+             per group of the 'x' and 'y' of the center of every bin that has points in the group along with the
+             'counts' of points
+    """
+    if groups is None:
+        groups = np.zeros(len(x), dtype=np.int64)
+    present = ~np.isnan(x) & ~np.isnan(y) & (groups >= 0)
+    x, y, groups = x[present], y[present], groups[present]
+
+    result = {'shape': shape, 'point_count': int(len(x))}
+    if len(x) == 0:
+        result.update(x_range=None, y_range=None, bin_width=None, bin_height=None)
+        result['groups'] = [{'x': [], 'y': [], 'counts': []} for _ in range(group_count)]
+        return result
+
+    bin_indexes, centers, grid = bin_points(x, y, shape, bins)
+    counts = np.bincount(groups * len(centers) + bin_indexes, minlength=group_count * len(centers))
+    counts = counts.reshape(group_count, len(centers))
+
+    result.update(grid)
+    result['groups'] = []
+    for group_counts in counts:
+        occupied = np.flatnonzero(group_counts)
+        result['groups'].append({
+            'x': centers[occupied, 0].tolist(),
+            'y': centers[occupied, 1].tolist(),
+            'counts': group_counts[occupied].tolist(),
+        })
+
+    return result
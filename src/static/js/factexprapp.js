@@ -96,6 +96,43 @@ function decURIComp(str) {
 }
 
 
+/**
+ * Decode a dictionary-encoded column from the sample table
+ * @param encodedCol    an object with 'levels' and 'codes' arrays (a code of -1 means missing)
+ * @return the decoded array with missing values as ''
+ */
+function decodeSampleCol(encodedCol) {
+    return encodedCol.codes.map(function(code) {
+        return code < 0 ? '' : encodedCol.levels[code];
+    });
+}
+
+/**
+ * Expand a slim expression response (see /expression/<id>?slim=1) into the same form as the full
+ * /expression/<id> response using the sample table from /samples/
+ * @param sampleTable   the sample table from /samples/
+ * @param slimData      the slim expression response
+ * @return the expanded expression data or null if the sample table version doesn't match
+ */
+function expandSlimExpression(sampleTable, slimData) {
+    if(sampleTable.sample_order_version !== slimData.sample_order_version) {
+        return null;
+    }
+
+    var exprData = {
+        mouse_ids: sampleTable.mouse_ids,
+        sexes: sampleTable.mouse_ids.map(function() {return 'M';}),
+        strains: decodeSampleCol(sampleTable.strains),
+        diets: decodeSampleCol(sampleTable.diets),
+        values: slimData.values.map(function(val) {return val === null ? '' : val;})
+    };
+    $.each(sampleTable.factors, function(factorID, encodedCol) {
+        exprData[factorID] = decodeSampleCol(encodedCol);
+    });
+
+    return exprData;
+}
+
 /**
  * Just A convenience method to build a jQuery option doc node
  * @param value the option's value
@@ -161,8 +198,11 @@ function listenForTextChange(textField, func, checkIntervalMS, doneIntervalMS) {
  * object to make them explicit.
  * @param appConfig this is a JSON-serialized version of the WEB_APP_CONF object specified in conif.py. Consult
  *                  the code documentation in config.py for details about the structure of this object.
+ * @param staticManifest    the paths of the pre-rendered data files when the page was built by static_build.py
+ *                  (null when the page is served by the application). Only gene searches and expression data
+ *                  are available from static files
  */
-function initFactExprApp(appConfig) {
+function initFactExprApp(appConfig, staticManifest) {
     var allFactorIDs = [];
     $.each(appConfig.factors, function(factorID) {
         allFactorIDs.push(factorID);
@@ -186,6 +226,102 @@ function initFactExprApp(appConfig) {
     searchStates[0].otherState = searchStates[1];
     searchStates[1].otherState = searchStates[0];
 
+    // the sample table is shared by every expression selection so we only fetch it once (and again if the
+    // dataset changes)
+    var sampleTablePromise = null;
+    function getSampleTable(refresh) {
+        if(sampleTablePromise === null || refresh) {
+            sampleTablePromise = $.getJSON(staticManifest ? staticManifest.samples : '../samples/');
+        }
+        return sampleTablePromise;
+    }
+
+    // in static mode the gene search index (every gene's ID, name and data file) is fetched once
+    var expressionIndexPromise = null;
+    function getExpressionIndex() {
+        if(expressionIndexPromise === null) {
+            expressionIndexPromise = $.getJSON(staticManifest.expression_index).then(function(index) {
+                index.filesByID = {};
+                index.ids.forEach(function(exprID, i) {
+                    index.filesByID[exprID] = index.files[i];
+                });
+                return index;
+            });
+        }
+        return expressionIndexPromise;
+    }
+
+    /**
+     * Fetch the expression data for the given gene as compactly as possible. Only the values are requested
+     * and the per-sample columns are filled in from the sample table.
+     * @param exprID    the expression ID
+     * @param callback  called with the expanded expression data
+     * @return the AJAX object for the values request
+     */
+    function getExpressionData(exprID, callback) {
+        var sampleTableReq = getSampleTable(false);
+        var slimCallback = function(slimData) {
+            sampleTableReq.done(function(sampleTable) {
+                var exprData = expandSlimExpression(sampleTable, slimData);
+                if(exprData !== null) {
+                    callback(exprData);
+                } else if(!staticManifest) {
+                    // the dataset changed since we fetched the sample table
+                    getSampleTable(true);
+                    $.getJSON('../expression/' + encURIComp(exprID), callback);
+                }
+            });
+        };
+
+        if(staticManifest) {
+            var aborted = false;
+            var fileReq = null;
+            getExpressionIndex().done(function(index) {
+                if(!aborted && index.filesByID.hasOwnProperty(exprID)) {
+                    fileReq = $.getJSON(index.filesByID[exprID], slimCallback);
+                }
+            });
+            return {abort: function() {
+                aborted = true;
+                if(fileReq !== null) {
+                    fileReq.abort();
+                }
+            }};
+        }
+
+        return $.getJSON('../expression/' + encURIComp(exprID) + '?slim=1', slimCallback);
+    }
+
+    /**
+     * Search the static gene search index the same way that the server searches genes: genes whose ID
+     * matches followed by genes whose name matches (case-insensitively)
+     * @param text      the search text
+     * @param callback  called with a search result like the one from /search/expression/...
+     * @return an object with an abort function
+     */
+    function searchExpressionIndex(text, callback) {
+        var aborted = false;
+        getExpressionIndex().done(function(index) {
+            if(aborted) {
+                return;
+            }
+
+            var lowerText = text.toLowerCase();
+            var ids = [];
+            var names = [];
+            [index.ids, index.names].forEach(function(searchedCol) {
+                searchedCol.forEach(function(searchedVal, i) {
+                    if(ids.length < 100 && String(searchedVal).toLowerCase().indexOf(lowerText) >= 0) {
+                        ids.push(index.ids[i]);
+                        names.push(index.names[i]);
+                    }
+                });
+            });
+            callback({ids: ids, names: names, total_count: ids.length});
+        });
+        return {abort: function() {aborted = true;}};
+    }
+
     function initSearchState(state, stateIndex) {
         var geneAJAXObj = null;
 
@@ -217,25 +353,24 @@ function initFactExprApp(appConfig) {
             onCheck: function(rowData, row) {
                 state.selectionName = rowData.name;
                 state.selectionID = rowData.id;
+                state.selectionKind = state.searchMode === 'phenotype' ? 'phenotype' : 'expression';
                 state.otherState.correlationLink.text(rowData.name + ' Correlation Search');
 
                 if(geneAJAXObj !== null) {
                     geneAJAXObj.abort();
                 }
 
+                var selectionCallback = function(selectionData) {
+                    state.selectionData = selectionData;
+                    refreshPlots();
+                };
+
                 // FIXME prefix needs to work for all correlation kinds
-                var urlPrefix = null;
-                if(state.searchMode === 'correlation') {
-                    urlPrefix = '../expression/';
+                if(state.searchMode === 'phenotype') {
+                    geneAJAXObj = $.getJSON('../phenotype/' + encURIComp(rowData.id), selectionCallback);
                 } else {
-                    urlPrefix = '../' + state.searchMode + '/';
+                    geneAJAXObj = getExpressionData(rowData.id, selectionCallback);
                 }
-                var url = urlPrefix + encURIComp(rowData.id);
-                geneAJAXObj = $.getJSON(url, function(selectionData) {
-                    console.log(selectionData);
-                    state.selectionData = selectionData;
-                    refreshPlots();
-                });
             }
         });
 
@@ -279,6 +414,12 @@ function initFactExprApp(appConfig) {
             searchTextFields[stateIndex].prop('disabled', true);
             correlationSearch(state);
         });
+
+        if(staticManifest) {
+            // phenotype and correlation searches need the application server
+            $('#phenotype' + (stateIndex + 1) + '-search-select').parent().hide();
+            state.correlationLink.parent().hide();
+        }
     }
     searchStates.forEach(initSearchState);
 
@@ -299,8 +440,7 @@ function initFactExprApp(appConfig) {
         if(['expression', 'phenotype'].indexOf(state.searchMode) >= 0) {
             state.searchResultsTable.bootstrapTable('showLoading');
 
-            var url = '../search/' + state.searchMode + '/' + encURIComp(text) + '/1/100';
-            state.prevGeneSearch = $.getJSON(url, function(data) {
+            var loadResults = function(data) {
                 var tableRows = [];
                 for(var rowIndex = 0; rowIndex < data.total_count; rowIndex++) {
                     tableRows.push({
@@ -310,9 +450,19 @@ function initFactExprApp(appConfig) {
                 }
 
                 state.searchResultsTable.bootstrapTable('load', tableRows);
-            }).always(function() {
-                state.searchResultsTable.bootstrapTable('hideLoading');
-            });
+            };
+
+            if(staticManifest) {
+                state.prevGeneSearch = searchExpressionIndex(text, function(data) {
+                    loadResults(data);
+                    state.searchResultsTable.bootstrapTable('hideLoading');
+                });
+            } else {
+                var url = '../search/' + state.searchMode + '/' + encURIComp(text) + '/1/100';
+                state.prevGeneSearch = $.getJSON(url, loadResults).always(function() {
+                    state.searchResultsTable.bootstrapTable('hideLoading');
+                });
+            }
         }
     }
 
@@ -330,7 +480,7 @@ function initFactExprApp(appConfig) {
 
         if(['expression', 'correlation'].indexOf(state.otherState.searchMode) >= 0) {
             var url = '../correlation/pearson/expression/' + encURIComp(state.otherState.selectionID) + '/expression/100';
-            state.prevGeneSearch = $.getJSON(url, function(data) {
+            var loadResults = function(data) {
                 var tableRows = [];
                 for(var rowIndex = 0; rowIndex < data.total_count; rowIndex++) {
                     tableRows.push({
@@ -341,9 +491,33 @@ function initFactExprApp(appConfig) {
                 }
 
                 state.searchResultsTable.bootstrapTable('load', tableRows);
-            }).always(function() {
-                state.searchResultsTable.bootstrapTable('hideLoading');
-            });
+            };
+
+            if(window.EventSource) {
+                // stream the provisional leaders so that the table fills in while the scan runs
+                var source = new EventSource(url + '?format=sse');
+                var first = true;
+                source.onmessage = function(event) {
+                    var data = JSON.parse(event.data);
+                    if(first) {
+                        state.searchResultsTable.bootstrapTable('hideLoading');
+                        first = false;
+                    }
+                    loadResults(data);
+                    if(data.final) {
+                        source.close();
+                    }
+                };
+                source.onerror = function() {
+                    state.searchResultsTable.bootstrapTable('hideLoading');
+                    source.close();
+                };
+                state.prevGeneSearch = {abort: function() {source.close();}};
+            } else {
+                state.prevGeneSearch = $.getJSON(url, loadResults).always(function() {
+                    state.searchResultsTable.bootstrapTable('hideLoading');
+                });
+            }
         }
     }
 
@@ -592,7 +766,11 @@ function initFactExprApp(appConfig) {
                         //min: 0
                     }
                 };
-                scatterPlot.renderPlot(scatterPlotParams);
+                if(useScatterDensity(scatterPlotParams.sampleCount)) {
+                    renderScatterDensity(scatterPlotParams);
+                } else {
+                    scatterPlot.renderPlot(scatterPlotParams);
+                }
             }
         } catch(msg) {
             console.error('failed to render plot');
@@ -600,6 +778,51 @@ function initFactExprApp(appConfig) {
         }
     }
 
+    // large gene vs. gene scatter plots are drawn as density bins from the server rather than a point per sample
+    var scatterDensityThreshold = typeof appConfig.scatter_density_threshold === 'undefined' ?
+        2000 : appConfig.scatter_density_threshold;
+    var scatterDensityReq = null;
+    function useScatterDensity(sampleCount) {
+        return !staticManifest && sampleCount > scatterDensityThreshold && searchStates.every(function(state) {
+            return state.selectionKind === 'expression';
+        });
+    }
+
+    function renderScatterDensity(scatterPlotParams) {
+        var url =
+            '../scatter-density/' + encURIComp(searchStates[0].selectionID) +
+            '/' + encURIComp(searchStates[1].selectionID) +
+            '?log=' + (log2TransformBtn.is(':checked') ? '1' : '0');
+        var densityFactor = appConfig.scatter_density_factor;
+        var densityColors = {};
+        if(densityFactor) {
+            url += '&factor=' + encodeURIComponent(densityFactor);
+            var levelStyles = (appConfig.factors[densityFactor] || {}).level_styles || {};
+            $.each(levelStyles, function(level, style) {
+                if(style.fill) {
+                    densityColors[level] = style.fill;
+                }
+            });
+        }
+
+        if(scatterDensityReq !== null) {
+            scatterDensityReq.abort();
+        }
+        scatterDensityReq = $.getJSON(url, function(density) {
+            scatterDensityReq = null;
+            scatterPlotParams.renderPoints = false;
+            scatterPlotParams.density = density;
+            scatterPlotParams.densityColors = densityColors;
+            if(density.x_range !== null) {
+                scatterPlotParams.xAxis.min = density.x_range[0];
+                scatterPlotParams.xAxis.max = density.x_range[1];
+                scatterPlotParams.yAxis.min = density.y_range[0];
+                scatterPlotParams.yAxis.max = density.y_range[1];
+            }
+            scatterPlot.renderPlot(scatterPlotParams);
+        });
+    }
+
     var log2TransformBtn = $('#log2-transform');
     log2TransformBtn.change(refreshPlots);
 
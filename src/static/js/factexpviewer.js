@@ -886,6 +886,53 @@ function renderShape(parentNode, sizePx, shape) {
     }
 }
 
+/**
+ * Render density bins (as returned by the /scatter-density/ route) in place of individual points. Every bin is
+ * colored by its group (factor level) and is more opaque the more points it holds.
+ * @param parentNode                the d3 parent node to render to
+ * @param density                   the density object returned by /scatter-density/
+ * @param xScale                    the d3 scale for X values
+ * @param yScale                    the d3 scale for Y values
+ * @param [levelColors]             an object mapping group levels to fill colors. Levels without a color are
+ *                                  given one from d3.scale.category10
+ */
+function renderDensityBins(parentNode, density, xScale, yScale, levelColors) {
+    var maxCount = 0;
+    density.groups.forEach(function(group) {
+        maxCount = Math.max(maxCount, d3.max(group.counts) || 0);
+    });
+
+    // the vertices of a bin relative to its center (see scatter_density.py)
+    var w = density.bin_width;
+    var h = density.bin_height;
+    var offsets;
+    if(density.shape === 'hex') {
+        offsets = [[0, h / 3], [w / 2, h / 6], [w / 2, -h / 6], [0, -h / 3], [-w / 2, -h / 6], [-w / 2, h / 6]];
+    } else {
+        offsets = [[-w / 2, -h / 2], [w / 2, -h / 2], [w / 2, h / 2], [-w / 2, h / 2]];
+    }
+
+    var defaultColors = d3.scale.category10();
+    density.groups.forEach(function(group) {
+        var color = levelColors && levelColors.hasOwnProperty(group.level) ?
+            levelColors[group.level] : defaultColors(group.level);
+        var groupNode = parentNode.append('g').attr('class', 'density-bins');
+        group.counts.forEach(function(count, i) {
+            var cx = group.x[i];
+            var cy = group.y[i];
+            var points = offsets.map(function(offset) {
+                return xScale(cx + offset[0]) + ',' + yScale(cy + offset[1]);
+            });
+            groupNode.append('polygon')
+                .attr('points', points.join(' '))
+                .style('fill', color)
+                .style('fill-opacity', 0.15 + 0.85 * count / maxCount)
+                .append('title')
+                .text(group.level + ': ' + count);
+        });
+    });
+}
+
 /**
  * The factorial plot object.
  * @param params.svg a D3 object for the svg element. Eg: d3.select('#id-of-svg-elem')
@@ -1029,6 +1076,9 @@ function FactExpPlot(params) {
      * @param {AxisDescription} [params.xAxis] describes the X axis
      * @param {AxisDescription} [params.yAxis] describes the Y axis
      * @param {boolean} [params.renderPoints=true] determines if we actually render the plot data points
+     * @param {Object} [params.density] density bins from the /scatter-density/ route to draw in place of
+     *          the points (set renderPoints to false). Only used when both axes are numeric
+     * @param {Object} [params.densityColors] an object mapping density group levels to fill colors
      */
     this.renderPlot = function(params) {
         svg.selectAll('#' + idPrefix + 'plot-content').remove();
@@ -1542,6 +1592,11 @@ function FactExpPlot(params) {
             }
         }
 
+        if(params.density && xAxis.numericScales !== null && yAxis.numericScales !== null) {
+            renderDensityBins(pointGrp, params.density, xAxis.numericScales[0], yAxis.numericScales[0],
+                              params.densityColors);
+        }
+
         // draw whiskers
         // TODO generalize me to X and Y
         if(typeof params.yAxis.whiskers !== 'undefined' && yAxis.numeric !== null) {
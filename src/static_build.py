@@ -0,0 +1,281 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pre-render an experiment into a directory of static files so that any web server or CDN can serve it without
+python or mongo. Run it after every import, eg:
+
+    python src/static_build.py /var/www/experiment --processes 8
+
+and serve the directory from the web server's root. The build writes:
+
+* index.html with the static manifest (the paths of the data files below) embedded so that the client reads
+  the data files rather than calling the API. Searching genes and plotting their expression work as usual but
+  phenotype and correlation searches need the application server
+* data/: the /samples/ table, /app-config.json, every gene's /expression/<id>?slim=1 payload (the full payload
+  is rebuilt from these two in the client) and a search index of every gene's ID, symbol and data file. Every
+  data file is named after a hash of its content so it can be cached forever
+* static/: a copy of the application's javascript and stylesheets
+
+Every data file and index.html is also written precompressed (.gz) for servers that can serve those directly
+(eg. nginx's gzip_static). The payloads are rendered through the application's own routes (in parallel worker
+processes) so they are identical to what the server would send. The build remembers a hash of each gene's inputs
+(its values and the sample table version) and only renders the genes whose inputs changed since the last build.
+Data files that are no longer referenced are removed.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+import numpy as np
+
+# the build state (the input hash and data file of every gene) is kept here between builds
+STATE_FILE = '.static-build-state.json'
+
+DATA_DIR = 'data'
+
+_CLIENT = None
+
+
+def _encode_uri_component(text):
+    # the same encoding as encURIComp in factexprapp.js (see application._decode_uri_slashes)
+    return quote(text.replace('\\', '\\b').replace('/', '\\f').encode('utf-8'), safe='')
+
+
+def _write_file(out_dir, path, content):
+    """
+    Write a file and its gzip-compressed copy (with a fixed timestamp so that unchanged content gives an
+    unchanged file).
+    """
+    full_path = os.path.join(out_dir, path)
+    if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+
+    with open(full_path, 'wb') as handle:
+        handle.write(content)
+    with open(full_path + '.gz', 'wb') as handle:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=handle, mtime=0) as gzip_handle:
+            gzip_handle.write(content)
+
+
+def _write_data_file(out_dir, name, content):
+    """
+    Write a data file named after a hash of its content unless it already exists.
+
+    :return: the path of the file relative to out_dir
+    """
+    path = '{}/{}.{}.json'.format(DATA_DIR, name, hashlib.sha1(content).hexdigest()[:16])
+    if not os.path.exists(os.path.join(out_dir, path)):
+        _write_file(out_dir, path, content)
+
+    return path
+
+
+def _get(url):
+    global _CLIENT
+    if _CLIENT is None:
+        import application
+        _CLIENT = application.app.test_client()
+
+    response = _CLIENT.get(url)
+    if response.status_code != 200:
+        raise Exception('GET {} failed with status {}'.format(url, response.status_code))
+
+    return response.data
+
+
+def _render_expression(task):
+    """
+    Render a gene's slim expression payload (this runs in a worker process).
+
+    :param task: a (gene ID, output directory) tuple
+    :return: the path of the gene's data file
+    """
+    gene_id, out_dir = task
+    content = _get('/expression/{}?slim=1'.format(_encode_uri_component(gene_id)))
+
+    return _write_data_file(out_dir, 'expression/gene', content)
+
+
+def _expression_input_hashes(expr_matrix, sample_order_version):
+    """
+    :return: a dict of gene ID to a hash of the inputs of the gene's expression payload
+    """
+    input_hashes = {}
+    for start, stop, block in expr_matrix.iter_blocks(1024):
+        for gene_id, values in zip(expr_matrix.gene_ids[start:stop], block):
+            input_hash = hashlib.sha1(sample_order_version.encode('utf-8'))
+            input_hash.update(np.ascontiguousarray(values).tobytes())
+            input_hashes[gene_id] = input_hash.hexdigest()
+
+    return input_hashes
+
+
+def _load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as handle:
+            return json.load(handle)
+    except (IOError, OSError, ValueError):
+        return {'expression': {}}
+
+
+def _copy_static_assets(static_dir, out_dir):
+    """
+    Copy the application's static assets, skipping the files that haven't changed.
+
+    :return: the number of files copied
+    """
+    copied = 0
+    for root, _, filenames in os.walk(static_dir):
+        for filename in filenames:
+            source = os.path.join(root, filename)
+            target = os.path.join(out_dir, 'static', os.path.relpath(source, static_dir))
+            if os.path.exists(target):
+                source_stat, target_stat = os.stat(source), os.stat(target)
+                same_size = source_stat.st_size == target_stat.st_size
+                if same_size and int(source_stat.st_mtime) == int(target_stat.st_mtime):
+                    continue
+
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy2(source, target)
+            copied += 1
+
+    return copied
+
+
+def _remove_unreferenced(out_dir, referenced):
+    """
+    Remove the data files (and their compressed copies) that aren't in referenced.
+
+    :return: the number of data files removed
+    """
+    removed = 0
+    for root, _, filenames in os.walk(os.path.join(out_dir, DATA_DIR)):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), out_dir).replace(os.sep, '/')
+            if path.endswith('.gz'):
+                path = path[:-3]
+            if path not in referenced:
+                os.remove(os.path.join(root, filename))
+                removed += 0 if filename.endswith('.gz') else 1
+
+    return removed
+
+
+def build(out_dir, processes=None):
+    """
+    Build (or update) the static files for the current dataset version.
+
+    :param out_dir: the output directory
+    :param processes: the number of worker processes that render payloads (the number of CPUs by default)
+    :return: a dict of the number of genes 'rendered' and 'reused', the number of static assets 'copied' and the
+             number of data files 'removed'
+    """
+    import application
+    import dataset
+
+    # the workers are forked from this process so build the structures here first. The workers then never need
+    # to check the dataset version (so they never talk to mongo) because it can't change during the build
+    expr_matrix = dataset.get_expression_matrix()
+    sample_index = dataset.get_sample_index()
+    dataset.set_version_check_interval(float('inf'))
+
+    state = _load_state(out_dir)
+    input_hashes = _expression_input_hashes(expr_matrix, sample_index.sample_order_version)
+    expression_files = {}
+    stale_gene_ids = []
+    for gene_id, input_hash in input_hashes.items():
+        previous = state['expression'].get(gene_id)
+        if previous is not None and previous[0] == input_hash and os.path.exists(os.path.join(out_dir, previous[1])):
+            expression_files[gene_id] = previous[1]
+        else:
+            stale_gene_ids.append(gene_id)
+
+    if stale_gene_ids:
+        pool = multiprocessing.Pool(processes)
+        try:
+            paths = pool.map(_render_expression, [(gene_id, out_dir) for gene_id in stale_gene_ids], chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+        expression_files.update(zip(stale_gene_ids, paths))
+
+    search_index = {
+        'ids': expr_matrix.gene_ids,
+        'names': expr_matrix.gene_symbols,
+        'files': [expression_files[gene_id] for gene_id in expr_matrix.gene_ids],
+    }
+    manifest = {
+        'dataset_version': dataset.get_dataset_version(),
+        'samples': _write_data_file(out_dir, 'samples', _get('/samples/')),
+        'app_config': _write_data_file(out_dir, 'app-config', _get('/app-config.json')),
+        'expression_index': _write_data_file(
+            out_dir, 'expression-index', json.dumps(search_index, separators=(',', ':')).encode('utf-8')),
+    }
+
+    with application.app.test_request_context('/index.html'):
+        index_html = application.render_template(
+            'index.html', web_app_conf=application.config.WEB_APP_CONF, static_manifest=manifest)
+    _write_file(out_dir, 'index.html', index_html.encode('utf-8'))
+
+    copied = _copy_static_assets(application.app.static_folder, out_dir)
+    data_files = set(expression_files.values())
+    data_files.update(path for key, path in manifest.items() if key != 'dataset_version')
+    removed = _remove_unreferenced(out_dir, data_files)
+
+    state = {'expression': {gene_id: [input_hashes[gene_id], path] for gene_id, path in expression_files.items()}}
+    with open(os.path.join(out_dir, STATE_FILE), 'w') as handle:
+        json.dump(state, handle)
+
+    return {
+        'rendered': len(stale_gene_ids),
+        'reused': len(input_hashes) - len(stale_gene_ids),
+        'copied': copied,
+        'removed': removed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pre-render the experiment into static files')
+    parser.add_argument(
+        '--processes',
+        type=int,
+        help='the number of worker processes (the number of CPUs by default)')
+    parser.add_argument('out_dir', help='the directory to write the static files to')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    counts = build(args.out_dir, args.processes)
+    print('rendered {rendered} genes, reused {reused}, copied {copied} static assets and removed {removed} '
+          'unreferenced data files'.format(**counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Export expression matrices and sample designs as tab-separated files in the same format that importdesnp.py reads,
+so an export can be imported into another database. Exports are generated a block of genes at a time so memory use
+doesn't depend on the size of the export.
+
+The export functions are used by the /export/ routes and can also be run from the command line, eg:
+
+    python src/tsv_export.py --genes-file genes.txt --subset tissue=hypothalamus --gzip expression.tsv.gz
+"""
+
+import argparse
+import re
+import sys
+import zlib
+
+import numpy as np
+
+import importdesnp
+
+# the number of genes to read from the matrix at once
+BLOCK_SIZE = 256
+
+REGION_PATTERN = re.compile(r'^(?P<chrom>[^:]+):(?P<start>\d+)-(?P<end>\d+)$')
+
+
+def parse_region(region):
+    """
+    :param region: a region string like "chr7:1000000-2000000"
+    :return: a (chrom, start, end) tuple
+    """
+    match = REGION_PATTERN.match(region.replace(',', ''))
+    if match is None:
+        raise ValueError('"{}" is not a region like chr7:1000000-2000000'.format(region))
+
+    return match.group('chrom'), int(match.group('start')), int(match.group('end'))
+
+
+def select_gene_rows(expr_matrix, intervals, gene_ids=None, regions=None):
+    """
+    Find the matrix rows to export. Genes are exported in the order given followed by the genes in each region
+    (ordered by position). Every gene is only exported once and unknown gene IDs are skipped. If no genes or
+    regions are given every gene is exported.
+
+    :param expr_matrix: the ExpressionMatrix
+    :param intervals: the GeneIntervalIndex
+    :param gene_ids: a list of gene IDs
+    :param regions: a list of (chrom, start, end) tuples
+    :return: an array of matrix row indexes
+    """
+    if not gene_ids and not regions:
+        return np.arange(len(expr_matrix.gene_ids))
+
+    rows = []
+    seen = set()
+    region_gene_ids = [
+        intervals.gene_ids[i]
+        for chrom, start, end in regions or []
+        for i in intervals.overlapping(chrom, start, end)
+    ]
+    for gene_id in list(gene_ids or []) + region_gene_ids:
+        row = expr_matrix.gene_index(gene_id)
+        if row is not None and row not in seen:
+            seen.add(row)
+            rows.append(row)
+
+    return np.array(rows, dtype=np.int64)
+
+
+def _format_value(value):
+    # repr keeps every digit so values survive a round trip. Missing values are written as nan which float()
+    # (and so the importer) reads back as NaN
+    return repr(value)
+
+
+def iter_expression_tsv(expr_matrix, intervals, gene_rows, sample_mask=None):
+    """
+    Generate an expression matrix in the importer's intensities file format. Genes without positions have empty
+    Start and End columns (and an empty Chr column if they have no chromosome either), which the importer reads
+    back as missing coordinates.
+
+    :param expr_matrix: the ExpressionMatrix
+    :param intervals: the GeneIntervalIndex (for the gene coordinates)
+    :param gene_rows: the matrix rows to export (see select_gene_rows)
+    :param sample_mask: an optional boolean mask of the samples to export
+    :return: a generator of text chunks (the header and then one chunk per block of genes)
+    """
+    if sample_mask is None:
+        sample_mask = np.ones(len(expr_matrix.mouse_ids), dtype=bool)
+    mouse_ids = [mouse_id for mouse_id, selected in zip(expr_matrix.mouse_ids, sample_mask) if selected]
+
+    yield '\t'.join([
+        importdesnp.GENE_ID_HEADER,
+        importdesnp.GENE_SYMBOL_HEADER,
+        importdesnp.CHR_HEADER,
+        importdesnp.START_POS_HEADER,
+        importdesnp.END_POS_HEADER,
+    ] + mouse_ids) + '\n'
+
+    for start in range(0, len(gene_rows), BLOCK_SIZE):
+        block_rows = gene_rows[start:start + BLOCK_SIZE]
+        values = expr_matrix.rows(block_rows)[:, sample_mask]
+        lines = []
+        for row, gene_values in zip(block_rows, values.tolist()):
+            gene_id = expr_matrix.gene_ids[row]
+            chrom, gene_start, gene_end = intervals.location(gene_id) or (intervals.chromosome(gene_id) or '', '', '')
+            lines.append('\t'.join(
+                [gene_id, expr_matrix.gene_symbols[row], chrom, str(gene_start), str(gene_end)] +
+                [_format_value(value) for value in gene_values]))
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_design_tsv(sample_index, sample_mask=None):
+    """
+    Generate the sample design in the importer's design file format.
+
+    :param sample_index: the SampleIndex
+    :param sample_mask: an optional boolean mask of the samples to export
+    :return: a generator of text chunks
+    """
+    if sample_mask is None:
+        sample_mask = np.ones(sample_index.sample_count, dtype=bool)
+    mouse_ids = [mouse_id for mouse_id, selected in zip(sample_index.mouse_ids, sample_mask) if selected]
+    factor_columns = [sample_index.factor_values(factor_id, sample_mask) for factor_id in sample_index.factor_ids]
+
+    yield '\t'.join([importdesnp.SAMPLE_ID_HEADER] + list(sample_index.factor_ids)) + '\n'
+    for i, mouse_id in enumerate(mouse_ids):
+        yield '\t'.join([mouse_id] + [column[i] for column in factor_columns]) + '\n'
+
+
+def iter_gzip(chunks):
+    """
+    Gzip-compress text chunks as they are generated.
+
+    :param chunks: an iterable of text chunks
+    :return: a generator of compressed byte chunks
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _write_chunks(handle, chunks):
+    for chunk in chunks:
+        handle.write(chunk)
+
+
+def main():
+    import cache_snapshot
+    import config
+    import dataset
+    import mongodb_utils
+
+    parser = argparse.ArgumentParser(description='export expression data in the import file format')
+    parser.add_argument('--gene', action='append', default=[], help='a gene ID to export (can be repeated)')
+    parser.add_argument('--genes-file', help='a file of gene IDs to export (one per line)')
+    parser.add_argument(
+        '--region',
+        action='append',
+        default=[],
+        help='export the genes overlapping a region like chr7:1000000-2000000 (can be repeated)')
+    parser.add_argument('--subset', help='a sample subset filter like "tissue=hypothalamus;time=6hrs|9hrs"')
+    parser.add_argument('--design-file', help='also write the design file of the exported samples to this file')
+    parser.add_argument('--gzip', action='store_true', help='gzip-compress the output')
+    parser.add_argument('intensities_file', help='the file to write the expression data to ("-" for stdout)')
+    args = parser.parse_args()
+
+    gene_ids = list(args.gene)
+    if args.genes_file:
+        with open(args.genes_file) as genes_handle:
+            gene_ids.extend(line.strip() for line in genes_handle if line.strip())
+    try:
+        regions = [parse_region(region) for region in args.region]
+    except ValueError as e:
+        parser.error(str(e))
+
+    mongodb_utils.connect(config.MONGO_SERVER, config.MONGO_PORT)
+    mongodb_utils.set_default_database(config.MONGO_DATABASE)
+    cache_snapshot.set_snapshot_dir(getattr(config, 'CACHE_SNAPSHOT_DIR', None), config.MONGO_DATABASE)
+
+    expr_matrix = dataset.get_expression_matrix()
+    intervals = dataset.get_gene_intervals()
+    sample_index = dataset.get_sample_index()
+    sample_mask = sample_index.select(args.subset)
+    gene_rows = select_gene_rows(expr_matrix, intervals, gene_ids, regions)
+
+    outputs = [(args.intensities_file, iter_expression_tsv(expr_matrix, intervals, gene_rows, sample_mask))]
+    if args.design_file:
+        outputs.append((args.design_file, iter_design_tsv(sample_index, sample_mask)))
+
+    for path, chunks in outputs:
+        if args.gzip:
+            chunks = iter_gzip(chunks)
+        else:
+            chunks = (chunk.encode('utf-8') for chunk in chunks)
+
+        if path == '-':
+            _write_chunks(getattr(sys.stdout, 'buffer', sys.stdout), chunks)
+        else:
+            with open(path, 'wb') as handle:
+                _write_chunks(handle, chunks)
+
+    sys.stderr.write('exported {} genes x {} samples\n'.format(len(gene_rows), int(sample_mask.sum())))
+
+
+if __name__ == '__main__':
+    main()
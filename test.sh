@@ -4,6 +4,10 @@ echo "Calling API with regex mouse ID..."
 echo "=================================="
 curl -H "Content-Type: application/json" -X POST -d '{"mouse_id": { "$regex": "NZO" }}' http://127.0.0.1:5000/mice/
 
+echo "Calling API with regex mouse ID streaming projected NDJSON..."
+echo "=================================="
+curl -H "Content-Type: application/json" -X POST -d '{"mouse_id": { "$regex": "NZO" }}' 'http://127.0.0.1:5000/mice/?format=ndjson&limit=10&fields=mouse_id,factors'
+
 echo "Get data for an individual mouse"
 echo "=================================="
 curl http://127.0.0.1:5000/mouse/NZO-7
@@ -0,0 +1,53 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared pytest fixtures. The modules in src/ are imported the same way the server imports them (as top-level
+modules) and the database tests run against mongomock rather than a real server.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """
+    Point pymongo (and so the importer and mongodb_utils) at an empty in-memory mongomock database.
+
+    :return: the mongomock database
+    """
+    mongomock = pytest.importorskip('mongomock')
+    import pymongo
+    if pymongo.version_tuple[0] >= 4:
+        pytest.skip('the importer uses the pymongo 3 API (see requirements.txt)')
+
+    import config
+    import mongodb_utils
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setattr(config, 'MONGO_DATABASE', 'testdb')
+    monkeypatch.setattr(mongodb_utils, 'MONGO', client)
+    monkeypatch.setattr(mongodb_utils, 'DEFAULT_DB', 'testdb')
+
+    return client['testdb']
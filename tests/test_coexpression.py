@@ -0,0 +1,73 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import coexpression
+
+
+def _random_edges(gene_count, edge_count, seed):
+    random_state = np.random.RandomState(seed)
+    sources = random_state.randint(0, gene_count, edge_count)
+    targets = random_state.randint(0, gene_count, edge_count)
+    keep = sources != targets
+    sources, targets = sources[keep], targets[keep]
+
+    return np.concatenate([sources, targets]), np.concatenate([targets, sources])
+
+
+def test_color_genes_never_gives_neighbours_the_same_color():
+    sources, targets = _random_edges(200, 1000, 0)
+
+    colors, color_count = coexpression._color_genes(sources, targets, 200)
+
+    assert (colors >= 0).all() and (colors < color_count).all()
+    assert (colors[sources] != colors[targets]).all()
+
+
+def test_best_labels_picks_the_heaviest_label():
+    # gene 0 has two votes for label 5 and one heavier vote for label 2, gene 1 has a tie between labels 4 and 3
+    # and gene 3 has a single vote
+    sources = np.array([0, 0, 0, 1, 1, 3])
+    labels = np.array([5, 2, 5, 4, 3, 0])
+    weights = np.array([0.3, 0.5, 0.3, 0.7, 0.7, 0.1])
+
+    genes, best_labels = coexpression._best_labels(sources, labels, weights, 6)
+
+    assert genes.tolist() == [0, 1, 3]
+    assert best_labels.tolist() == [5, 3, 0]
+
+
+def test_propagate_labels_finds_connected_groups():
+    # two triangles (genes 0-2 and 3-5) that aren't connected to each other and a gene (6) without neighbours
+    neighbour_indexes = np.array([[1, 2], [2, 0], [0, 1], [4, 5], [5, 3], [3, 4], [0, 0]])
+    neighbour_weights = np.array([[0.9, 0.8], [0.9, 0.9], [0.8, 0.9], [0.7, 0.7], [0.7, 0.7], [0.7, 0.7], [0, 0]])
+
+    labels = coexpression._propagate_labels(neighbour_indexes, neighbour_weights)
+
+    assert len(set(labels[:3])) == 1
+    assert len(set(labels[3:6])) == 1
+    assert labels[0] != labels[3]
+    assert labels[6] == 6
+
+
+def test_propagate_labels_counts_edges_from_either_end():
+    # only gene 0 lists gene 1 as a neighbour but gene 1 still takes part in the module
+    labels = coexpression._propagate_labels(np.array([[1], [2], [0]]), np.array([[0.9], [0.0], [0.0]]))
+
+    assert labels.tolist() == [1, 1, 2]
@@ -0,0 +1,72 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+import correlation
+
+stats = pytest.importorskip('scipy.stats')
+
+
+def _rows_with_missing_values(seed):
+    random_state = np.random.RandomState(seed)
+    x = random_state.normal(size=30)
+    rows = x + random_state.normal(scale=2.0, size=(40, 30))
+    rows[random_state.random_sample(rows.shape) < 0.1] = np.nan
+    x[[3, 17]] = np.nan
+    rows[0] = np.nan
+    rows[1, 2:] = np.nan
+    rows[2] = 5.0
+
+    return x, rows
+
+
+def _scipy_correlations(corr_func, x, rows):
+    expected = []
+    for row in rows:
+        common = ~np.isnan(x) & ~np.isnan(row)
+        if common.sum() < correlation.MIN_COMMON_SAMPLES or np.ptp(row[common]) == 0:
+            expected.append(np.nan)
+        else:
+            expected.append(corr_func(x[common], row[common])[0])
+
+    return np.array(expected)
+
+
+def test_pearson_rows_matches_scipy_with_missing_values():
+    x, rows = _rows_with_missing_values(0)
+    expected = _scipy_correlations(stats.pearsonr, x, rows)
+
+    assert np.allclose(correlation.pearson_rows(x, rows), expected, equal_nan=True)
+
+
+def test_spearman_rows_matches_scipy_with_missing_values():
+    x, rows = _rows_with_missing_values(1)
+    # rounding gives plenty of ties
+    x, rows = np.round(x), np.round(rows)
+    expected = _scipy_correlations(stats.spearmanr, x, rows)
+
+    assert np.allclose(correlation.spearman_rows(x, rows), expected, equal_nan=True)
+
+
+def test_rank_rows_matches_scipy():
+    values = np.round(np.random.RandomState(2).normal(size=(5, 20)))
+    expected = np.array([stats.rankdata(row) for row in values])
+
+    assert np.array_equal(correlation.rank_rows(values), expected)
@@ -0,0 +1,84 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+import correlation
+import correlation_significance
+
+
+def _reference_q_values(p_values):
+    # the textbook definition: q(i) = min over j >= i of p(j) * n / j for the p-values sorted in ascending order
+    tested = sorted(p for p in p_values if not np.isnan(p))
+    n = len(tested)
+    q_by_rank = [min(1.0, min(tested[j] * n / (j + 1.0) for j in range(i, n))) for i in range(n)]
+    q_values = []
+    for p in p_values:
+        q_values.append(np.nan if np.isnan(p) else q_by_rank[tested.index(p)])
+
+    return np.array(q_values)
+
+
+def test_benjamini_hochberg_matches_the_definition():
+    p_values = np.array([0.01, 0.04, np.nan, 0.03, 0.5, 0.04, 0.9, 0.002])
+
+    q_values = correlation_significance.benjamini_hochberg(p_values)
+
+    assert np.allclose(q_values, _reference_q_values(p_values), equal_nan=True)
+    assert np.isnan(q_values[2])
+
+
+def test_benjamini_hochberg_without_tests():
+    q_values = correlation_significance.benjamini_hochberg(np.array([np.nan, np.nan]))
+
+    assert np.isnan(q_values).all()
+
+
+@pytest.mark.parametrize('corr_kind', correlation.CORRELATION_KINDS)
+def test_permutation_p_values_match_brute_force(corr_kind):
+    random_state = np.random.RandomState(3)
+    search_values = random_state.normal(size=12)
+    rows = search_values * np.linspace(0.0, 1.0, 8)[:, np.newaxis] + random_state.normal(size=(8, 12))
+    # a missing search value, a candidate with missing values and one without enough samples
+    search_values[5] = np.nan
+    rows[2, [0, 4]] = np.nan
+    rows[6, 2:] = np.nan
+    ids = ['G{}'.format(i) for i in range(len(rows))]
+    search = correlation.CorrelationSearch(
+        corr_kind, search_values, ids, ids, correlation.ArrayRows(rows), exclude_id='G7')
+    permutations, seed = 50, 7
+
+    correlations, p_values = correlation_significance.permutation_p_values(search, permutations, seed, block_size=3)
+
+    present = ~np.isnan(search_values)
+    shuffled = search_values[present][correlation_significance.permutation_matrix(present.sum(), permutations, seed)]
+    expected = []
+    for i, row in enumerate(rows):
+        observed = search.corr_func(search_values, row[np.newaxis, :])[0]
+        if np.isnan(observed) or ids[i] == search.exclude_id:
+            expected.append(np.nan)
+            continue
+
+        permuted = np.array([search.corr_func(values, row[np.newaxis, present])[0] for values in shuffled])
+        exceed_count = (np.abs(permuted) >= abs(observed) - correlation_significance.TOLERANCE).sum()
+        expected.append((exceed_count + 1.0) / (permutations + 1.0))
+
+    assert np.isnan(p_values[6]) and np.isnan(p_values[7])
+    assert np.allclose(p_values, expected, equal_nan=True)
+    assert np.array_equal(np.isnan(correlations), np.isnan(p_values))
@@ -0,0 +1,117 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+import importdesnp
+import tsv_export
+from expression_matrix import ExpressionMatrix
+from gene_intervals import GeneIntervalIndex
+
+MOUSE_IDS = ['M1', 'M2', 'M3', 'M4']
+
+GENE_COLUMNS = [
+    importdesnp.GENE_ID_HEADER,
+    importdesnp.GENE_SYMBOL_HEADER,
+    importdesnp.CHR_HEADER,
+    importdesnp.START_POS_HEADER,
+    importdesnp.END_POS_HEADER,
+]
+
+# the second gene has a chromosome but no positions, the third has no coordinates at all and the fourth has a
+# missing value
+GENES = [
+    ['G1', 'Sym1', 'chr1', '100', '500', '1.5', '2.25', '3.0', '4.125'],
+    ['G2', 'Sym2', 'chr1', '', '', '0.5', '0.75', '1.0', '1.25'],
+    ['G3', 'Sym3', '', '', '', '7.0', '6.0', '5.0', '4.0'],
+    ['G4', 'Sym4', 'chr2', '1000', '2000', '2.0', 'nan', '3.5', '1.0'],
+]
+
+
+def _write_design(path):
+    lines = ['{}\ttissue'.format(importdesnp.SAMPLE_ID_HEADER)]
+    lines += ['{}\t{}'.format(mouse_id, 'liver' if i % 2 else 'brain') for i, mouse_id in enumerate(MOUSE_IDS)]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def _write_intensities(path, genes):
+    lines = ['\t'.join(GENE_COLUMNS + MOUSE_IDS)] + ['\t'.join(gene) for gene in genes]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def _import(monkeypatch, capsys, design_path, intensities_path, incremental):
+    flags = ['--incremental'] if incremental else []
+    monkeypatch.setattr(sys, 'argv', ['importdesnp.py'] + flags + [str(design_path), str(intensities_path)])
+    importdesnp.main()
+
+    return capsys.readouterr().out
+
+
+def _dataset_version(mongo):
+    return mongo.dataset.find_one({'_id': 'version'})['version']
+
+
+def test_reimporting_unchanged_values_finds_no_changes(mongo, monkeypatch, capsys, tmp_path):
+    design_path, intensities_path = tmp_path / 'design.tsv', tmp_path / 'intensities.tsv'
+    _write_design(design_path)
+    _write_intensities(intensities_path, GENES)
+    _import(monkeypatch, capsys, design_path, intensities_path, incremental=False)
+    assert _dataset_version(mongo) == 1
+
+    # a missing value that is still missing isn't a change
+    output = _import(monkeypatch, capsys, design_path, intensities_path, incremental=True)
+    assert 'no changes found' in output
+    assert _dataset_version(mongo) == 1
+
+
+def test_incremental_import_records_only_changed_genes(mongo, monkeypatch, capsys, tmp_path):
+    design_path, intensities_path = tmp_path / 'design.tsv', tmp_path / 'intensities.tsv'
+    _write_design(design_path)
+    _write_intensities(intensities_path, GENES)
+    _import(monkeypatch, capsys, design_path, intensities_path, incremental=False)
+
+    changed_genes = [list(gene) for gene in GENES]
+    changed_genes[3][6] = '2.5'
+    _write_intensities(intensities_path, changed_genes)
+    output = _import(monkeypatch, capsys, design_path, intensities_path, incremental=True)
+    assert '1 genes and 1 samples changed (0 new genes, 0 new samples)' in output
+    assert _dataset_version(mongo) == 2
+
+    change_doc = mongo.dataset_changes.find_one({'version': 2})
+    assert not change_doc['full']
+    assert change_doc['genes'] == ['G4']
+
+
+def test_exported_expression_reimports_without_changes(mongo, monkeypatch, capsys, tmp_path):
+    design_path, intensities_path = tmp_path / 'design.tsv', tmp_path / 'intensities.tsv'
+    _write_design(design_path)
+    _write_intensities(intensities_path, GENES)
+    _import(monkeypatch, capsys, design_path, intensities_path, incremental=False)
+
+    expr_matrix = ExpressionMatrix.from_mongo()
+    intervals = GeneIntervalIndex.from_mongo()
+    gene_rows = tsv_export.select_gene_rows(expr_matrix, intervals)
+    export_path = tmp_path / 'exported.tsv'
+    export_path.write_text(''.join(tsv_export.iter_expression_tsv(expr_matrix, intervals, gene_rows)))
+
+    exported = [line.split('\t')[:5] for line in export_path.read_text().splitlines()[1:]]
+    assert exported == [gene[:5] for gene in GENES]
+
+    output = _import(monkeypatch, capsys, design_path, export_path, incremental=True)
+    assert 'no changes found' in output
+    assert _dataset_version(mongo) == 1
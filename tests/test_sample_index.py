@@ -0,0 +1,55 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from sample_index import SampleIndex, SubsetError
+
+
+@pytest.fixture
+def sample_index():
+    # the last sample has no time
+    return SampleIndex(
+        ['M1', 'M2', 'M3', 'M4', 'M5'],
+        ['tissue', 'time'],
+        [['liver', 'brain'], ['0hrs', '6hrs']],
+        np.array([[0, 0, 1, 1, 0], [0, 1, 0, 1, -1]], dtype=np.int32),
+        ['A', 'A', 'B', 'B', 'B'],
+        ['chow'] * 5)
+
+
+@pytest.mark.parametrize('subset, expected', [
+    (None, [True, True, True, True, True]),
+    ('', [True, True, True, True, True]),
+    ('tissue=liver', [True, True, False, False, True]),
+    ('tissue=liver|brain', [True, True, True, True, True]),
+    ('tissue!=liver', [False, False, True, True, False]),
+    ('time!=0hrs', [False, True, False, True, True]),
+    ('tissue=liver;time=6hrs', [False, True, False, False, False]),
+    ('tissue=liver;;time=0hrs;', [True, False, False, False, False]),
+    ('tissue=kidney', [False, False, False, False, False]),
+])
+def test_select(sample_index, subset, expected):
+    assert sample_index.select(subset).tolist() == expected
+
+
+@pytest.mark.parametrize('subset', ['tissue', 'tissue=liver;time', 'strain=A'])
+def test_select_rejects_bad_subsets(sample_index, subset):
+    with pytest.raises(SubsetError):
+        sample_index.select(subset)
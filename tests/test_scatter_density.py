@@ -0,0 +1,78 @@
+# Copyright (c) 2015 The Jackson Laboratory
+#
+# This software was developed by Gary Churchill's Lab at The Jackson
+# Laboratory (see http://research.jax.org/faculty/churchill).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+import scatter_density
+
+
+def _points(seed, count=2000):
+    random_state = np.random.RandomState(seed)
+    return random_state.normal(size=count), random_state.normal(scale=3.0, size=count) + 10.0
+
+
+def test_hex_bins_are_the_nearest_lattice_centers():
+    x, y = _points(0)
+
+    bin_indexes, centers, grid = scatter_density.bin_points(x, y, 'hex', bins=10)
+
+    # distances in bin units with the row spacing scaled so that the lattice is regular
+    dx = (x[:, np.newaxis] - centers[:, 0]) / grid['bin_width']
+    dy = (y[:, np.newaxis] - centers[:, 1]) / grid['bin_height']
+    distances = dx ** 2 + 3.0 * dy ** 2
+    assert np.allclose(distances[np.arange(len(x)), bin_indexes], distances.min(axis=1))
+
+
+def test_hex_lattice_covers_the_ranges():
+    x, y = _points(1)
+
+    _, centers, grid = scatter_density.bin_points(x, y, 'hex', bins=10)
+
+    row_count = int(round(10 / np.sqrt(3.0)))
+    assert len(centers) == 11 * (row_count + 1) + 10 * row_count
+    assert np.isclose(grid['bin_height'], (y.max() - y.min()) / row_count)
+    assert np.isclose(centers[:, 0].min(), x.min()) and np.isclose(centers[:, 0].max(), x.max())
+    assert np.isclose(centers[:, 1].min(), y.min()) and np.isclose(centers[:, 1].max(), y.max())
+
+
+def test_rect_bins_contain_their_points():
+    x, y = _points(2)
+
+    bin_indexes, centers, grid = scatter_density.bin_points(x, y, 'rect', bins=8)
+
+    assert np.all(np.abs(x - centers[bin_indexes, 0]) <= grid['bin_width'] / 2 + 1e-9)
+    assert np.all(np.abs(y - centers[bin_indexes, 1]) <= grid['bin_height'] / 2 + 1e-9)
+
+
+def test_density_counts_every_present_point_once_per_group():
+    x, y = _points(3, count=100)
+    x[:5] = np.nan
+    groups = np.arange(100) % 3 - 1
+
+    result = scatter_density.density(x, y, groups, group_count=2)
+
+    present = ~np.isnan(x) & (groups >= 0)
+    assert result['point_count'] == present.sum()
+    assert [sum(group['counts']) for group in result['groups']] == [
+        (present & (groups == 0)).sum(), (present & (groups == 1)).sum()]
+
+
+def test_unknown_bin_shape():
+    with pytest.raises(ValueError):
+        scatter_density.bin_points(np.zeros(3), np.zeros(3), 'triangle')